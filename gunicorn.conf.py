@@ -0,0 +1,114 @@
+"""
+Gunicorn configuration
+
+Sizes the workers to the CPU and memory limits of the container, read
+from its cgroup, instead of the host it happens to be scheduled on.
+Every setting can be overridden with the environment variables below.
+
+    GUNICORN_WORKER_CLASS   gthread (default), sync, gevent or eventlet
+    WEB_CONCURRENCY         number of worker processes
+    GUNICORN_THREADS        threads per gthread worker
+    GUNICORN_WORKER_MEMORY  MiB each worker needs, caps the worker count
+    GUNICORN_PRELOAD        load the app once before forking (default true,
+                            false for gevent and eventlet)
+"""
+import math
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read(path):
+    try:
+        with open(path, encoding="utf-8") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_limit(root=CGROUP_ROOT):
+    """Returns the CPUs the cgroup may use, or the host CPU count"""
+    quota = _read(f"{root}/cpu.max")  # cgroup v2: "<quota> <period>"
+    if quota:
+        quota, period = quota.split()
+    else:  # cgroup v1
+        quota = _read(f"{root}/cpu/cpu.cfs_quota_us") or "-1"
+        period = _read(f"{root}/cpu/cpu.cfs_period_us") or "100000"
+    if quota not in ("max", "-1"):
+        return int(quota) / int(period)
+    return float(os.cpu_count() or 1)
+
+
+def memory_limit(root=CGROUP_ROOT):
+    """Returns the bytes of memory the cgroup may use, or None without a limit"""
+    limit = _read(f"{root}/memory.max") or _read(f"{root}/memory/memory.limit_in_bytes")
+    # cgroup v1 reports no limit as a number near the largest 64 bit integer
+    if limit and limit != "max" and int(limit) < 2**60:
+        return int(limit)
+    return None
+
+
+def worker_count(cpu, memory=None, worker_memory=64):
+    """Returns 2 workers per CPU plus one, as many as fit in the memory"""
+    count = math.ceil(cpu * 2) + 1 if cpu >= 1 else 2
+    if memory:
+        count = min(count, max(1, memory // (worker_memory * 2**20)))
+    return count
+
+
+cpus = cpu_limit()
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(
+    os.getenv("WEB_CONCURRENCY")
+    or worker_count(cpus, memory_limit(), int(os.getenv("GUNICORN_WORKER_MEMORY", "64")))
+)
+# Requests spend most of their time waiting on PostgreSQL, so each
+# worker gets a few threads, more when the CPU share is larger
+threads = int(os.getenv("GUNICORN_THREADS") or max(2, math.ceil(cpus * 4)))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+wsgi_app = "wsgi:app"
+
+# Loading the app before forking shares its memory between the workers
+# and fails fast on a bad configuration. The async workers patch the
+# standard library after the fork, so it is off by default with them.
+ASYNC_WORKERS = ("gevent", "eventlet")
+preload_app = os.getenv(
+    "GUNICORN_PRELOAD", "false" if worker_class in ASYNC_WORKERS else "true"
+).lower() == "true"
+
+# Recycle workers now and then so a slow leak cannot grow without bound,
+# with jitter so they do not all restart at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = max_requests // 10
+
+# Keep idle connections open longer than the ingress does (60 seconds
+# for ingress-nginx), so it never reuses one we have just closed
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+# Longer than MAX_REQUEST_TIMEOUT_MS so deadlines fail before the worker is killed
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "35"))
+graceful_timeout = 30
+# Heartbeat files on a memory file system, a slow overlay disk can get
+# healthy workers killed
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "*")
+
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops what the worker inherited from the preloaded app
+
+    Pooled connections opened by the master must not be used by two
+    processes, and the log listener thread did not survive the fork
+    """
+    if not server.cfg.preload_app:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service.common import log_handlers
+    from service.models import db
+
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+    log_handlers.restart_listener()
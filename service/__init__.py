@@ -23,7 +23,7 @@ This module contains the microservice code for
 import sys
 from flask import Flask
 from flask_restx import Api
-from service.common import log_handlers
+from service.common import log_handlers, admission
 from service import config
 
 # NOTE: Do not change the order of this code
@@ -50,9 +50,11 @@ def create_app():
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, init_db, hot_cache, stats_cache, Recommendation
+    from service.common import health
 
     db.init_app(app)
+    admission.init_admission(app)
 
     # Turn off strict slashes because it violates best practices
     app.url_map.strict_slashes = False
@@ -77,14 +79,42 @@ def create_app():
         # Import the routes After the Flask app is created
         # pylint: disable=import-outside-toplevel
         from service import routes  # noqa: F401, E402
-        from service.common import error_handlers  # pylint: disable=unused-import
-
+        from service.common import error_handlers, cli_commands  # pylint: disable=unused-import
+        from service.common import deadlines, read_cache, tracing
+
+        deadlines.init_deadlines(app)
+        tracing.init_tracing(app)
+
+        health.database.ttl = app.config["HEALTH_CHECK_TTL"]
+        stats_cache.ttl = app.config["STATS_CACHE_TTL"]
+        # Opened before gunicorn forks so every worker maps the same memory
+        if app.config["SHARED_CACHE_MB"] > 0:
+            hot_cache.open(
+                app.config["SHARED_CACHE_MB"] * 2**20,
+                app.config["SHARED_CACHE_SLOT_KB"] * 2**10,
+                app.config["SHARED_CACHE_TTL"],
+            )
+        health.warm_up.begin("database")
         try:
-            db.create_all()
+            init_db(app)
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
+        health.warm_up.finish("database")
+
+        # Load the lists the running pods looked up the most before taking traffic
+        if hot_cache.enabled and app.config["HOT_KEYS_WARM_UP"] > 0:
+            health.warm_up.begin("hot_keys")
+            warmed = read_cache.warm_up_hot_products(app.config["HOT_KEYS_WARM_UP"])
+            app.logger.info("Warmed the shared cache with %d hot products", warmed)
+            health.warm_up.finish("hot_keys")
+
+        # Without trigram indexes name searches are served from memory
+        if db.engine.dialect.name != "postgresql":
+            health.warm_up.begin("name_index")
+            Recommendation.build_name_index()
+            health.warm_up.finish("name_index")
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
@@ -0,0 +1,203 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+This module contains the token buckets and load shedding hooks that
+keep one noisy client from starving everyone else. Buckets are kept
+in process, so every gunicorn worker enforces its own share of a limit.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+GLOBAL_KEY = "*"
+
+
+class TokenBucket:
+    """A bucket that refills at a fixed rate up to its capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens: float = 1.0) -> float:
+        """Takes tokens from the bucket
+
+        Returns 0 when the tokens were taken, otherwise the number of
+        seconds to wait before enough tokens will be available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+
+class BucketStore:
+    """In process store of token buckets with least recently used eviction"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, rate: float, capacity: float) -> TokenBucket:
+        """Returns the bucket for a key, creating it if needed"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket.rate != rate or bucket.capacity != capacity:
+                bucket = TokenBucket(rate, capacity)
+                self._buckets[key] = bucket
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def clear(self):
+        """Removes all of the buckets"""
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class InFlightCounter:
+    """Thread safe count of the requests currently being served"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def enter(self) -> int:
+        """Counts a request in and returns the new total"""
+        with self._lock:
+            self.count += 1
+            return self.count
+
+    def leave(self):
+        """Counts a request out"""
+        with self._lock:
+            self.count -= 1
+
+
+buckets = BucketStore()
+in_flight = InFlightCounter()
+exempt_endpoints = set()
+
+
+def exempt(func):
+    """Decorator to keep a view, such as a health probe, out of load shedding"""
+    exempt_endpoints.add(func.__name__)
+    return func
+
+
+def _retry_after(seconds: float) -> int:
+    """Rounds a wait up to whole seconds for the Retry-After header"""
+    return max(1, math.ceil(seconds))
+
+
+def check_rate(key: str):
+    """Takes a token from the global bucket and the bucket for key
+
+    Raises TooManyRequests with a Retry-After when either is empty
+    """
+    burst = current_app.config["RATE_LIMIT_BURST"]
+    global_rate = current_app.config["RATE_LIMIT_GLOBAL"]
+    if global_rate > 0:
+        wait = buckets.get(GLOBAL_KEY, global_rate, burst).consume()
+        if wait:
+            raise TooManyRequests(
+                "Service rate limit exceeded", retry_after=_retry_after(wait)
+            )
+    key_rate = current_app.config["RATE_LIMIT_PER_KEY"]
+    if key_rate > 0 and key:
+        wait = buckets.get(key, key_rate, burst).consume()
+        if wait:
+            raise TooManyRequests(
+                "Rate limit exceeded for this client", retry_after=_retry_after(wait)
+            )
+
+
+def queue_time(header: str) -> float:
+    """Returns the seconds a request spent queued before reaching us
+
+    The header is the X-Request-Start value set by the ingress, either
+    "t=<epoch>" or a bare epoch in seconds, milliseconds or microseconds
+    """
+    try:
+        started = float(header.strip().removeprefix("t="))
+    except (AttributeError, ValueError):
+        return 0.0
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, time.time() - started)
+
+
+def shed_load():
+    """Rejects requests early when this worker is saturated"""
+    if request.endpoint in exempt_endpoints:
+        return
+    max_queue_ms = current_app.config["MAX_QUEUE_TIME_MS"]
+    if max_queue_ms > 0:
+        waited = queue_time(request.headers.get("X-Request-Start"))
+        if waited * 1000 > max_queue_ms:
+            raise ServiceUnavailable(
+                "Request queued too long", retry_after=current_app.config["SHED_RETRY_AFTER"]
+            )
+
+    count = in_flight.enter()
+    g.admitted = True
+    max_in_flight = current_app.config["MAX_IN_FLIGHT"]
+    if 0 < max_in_flight < count:
+        raise ServiceUnavailable(
+            "Service is overloaded", retry_after=current_app.config["SHED_RETRY_AFTER"]
+        )
+
+
+def release(_exc=None):
+    """Counts an admitted request out when it is torn down"""
+    if g.pop("admitted", False):
+        in_flight.leave()
+
+
+def init_admission(app):
+    """Registers the load shedding hooks on the application
+
+    Behind PROXY_FIX_HOPS trusted proxies the client address is taken
+    from X-Forwarded-For, so each client is limited on its own bucket
+    """
+    app.before_request(shed_load)
+    app.teardown_request(release)
+    hops = app.config.get("PROXY_FIX_HOPS", 0)
+    if hops > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
@@ -0,0 +1,439 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Caches
+
+This module contains the in process caches used on the read paths,
+the single flight that shares one database read among the identical
+requests that arrive at the same time, the cache that serves stale
+reads while they are refreshed, and the cache shared by the workers
+forked from the same master
+"""
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("flask.app")
+
+MISSING = object()
+
+# How fresh a value returned by StaleCache.get is
+FRESH = "fresh"
+STALE = "stale"
+FAILED = "failed"
+
+
+class TTLCache:
+    """A size bounded cache whose entries expire after a time to live"""
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """Returns the value for key, or default if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores value under key for the time to live"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Call:
+    """A call in flight and, once it is done, its result"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function once for all the threads that ask for the same key at once
+
+    The first caller of a key runs the function, the ones that come while
+    it is running wait for it and get the same result or exception. Nothing
+    is kept once the call returns, so unlike a cache a result is never
+    older than the call that was in flight when it was asked for. An error
+    that may be the leader's own, like running out of its time, can be
+    listed in retry_on so each caller then runs the function itself
+    """
+
+    def __init__(self):
+        self.joined = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, timeout=None, retry_on=()):
+        """Returns function(), shared with the callers of key that are in flight
+
+        A caller that joined a call which failed with one of the retry_on
+        errors runs function() on its own instead of raising it.
+        Raises TimeoutError when a call in flight does not return in time
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.joined += 1
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"Call for {key} still in flight")
+            if isinstance(call.error, retry_on):
+                return function()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def forget(self):
+        """Makes later callers start new calls instead of joining the ones in flight
+
+        Called after a write commits, so no reader that comes after it
+        gets a result that was read before it
+        """
+        with self._lock:
+            self._calls.clear()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class _Entry:  # pylint: disable=too-few-public-methods
+    """A cached value, when it was read and the generation it was read in"""
+
+    __slots__ = ("value", "stored", "generation")
+
+    def __init__(self, value, stored, generation):
+        self.value = value
+        self.stored = stored
+        self.generation = generation
+
+
+class StaleCache:
+    """A cache that keeps serving entries while they are read again
+
+    Entries younger than soft_ttl are fresh. Up to hard_ttl they are
+    still returned at once, as stale, while a background thread reads
+    them again. Older entries are read again by the caller, and when
+    that read raises one of errors the entry is returned anyway, as
+    failed, for up to stale_if_error seconds past hard_ttl. For soft_ttl
+    seconds after a failure such entries are returned without trying
+    the read, so requests do not queue on a database that is down.
+    expire()
+    makes every entry older than hard_ttl without dropping it, so a
+    write is read back at once unless the database is down
+    """
+
+    def __init__(self, soft_ttl=5, hard_ttl=60, stale_if_error=300, max_size=10000, errors=(Exception,)):
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.stale_if_error = stale_if_error
+        self.max_size = max_size
+        self.errors = errors
+        self.generation = 0
+        self.failed_until = 0.0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def get(self, key, load, refresh=None) -> tuple:
+        """Returns (value, age in seconds, FRESH, STALE or FAILED) of key
+
+        load() reads the value in the caller and refresh(), which
+        defaults to load, reads it in a background thread
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self.generation
+            if entry is not None:
+                self._entries.move_to_end(key)
+        now = time.monotonic()
+        if entry is not None and entry.generation == generation:
+            age = now - entry.stored
+            if age < self.soft_ttl:
+                return entry.value, age, FRESH
+            if age < self.hard_ttl:
+                self._refresh(key, refresh or load, generation)
+                return entry.value, age, STALE
+        usable = entry is not None and now - entry.stored < self.hard_ttl + self.stale_if_error
+        if usable and now < self.failed_until:
+            return entry.value, now - entry.stored, FAILED
+        try:
+            value = load()
+        except self.errors as error:
+            self.failed_until = time.monotonic() + self.soft_ttl
+            if not usable:
+                raise
+            logger.warning("Serving a stale %s: %s", key, error)
+            return entry.value, now - entry.stored, FAILED
+        self.failed_until = 0.0
+        self._store(key, value, generation)
+        return value, 0.0, FRESH
+
+    def _refresh(self, key, refresh, generation):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            # threads do not survive a fork, so each worker starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stale-cache")
+        self._executor.submit(self._run_refresh, key, refresh, generation)
+
+    def _run_refresh(self, key, refresh, generation):
+        try:
+            self._store(key, refresh(), generation)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Background refresh of %s failed: %s", key, error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value, generation):
+        """Stores value unless a write made the generation it was read in stale"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = _Entry(value, time.monotonic(), generation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def expire(self):
+        """Makes every entry read again before it is served, unless that fails"""
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache:
+    """A cache of bytes in shared memory, for every worker forked after it is opened
+
+    The memory is split into fixed size slots and a key always goes to
+    the same slot, so a newer key simply replaces an older one. Each slot
+    has a sequence number that is odd while it is being written, readers
+    take no lock and treat a slot that changed while they copied it as a
+    miss. A generation counter at the start of the memory is bumped by
+    invalidate(), which makes every entry stale at once in every worker
+    """
+
+    HEADER = struct.Struct("<Q")  # generation
+    SLOT = struct.Struct("<QQdHI")  # sequence, generation, expires, key size, value size
+    MAX_KEY_SIZE = 64
+
+    def __init__(self):
+        self.ttl = 0
+        self.slot_size = 0
+        self.slots = 0
+        self._memory = None
+        self._lock = None
+
+    def open(self, size: int, slot_size: int = 16384, ttl: float = 60):
+        """Maps size bytes of anonymous shared memory, call before forking"""
+        self.close()
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.slots = max(1, (size - self.HEADER.size) // slot_size)
+        self._memory = mmap.mmap(-1, self.HEADER.size + self.slots * slot_size)
+        self._lock = multiprocessing.Lock()
+
+    def close(self):
+        """Unmaps the memory, the cache is disabled until it is opened again"""
+        if self._memory is not None:
+            self._memory.close()
+            self._memory = None
+
+    @property
+    def enabled(self) -> bool:
+        """True when the cache has been opened"""
+        return self._memory is not None
+
+    @property
+    def generation(self) -> int:
+        """The current generation, read it before the data to be cached"""
+        if self._memory is None:
+            return 0
+        return self.HEADER.unpack_from(self._memory, 0)[0]
+
+    def _slot(self, key: bytes) -> int:
+        return self.HEADER.size + zlib.crc32(key) % self.slots * self.slot_size
+
+    def get(self, key: str):
+        """Returns the bytes stored under key, or None if missing, stale or expired"""
+        if self._memory is None:
+            return None
+        key = key.encode()
+        offset = self._slot(key)
+        memory = self._memory
+        sequence, generation, expires, key_size, value_size = self.SLOT.unpack_from(memory, offset)
+        if sequence % 2 or generation != self.generation or expires < time.monotonic():
+            return None
+        start = offset + self.SLOT.size
+        if memory[start:start + key_size] != key:
+            return None
+        start += self.MAX_KEY_SIZE
+        value = memory[start:start + value_size]
+        if self.SLOT.unpack_from(memory, offset)[0] != sequence:
+            return None  # rewritten while it was being copied
+        return value
+
+    def set(self, key: str, value: bytes, generation: int) -> bool:
+        """Stores value under key if nothing was invalidated since generation
+
+        Returns False when the key or value do not fit in a slot or the
+        value was read before the last invalidate()
+        """
+        key = key.encode()
+        if self._memory is None or len(key) > self.MAX_KEY_SIZE:
+            return False
+        if self.SLOT.size + self.MAX_KEY_SIZE + len(value) > self.slot_size:
+            return False
+        offset = self._slot(key)
+        memory = self._memory
+        with self._lock:
+            if generation != self.generation:
+                return False
+            sequence = self.SLOT.unpack_from(memory, offset)[0] + 1
+            struct.pack_into("<Q", memory, offset, sequence)
+            start = offset + self.SLOT.size
+            memory[start:start + len(key)] = key
+            start += self.MAX_KEY_SIZE
+            memory[start:start + len(value)] = value
+            self.SLOT.pack_into(
+                memory, offset, sequence + 1, generation, time.monotonic() + self.ttl, len(key), len(value)
+            )
+        return True
+
+    def invalidate(self):
+        """Makes every entry stale, in every worker sharing the memory"""
+        if self._memory is None:
+            return
+        with self._lock:
+            self.HEADER.pack_into(self._memory, 0, self.generation + 1)
+
+
+class NameMap:
+    """Maps the names of a small lookup table to their ids and back in memory
+
+    load() returns every (id, name) row. It is only called for a name or
+    id that is not in the map yet, and a name that is still missing after
+    it is not looked for again for miss_ttl seconds, so once warm every
+    lookup is a dictionary read or two. Rows are added by the caller, in
+    its own transaction, and passed to add() once committed
+    """
+
+    def __init__(self, load, max_names: int = 1000, miss_ttl: float = 5):
+        self.max_names = max_names
+        self._load = load
+        self._ids = {}
+        self._names = {}
+        self._misses = TTLCache(miss_ttl)
+        self._lock = threading.Lock()
+
+    def id_of(self, name: str):
+        """Returns the id of name, or None"""
+        row_id = self._ids.get(name)
+        if row_id is None and self._misses.get(name) is MISSING:
+            self.reload()
+            row_id = self._ids.get(name)
+            if row_id is None:
+                self._misses.set(name, True)
+        return row_id
+
+    def name_of(self, row_id: int):
+        """Returns the name of the row with row_id, or None"""
+        name = self._names.get(row_id)
+        if name is None:
+            self.reload()
+            name = self._names.get(row_id)
+        return name
+
+    def add(self, row_id: int, name: str):
+        """Maps a row that was committed since the last reload"""
+        with self._lock:
+            self._names = {**self._names, row_id: name}
+            self._ids = {**self._ids, name: row_id}
+
+    def reload(self):
+        """Reads every row again"""
+        with self._lock:
+            rows = self._load()
+            self._names = dict(rows)
+            self._ids = {name: row_id for row_id, name in rows}
+
+    def clear(self):
+        """Forgets every row, for when the table is created again"""
+        with self._lock:
+            self._names = {}
+            self._ids = {}
+        self._misses.clear()
+
+    def __len__(self):
+        return len(self._ids)
@@ -16,8 +16,14 @@
 """
 Flask CLI Command Extensions
 """
+import time
+import tracemalloc
+from datetime import timedelta
+import click
+from sqlalchemy import select, text
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.common import cooccurrence, jobs, partitioning, similarity
+from service.models import db, create_tables, create_search_indexes, Recommendation, Tombstone
 
 
 ######################################################################
@@ -32,5 +38,225 @@ def db_create():
     production. ;-)
     """
     db.drop_all()
-    db.create_all()
+    create_tables(app.config.get("PARTITION_COUNT", 0))
     db.session.commit()
+
+
+######################################################################
+# Command to remove duplicate recommendations
+# Usage:
+#   flask db-dedup --batch-size 1000
+######################################################################
+@app.cli.command("db-dedup")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows to delete per transaction")
+def db_dedup(batch_size):
+    """
+    Compacts recommendations that share a product, recommended product
+    and type, keeping the oldest, then adds the natural key unique index
+    """
+    removed = Recommendation.remove_duplicates(batch_size)
+    click.echo(f"Removed {removed} duplicate recommendations")
+    for index in Recommendation.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+######################################################################
+# Command to hash partition the recommendations on product_id
+# Usage:
+#   flask db-partition --partitions 16 --batch-size 10000
+######################################################################
+@app.cli.command("db-partition")
+@click.option("--partitions", default=16, show_default=True, help="Number of hash partitions")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows to copy per transaction")
+@click.option("--drop-old", is_flag=True, help="Drop the unpartitioned table afterwards")
+def db_partition(partitions, batch_size, drop_old):
+    """
+    Moves the recommendations into a table hash partitioned on
+    product_id. Pause writers first, updates made while the rows are
+    being copied are lost. PostgreSQL only.
+    """
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Partitioning needs PostgreSQL")
+    copied = partitioning.migrate(
+        db.engine, Recommendation.__table__, partitions, batch_size, echo=click.echo
+    )
+    click.echo(f"Copied {copied} recommendations into {partitions} partitions")
+    create_search_indexes()
+    if drop_old:
+        with db.engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS recommendation_unpartitioned"))
+
+
+######################################################################
+# Command to forget deletes the change feed no longer needs
+# Usage:
+#   flask db-purge-tombstones --days 30
+######################################################################
+@app.cli.command("db-purge-tombstones")
+@click.option("--days", type=int, help="Keep tombstones this many days [default: TOMBSTONE_RETENTION_DAYS]")
+def db_purge_tombstones(days):
+    """
+    Deletes the tombstones of old deletes. Change feed consumers that are
+    further behind than this miss those deletes and must read everything
+    """
+    if days is None:
+        days = app.config["TOMBSTONE_RETENTION_DAYS"]
+    count = Tombstone.purge(timedelta(days=days))
+    click.echo(f"Purged {count} tombstones older than {days} days")
+
+
+def parallel_options(command):
+    """Adds the options of commands that run through the job runner"""
+    command = click.option("--restart", is_flag=True, help="Ignore the checkpoints of an interrupted run")(command)
+    command = click.option("--shards", type=int, help="Slices of the product ids [default: 4 per worker]")(command)
+    return click.option("--workers", default=1, show_default=True, help="Processes to run the shards in")(command)
+
+
+######################################################################
+# Command to generate cross-sell recommendations from an order log
+# Usage:
+#   flask recommend-cooccurrence orders.csv --metric lift --top-n 10
+######################################################################
+@app.cli.command("recommend-cooccurrence")
+@click.argument("orders", type=click.File("r"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), help="Log format [default: from the file name]")
+@click.option("--metric", type=click.Choice(cooccurrence.METRICS), default="lift", show_default=True)
+@click.option("--top-n", default=10, show_default=True, help="Recommendations to keep per product")
+@click.option("--min-count", default=2, show_default=True, help="Orders a pair needs to be scored")
+@click.option("--max-basket-size", default=50, show_default=True, help="Larger orders are skipped")
+@click.option("--chunk-size", default=100000, show_default=True, help="Order events to read at a time")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows to write per transaction")
+@parallel_options
+def recommend_cooccurrence(orders, fmt, metric, top_n, min_count, max_basket_size, chunk_size, batch_size, **parallel):
+    """
+    Scores products bought in the same orders and writes the best of
+    each product as cross-sell recommendations. ORDERS is a CSV or NDJSON
+    log of order_id and product_id, or - for standard input
+    """
+    fmt = fmt or ("csv" if orders.name.endswith(".csv") else "ndjson")
+    matrix = cooccurrence.CooccurrenceMatrix(max_basket_size, chunk_size)
+    try:
+        for basket in cooccurrence.read_baskets(cooccurrence.read_events(orders, fmt), chunk_size):
+            matrix.add(basket)
+        matrix.flush()
+    except ValueError as error:
+        raise click.ClickException(str(error)) from error
+    click.echo(
+        f"Counted {matrix.orders} orders, {matrix.product_ids.size} products and {matrix.pair_codes.size} pairs, "
+        f"skipped {matrix.skipped} large orders"
+    )
+    # ranked once here, so forked workers share it
+    matrix.rank(top_n, metric, min_count)
+
+    def task(shard, shards):
+        top = list(matrix.top(top_n, metric, min_count, (shard, shards)))
+        written, removed = Recommendation.replace_generated(
+            "cross-sell", top, "Frequently bought together", batch_size
+        )
+        return len(top), written, removed
+
+    run_job("recommend-cooccurrence", task, **parallel)
+
+
+######################################################################
+# Command to generate similar recommendations from feature vectors
+# Usage:
+#   flask recommend-similar vectors.npy --top-k 10
+######################################################################
+@app.cli.command("recommend-similar")
+@click.argument("vectors", type=click.Path(exists=True, dir_okay=False))
+@click.option("--top-k", default=10, show_default=True, help="Neighbours to keep per product")
+@click.option("--min-score", default=0.0, show_default=True, help="Lowest cosine similarity to keep")
+@click.option("--block-size", default=256, show_default=True, help="Products to compare at a time")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows to write per transaction")
+@parallel_options
+def recommend_similar(vectors, top_k, min_score, block_size, batch_size, **parallel):
+    """
+    Writes the products with the most similar feature vectors as similar
+    recommendations. VECTORS is a .npy array or a CSV file whose rows
+    hold a product_id followed by its features
+    """
+    try:
+        if vectors.endswith(".npy"):
+            ids, features = similarity.read_npy(vectors)
+        else:
+            with open(vectors, encoding="utf-8", newline="") as stream:
+                ids, features = similarity.read_csv(stream)
+    except ValueError as error:
+        raise click.ClickException(str(error)) from error
+
+    def task(shard, shards):
+        neighbours = similarity.top_similar(ids, features, top_k, min_score, block_size, (shard, shards))
+        written, removed = Recommendation.replace_generated("similar", neighbours, "Similar product", batch_size)
+        return sum(1 for product_id in ids if jobs.in_shard(product_id, shard, shards)), written, removed
+
+    run_job("recommend-similar", task, **parallel)
+
+
+######################################################################
+# Command to compare the ORM and Core row read paths
+# Usage:
+#   flask bench-reads --rows 10000 --repeat 5
+######################################################################
+@app.cli.command("bench-reads")
+@click.option("--rows", default=10000, show_default=True, help="Recommendations to read")
+@click.option("--repeat", default=5, show_default=True, help="Reads to time, the fastest is reported")
+def bench_reads(rows, repeat):
+    """
+    Reads and serializes the same recommendations as ORM instances and as
+    Core rows, and reports the throughput and peak memory of each. The
+    rows are inserted in a transaction that is rolled back afterwards
+    """
+    paths = {
+        "orm": lambda: [row.serialize() for row in db.session.execute(select(Recommendation)).scalars()],
+        "core": lambda: [row.serialize() for row in Recommendation.read_rows(Recommendation.select_rows())],
+    }
+    try:
+        Recommendation.create_types(["bench"])
+        db.session.execute(
+            Recommendation.__table__.insert(),
+            [
+                {"name": "Benchmark", "product_id": i // 10, "recommended_product_id": i, "recommendation_type": "bench"}
+                for i in range(rows)
+            ],
+        )
+        total = len(paths["core"]())
+        click.echo(f"Reading {total} recommendations")
+        for name, read in paths.items():
+            seconds, peak = measure_read(read, repeat, reset=db.session.expunge_all)
+            click.echo(f"{name:>5}: {total / seconds:12,.0f} rows/s {peak / 2**20:8.1f} MiB peak")
+    finally:
+        db.session.rollback()
+
+
+def measure_read(read, repeat, reset):
+    """Returns the fastest of repeat calls of read in seconds and the peak
+    bytes allocated by one more call, calling reset after each
+    """
+    fastest = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        read()
+        fastest = min(fastest, time.perf_counter() - started)
+        reset()
+    tracemalloc.start()
+    try:
+        read()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        reset()
+    return fastest, peak
+
+
+def run_job(job, task, workers, shards, restart):
+    """Runs task through the job runner and reports the totals"""
+    shards = shards or workers * 4
+    try:
+        throughput = jobs.run(job, task, shards, workers, echo=click.echo, restart=restart)
+    except ValueError as error:
+        raise click.ClickException(str(error)) from error
+    products, written, removed = (
+        sum(totals[key] for totals in throughput.values()) for key in ("products", "written", "removed")
+    )
+    click.echo(f"Wrote {written} recommendations for {products} products, removed {removed}")
@@ -0,0 +1,203 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Co-occurrence Engine
+
+This module turns an order log into "frequently bought together" scores.
+Orders are read in chunks and counted into a sparse item-item matrix
+that only holds the pairs that were actually bought together. Pairs are
+kept as sorted int64 codes with their counts in NumPy arrays, so counting
+and scoring them are array operations rather than a loop per pair.
+"""
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+import numpy as np
+
+METRICS = ("lift", "pmi")
+ID_RANGE = (-(2**31), 2**31 - 1)
+LOW_BITS = 0xFFFFFFFF
+SIGN_BIT = 0x80000000
+
+
+def read_events(stream, fmt="csv"):
+    """Yields (order_id, product_id) from a CSV with a header or from NDJSON"""
+    if fmt == "csv":
+        rows = csv.DictReader(stream)
+    else:
+        rows = (json.loads(line) for line in stream if line.strip())
+    for row in rows:
+        try:
+            yield str(row["order_id"]), int(row["product_id"])
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"Invalid order event: {row}") from error
+
+
+def read_baskets(events, chunk_size=100000):
+    """Yields the set of products of every order, a chunk of events at a time
+
+    An order is complete once a whole chunk goes by without it, so the
+    log only has to be roughly ordered by order, like most exports are
+    """
+    events = iter(events)
+    open_orders = {}
+    while True:
+        chunk = list(islice(events, chunk_size))
+        seen = set()
+        for order_id, product_id in chunk:
+            open_orders.setdefault(order_id, set()).add(product_id)
+            seen.add(order_id)
+        for order_id in [order_id for order_id in open_orders if order_id not in seen or not chunk]:
+            yield open_orders.pop(order_id)
+        if not chunk:
+            return
+
+
+def encode_pairs(first, second):
+    """Returns one int64 code per pair of 32 bit product ids
+
+    Codes sort like the pairs when every first id is at most its second
+    """
+    return (first << 32) | (second & LOW_BITS)
+
+
+def decode_pairs(codes):
+    """Returns the first and second product ids of pair codes"""
+    return codes >> 32, ((codes & LOW_BITS) ^ SIGN_BIT) - SIGN_BIT
+
+
+def merge_counts(keys, counts, new_keys):
+    """Returns the sorted unique keys and counts of keys with new_keys added"""
+    new_keys, new_counts = np.unique(new_keys, return_counts=True)
+    keys, inverse = np.unique(np.concatenate((keys, new_keys)), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate((counts, new_counts)), minlength=keys.size)
+    return keys, counts.astype(np.int64)
+
+
+class CooccurrenceMatrix:
+    """Sparse counts of orders per product and per pair of products
+
+    Baskets are buffered and counted chunk_size at a time: baskets of the
+    same size are stacked into one array whose pairs of columns are the
+    pairs of every basket, which np.unique counts and merge_counts folds
+    into the counts of the earlier chunks
+    """
+
+    def __init__(self, max_basket_size=50, chunk_size=100000):
+        self.max_basket_size = max_basket_size
+        self.chunk_size = chunk_size
+        self.orders = 0
+        self.skipped = 0
+        self.product_ids = np.empty(0, dtype=np.int64)
+        self.product_counts = np.empty(0, dtype=np.int64)
+        self.pair_codes = np.empty(0, dtype=np.int64)
+        self.pair_counts = np.empty(0, dtype=np.int64)
+        self._baskets = defaultdict(list)
+        self._buffered = 0
+        self._ranking = None
+
+    def add(self, basket):
+        """Counts one order, orders larger than max_basket_size are skipped"""
+        if len(basket) > self.max_basket_size:
+            self.skipped += 1
+            return
+        self.orders += 1
+        self._baskets[len(basket)].append(sorted(basket))
+        self._buffered += 1
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Counts the buffered baskets into the product and pair counts
+
+        Raises ValueError for product ids that do not fit in 32 bits
+        """
+        if not self._buffered:
+            return
+        products, pairs = [self.product_ids[:0]], [self.pair_codes[:0]]
+        for size, baskets in self._baskets.items():
+            rows = np.array(baskets, dtype=np.int64).reshape(len(baskets), size)
+            if rows.size and (rows.min() < ID_RANGE[0] or rows.max() > ID_RANGE[1]):
+                raise ValueError(f"Product ids must be 32 bit integers, got {rows.min()} to {rows.max()}")
+            products.append(rows.ravel())
+            first, second = np.triu_indices(size, 1)
+            pairs.append(encode_pairs(rows[:, first], rows[:, second]).ravel())
+        self._baskets.clear()
+        self._buffered = 0
+        self._ranking = None
+        self.product_ids, self.product_counts = merge_counts(
+            self.product_ids, self.product_counts, np.concatenate(products)
+        )
+        self.pair_codes, self.pair_counts = merge_counts(self.pair_codes, self.pair_counts, np.concatenate(pairs))
+
+    def pairs(self):
+        """Returns the first and second product ids of every pair, first < second, and its count"""
+        self.flush()
+        first, second = decode_pairs(self.pair_codes)
+        return first, second, self.pair_counts
+
+    def scores(self, metric="lift", min_count=2):
+        """Returns arrays of product_id, other_product_id and score, both ways for every pair
+
+        lift is P(a and b) / (P(a) P(b)), pmi is its base 2 logarithm.
+        Pairs bought together fewer than min_count times are left out
+        """
+        first, second, counts = self.pairs()
+        kept = counts >= min_count
+        first, second, counts = first[kept], second[kept], counts[kept]
+        items = self.product_counts
+        lift = counts * float(self.orders) / (
+            items[np.searchsorted(self.product_ids, first)] * items[np.searchsorted(self.product_ids, second)]
+        )
+        score = lift if metric == "lift" else np.log2(lift)
+        return np.concatenate((first, second)), np.concatenate((second, first)), np.concatenate((score, score))
+
+    def rank(self, top_n=10, metric="lift", min_count=2):
+        """Returns arrays of product_id, other_product_id and score holding the
+        top_n scored other products of every product, by product and best first
+
+        The ranking is kept until more baskets are counted, so it is scored
+        once before the shards of a job are forked rather than once per shard
+        """
+        self.flush()
+        key = (top_n, metric, min_count)
+        if self._ranking is None or self._ranking[0] != key:
+            products, others, scores = self.scores(metric, min_count)
+            order = np.lexsort((others, -scores, products))
+            products, others, scores = products[order], others[order], scores[order]
+            # position of every row within the rows of its product
+            place = np.arange(products.size) - np.searchsorted(products, products)
+            kept = place < top_n
+            self._ranking = key, (products[kept], others[kept], scores[kept])
+        return self._ranking[1]
+
+    def top(self, top_n=10, metric="lift", min_count=2, shard=(0, 1)):
+        """Yields (product_id, [(other_product_id, score), ...]) for every product
+
+        Products bought with nothing that scored get an empty list, so their
+        older recommendations are removed. Only products whose id modulo
+        shard[1] is shard[0] are included
+        """
+        products, others, scores = self.rank(top_n, metric, min_count)
+        in_shard = products % shard[1] == shard[0]
+        products, others, scores = products[in_shard], others[in_shard], scores[in_shard]
+        ids = self.product_ids[self.product_ids % shard[1] == shard[0]]
+        starts = np.searchsorted(products, ids)
+        ends = np.searchsorted(products, ids, side="right")
+        for product_id, start, end in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            yield product_id, list(zip(others[start:end].tolist(), scores[start:end].tolist()))
@@ -0,0 +1,53 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Pagination Cursors
+
+Opaque cursors that carry the sort key of the last row a client saw,
+so the next page starts right after it without an OFFSET
+"""
+import json
+import base64
+import binascii
+from datetime import datetime
+
+
+def encode(*values) -> str:
+    """Returns a cursor holding values, datetimes are kept as ISO 8601"""
+    data = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode()
+
+
+def decode(cursor: str, *types) -> tuple:
+    """Returns the values of a cursor converted to types
+
+    Raises ValueError when the cursor was not made by encode with
+    values of those types
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, json.JSONDecodeError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+    if not isinstance(data, list) or len(data) != len(types):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    try:
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, data)
+        )
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
@@ -0,0 +1,106 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Deadlines
+
+This module gives every request a deadline and hands whatever is left
+of it to PostgreSQL as the statement_timeout of the request's transaction.
+Work done in the background can be given a deadline with time_limit
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.models import db, DeadlineExceededError
+
+DEADLINE_HEADER = "X-Request-Timeout"
+QUERY_CANCELED = "57014"
+
+# The deadline of the work done outside of a request, if it has one
+background_deadline = ContextVar("background_deadline", default=None)
+
+
+def start_deadline():
+    """Sets the deadline for the current request
+
+    Clients may ask for a shorter or longer timeout in milliseconds with
+    the X-Request-Timeout header, up to MAX_REQUEST_TIMEOUT_MS
+    """
+    g.pop("deadline", None)
+    timeout_ms = current_app.config["REQUEST_TIMEOUT_MS"]
+    try:
+        requested = int(request.headers.get(DEADLINE_HEADER, timeout_ms))
+    except ValueError:
+        requested = timeout_ms
+    if requested > 0:
+        timeout_ms = requested
+    timeout_ms = min(timeout_ms, current_app.config["MAX_REQUEST_TIMEOUT_MS"])
+    if timeout_ms > 0:
+        g.deadline = time.monotonic() + timeout_ms / 1000
+
+
+@contextmanager
+def time_limit(timeout_ms: int):
+    """Gives the work done in the block outside of a request a deadline
+    timeout_ms from now
+    """
+    token = background_deadline.set(time.monotonic() + timeout_ms / 1000)
+    try:
+        yield
+    finally:
+        background_deadline.reset(token)
+
+
+def remaining_ms():
+    """Returns the milliseconds left before the deadline, or None without one"""
+    if has_request_context():
+        deadline = g.get("deadline")
+    else:
+        deadline = background_deadline.get()
+    if deadline is None:
+        return None
+    return int((deadline - time.monotonic()) * 1000)
+
+
+def apply_statement_timeout(_session, _transaction, connection):
+    """Limits the transaction that was just begun to the time remaining"""
+    remaining = remaining_ms()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise DeadlineExceededError("Request deadline exceeded")
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {remaining}")
+
+
+def translate_timeout(context):
+    """Turns a statement cancelled by statement_timeout into a deadline error"""
+    error = context.original_exception
+    sqlstate = getattr(error, "sqlstate", None) or getattr(error, "pgcode", None)
+    if sqlstate == QUERY_CANCELED:
+        return DeadlineExceededError("Request deadline exceeded")
+    return None
+
+
+def init_deadlines(app):
+    """Registers the deadline hooks on the application and database"""
+    app.before_request(start_deadline)
+    if not event.contains(db.session, "after_begin", apply_statement_timeout):
+        event.listen(db.session, "after_begin", apply_statement_timeout)
+        event.listen(Engine, "handle_error", translate_timeout)
@@ -18,7 +18,7 @@ Module: error_handlers
 """
 from flask import jsonify
 from flask import current_app as app  # Import Flask application
-from service.models import DataValidationError
+from service.models import DataValidationError, DeadlineExceededError
 from . import status
 
 
@@ -31,6 +31,21 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(DeadlineExceededError)
+def deadline_exceeded(error):
+    """Handles requests that ran out of time with 504_GATEWAY_TIMEOUT"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_504_GATEWAY_TIMEOUT,
+            error="Gateway Timeout",
+            message=message,
+        ),
+        status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -85,6 +100,38 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """Handles rate limited requests with 429_TOO_MANY_REQUESTS"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles shed requests with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
@@ -0,0 +1,107 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Health Checks
+
+This module keeps track of start up warm-up tasks and caches the result
+of the database ping so that Kubernetes probes cost almost nothing
+"""
+import logging
+import threading
+import time
+from sqlalchemy import text
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+
+class WarmUp:
+    """Tracks the warm-up tasks that must finish before taking traffic"""
+
+    def __init__(self):
+        self._pending = set()
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def begin(self, name: str):
+        """Registers a warm-up task that has not finished yet"""
+        with self._lock:
+            self._done.discard(name)
+            self._pending.add(name)
+
+    def finish(self, name: str):
+        """Marks a warm-up task as finished"""
+        with self._lock:
+            self._pending.discard(name)
+            self._done.add(name)
+        logger.info("Warm-up of %s finished", name)
+
+    @property
+    def complete(self) -> bool:
+        """True once every registered task has finished"""
+        return not self._pending
+
+    def status(self) -> dict:
+        """Returns the state of every warm-up task"""
+        with self._lock:
+            state = {name: "pending" for name in self._pending}
+            state.update({name: "done" for name in self._done})
+        return state
+
+    def reset(self):
+        """Forgets all of the warm-up tasks"""
+        with self._lock:
+            self._pending.clear()
+            self._done.clear()
+
+
+class DatabaseProbe:
+    """Pings the database at most once per time to live"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.healthy = False
+        self.checked = None
+        self._lock = threading.Lock()
+
+    def ping(self) -> bool:
+        """Returns the cached result of SELECT 1, refreshing it when stale"""
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.ttl:
+            return self.healthy
+        # only one thread pays for the ping, the others use the last result
+        if not self._lock.acquire(blocking=False):
+            return self.healthy
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            self.healthy = True
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Database health check failed: %s", error)
+            self.healthy = False
+        finally:
+            self.checked = time.monotonic()
+            self._lock.release()
+        return self.healthy
+
+    def reset(self):
+        """Forces the next ping to go to the database"""
+        self.checked = None
+
+
+warm_up = WarmUp()
+database = DatabaseProbe(ttl=5)
@@ -0,0 +1,180 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Hot Key Detection
+
+This module finds the keys that dominate the read traffic in constant
+memory. A count-min sketch estimates how often every key was looked up
+and a small heap keeps the heaviest hitters seen so far.
+"""
+import heapq
+import logging
+import os
+import random
+import threading
+from array import array
+
+logger = logging.getLogger("flask.app")
+
+PRIME = 2**61 - 1
+
+
+class CountMinSketch:
+    """Estimated counts of keys in depth rows of width counters
+
+    An estimate is never below the true count and, with N lookups in
+    total, is above it by at most 2N / width with a probability of at
+    least 1 - 1 / 2**depth
+    """
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.counters = array("Q", bytes(8 * width * depth))
+        # one universal hash (a * x + b) mod p per row
+        self.seeds = [(random.randrange(1, PRIME), random.randrange(PRIME)) for _ in range(depth)]
+
+    def _cells(self, key):
+        value = hash(key) % PRIME
+        return [
+            row * self.width + (a * value + b) % PRIME % self.width
+            for row, (a, b) in enumerate(self.seeds)
+        ]
+
+    def add(self, key, count: int = 1) -> int:
+        """Counts key and returns its new estimate"""
+        cells = self._cells(key)
+        for cell in cells:
+            self.counters[cell] += count
+        return min(self.counters[cell] for cell in cells)
+
+    def estimate(self, key) -> int:
+        """Returns the estimated count of key"""
+        return min(self.counters[cell] for cell in self._cells(key))
+
+    def halve(self):
+        """Halves every counter so old traffic fades away"""
+        for cell, count in enumerate(self.counters):
+            self.counters[cell] = count >> 1
+
+    def clear(self):
+        """Sets every counter to zero"""
+        self.counters = array("Q", bytes(8 * self.width * self.depth))
+
+
+class HotKeys:
+    """The top_k most looked up keys, from a count-min sketch
+
+    The heap may hold outdated counts of a key, they are dropped when
+    they reach its top and the heap is rebuilt before it grows past
+    four times top_k
+    """
+
+    def __init__(self, top_k: int = 100, width: int = 2048, depth: int = 4):
+        self.top_k = top_k
+        self.sketch = CountMinSketch(width, depth)
+        self.lookups = 0
+        self._counts = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        """Counts one lookup of key"""
+        with self._lock:
+            self.lookups += 1
+            count = self.sketch.add(key)
+            if key not in self._counts and len(self._counts) >= self.top_k:
+                if count <= self._floor():
+                    return
+                del self._counts[heapq.heappop(self._heap)[1]]
+            self._counts[key] = count
+            heapq.heappush(self._heap, (count, key))
+            if len(self._heap) > 4 * self.top_k:
+                self._rebuild()
+
+    def _floor(self) -> int:
+        """Returns the smallest current count on the heap"""
+        while self._counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def _rebuild(self):
+        self._heap = [(count, key) for key, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def top(self, limit: int = None) -> list:
+        """Returns up to limit (key, estimated count) pairs, hottest first"""
+        with self._lock:
+            hottest = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return hottest[:limit]
+
+    def decay(self):
+        """Halves every count so the keys follow the recent traffic"""
+        with self._lock:
+            self.sketch.halve()
+            self.lookups >>= 1
+            self._counts = {key: count >> 1 for key, count in self._counts.items() if count > 1}
+            self._rebuild()
+
+    def clear(self):
+        """Forgets every lookup"""
+        with self._lock:
+            self.sketch.clear()
+            self.lookups = 0
+            self._counts.clear()
+            self._heap.clear()
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class Refresher:
+    """Calls a function every interval seconds from a daemon thread
+
+    The thread is started by the first call to ensure_started in each
+    process, since threads do not survive the fork of a gunicorn worker
+    """
+
+    def __init__(self, interval: float, function):
+        self.interval = interval
+        self.function = function
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Starts the thread of this process unless it is running"""
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            threading.Thread(target=self._run, args=(self._stop,), name="hot-keys", daemon=True).start()
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.function()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Hot key refresh failed: %s", error)
+
+    def stop(self):
+        """Stops the thread of this process"""
+        self._stop.set()
+        self._pid = None
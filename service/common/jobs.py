@@ -0,0 +1,123 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Batch Job Runner
+
+Runs a recompute one shard of the product_id space at a time across a
+pool of forked worker processes. Every finished shard is checkpointed
+in the database, so a run that was interrupted skips them next time.
+"""
+import os
+import time
+import logging
+import multiprocessing
+from flask import current_app
+from service.models import db, JobCheckpoint
+
+logger = logging.getLogger("flask.app")
+
+# The task and shard count of this worker process, set when it starts
+worker = {}
+
+
+def in_shard(product_id: int, shard: int, shards: int) -> bool:
+    """Returns True if product_id belongs to shard"""
+    return product_id % shards == shard
+
+
+def _start_worker(app, task, shards):
+    """Runs in each forked worker before its first shard
+
+    The pooled connections inherited from the parent are dropped without
+    closing them, so each worker opens its own
+    """
+    worker.update(task=task, shards=shards)
+    app.app_context().push()
+    db.engine.dispose(close=False)
+
+
+def _run_shard(shard: int) -> dict:
+    """Runs the task on one shard and reports what it did"""
+    started = time.monotonic()
+    products, written, removed = worker["task"](shard, worker["shards"])
+    return {
+        "shard": shard,
+        "worker": os.getpid(),
+        "products": products,
+        "written": written,
+        "removed": removed,
+        "seconds": time.monotonic() - started,
+    }
+
+
+def _throughput(results) -> dict:
+    """Returns the totals and rows per second of every worker"""
+    workers = {}
+    for result in results:
+        totals = workers.setdefault(
+            result["worker"], {"shards": 0, "products": 0, "written": 0, "removed": 0, "seconds": 0.0}
+        )
+        totals["shards"] += 1
+        for key in ("products", "written", "removed", "seconds"):
+            totals[key] += result[key]
+    for totals in workers.values():
+        totals["rows_per_second"] = totals["written"] / totals["seconds"] if totals["seconds"] else 0.0
+    return workers
+
+
+def run(job: str, task, shards: int, workers: int = 1, echo=logger.info, restart: bool = False) -> dict:
+    """Runs task(shard, shards) on every shard that is not done yet
+
+    task returns the number of products, rows written and rows removed.
+    With more than one worker the shards run in forked processes, which
+    share what the parent loaded for the task without copying it.
+    Returns the throughput of every worker
+    """
+    if restart:
+        JobCheckpoint.clear(job)
+    done = JobCheckpoint.finished(job, shards)
+    pending = [shard for shard in range(shards) if shard not in done]
+    echo(f"{job}: {len(done)} of {shards} shards already done, running {len(pending)}")
+    results = []
+
+    def record(result):
+        JobCheckpoint.record(job, shards, result)
+        results.append(result)
+        echo(
+            f"{job}: shard {result['shard']} done by worker {result['worker']}, "
+            f"{result['products']} products and {result['written']} rows in {result['seconds']:.1f}s"
+        )
+
+    if workers > 1 and len(pending) > 1:
+        app = current_app._get_current_object()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(workers, len(pending)), _start_worker, (app, task, shards)) as pool:
+            for result in pool.imap_unordered(_run_shard, pending):
+                record(result)
+    else:
+        worker.update(task=task, shards=shards)
+        for shard in pending:
+            record(_run_shard(shard))
+
+    throughput = _throughput(results)
+    for pid, totals in sorted(throughput.items()):
+        echo(
+            f"{job}: worker {pid} ran {totals['shards']} shards, {totals['products']} products, "
+            f"{totals['written']} rows at {totals['rows_per_second']:.0f} rows/s"
+        )
+    JobCheckpoint.clear(job)
+    return throughput
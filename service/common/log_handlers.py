@@ -20,7 +20,145 @@ Log Handlers
 This module contains utility functions to set up logging
 consistently
 """
+import atexit
+import json
 import logging
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from flask import g, has_request_context, request
+from service.common.admission import TokenBucket
+
+# The listener that writes queued records, when LOG_QUEUE is turned on
+listener = None  # pylint: disable=invalid-name
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every N records below WARNING for each sampled logger
+
+    Rates are the fraction of records to keep, by logger name. Records at
+    WARNING or above are never dropped
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) for name, rate in rates.items() if 0 < rate < 1}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        every = self.every.get(record.name)
+        if every is None or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        return count % every == 0
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits how often the same message below WARNING can be logged"""
+
+    def __init__(self, per_second: float, burst: int = 10, max_keys: int = 1000):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.clear()
+            bucket = self.buckets.setdefault(key, TokenBucket(self.per_second, self.burst))
+        return bucket.consume() == 0
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the request id and the latency so far to every record"""
+
+    def filter(self, record):
+        if has_request_context() and "request_id" in g:
+            record.request_id = g.request_id
+            record.latency_ms = round((time.monotonic() - g.request_started) * 1000, 3)
+        else:
+            record.request_id = None
+            record.latency_ms = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "latency_ms": getattr(record, "latency_ms", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def start_request():
+    """Stamps the request with an id and a start time for the log records"""
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.request_started = time.monotonic()
+
+
+def tag_response(response):
+    """Echoes the request id back to the client"""
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+def start_listener(handlers):
+    """Moves the writing of records to a background thread
+
+    Returns the QueueHandler that the loggers should use instead
+    """
+    global listener
+    stop_listener()
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return QueueHandler(queue)
+
+
+def stop_listener():
+    """Flushes the queue and stops the listener thread"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def restart_listener():
+    """Starts a new listener thread on the same queue
+
+    Threads do not survive a fork, so each worker forked from a
+    preloaded app calls this to drain the queue it inherited
+    """
+    global listener
+    if listener is not None:
+        listener = QueueListener(listener.queue, *listener.handlers, respect_handler_level=True)
+        listener.start()
+
+
+atexit.register(stop_listener)
 
 
 def init_logging(app, logger_name: str):
@@ -30,7 +168,25 @@ def init_logging(app, logger_name: str):
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter(datefmt="%Y-%m-%d %H:%M:%S %z")
+    else:
+        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
+
+    # Filters run on the request thread so dropped records cost next to nothing
+    filters = [RequestContextFilter()]
+    if app.config.get("LOG_SAMPLE_RATES"):
+        filters.append(SamplingFilter(app.config["LOG_SAMPLE_RATES"]))
+    if app.config.get("LOG_RATE_LIMIT"):
+        filters.append(RateLimitFilter(app.config["LOG_RATE_LIMIT"]))
+    if app.config.get("LOG_QUEUE") and app.logger.handlers:
+        app.logger.handlers = [start_listener(app.logger.handlers)]
+    for handler in app.logger.handlers:
+        for log_filter in filters:
+            handler.addFilter(log_filter)
+
+    app.before_request(start_request)
+    app.after_request(tag_response)
     app.logger.info("Logging handler established")
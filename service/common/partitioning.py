@@ -0,0 +1,145 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Table Partitioning
+
+This module creates PostgreSQL tables that are hash partitioned on
+product_id and migrates an existing table into one, a batch at a time
+"""
+import logging
+from sqlalchemy import MetaData, PrimaryKeyConstraint, text
+
+logger = logging.getLogger("flask.app")
+
+PARTITION_KEY = "product_id"
+
+
+def partitioned_table(table, name: str, index_suffix: str = ""):
+    """Returns a copy of table that is hash partitioned on product_id
+
+    PostgreSQL requires the partition key in every unique index, so the
+    primary key becomes (id, product_id)
+    """
+    metadata = MetaData()
+    for foreign_key in table.foreign_keys:  # so the copy can resolve them
+        foreign_key.column.table.to_metadata(metadata)
+    copy = table.to_metadata(metadata, name=name)
+    copy.c[PARTITION_KEY].primary_key = True
+    copy.append_constraint(PrimaryKeyConstraint("id", PARTITION_KEY))
+    copy.c.id.autoincrement = True
+    copy.dialect_kwargs["postgresql_partition_by"] = f"HASH ({PARTITION_KEY})"
+    for index in copy.indexes:
+        index.name = f"{index.name}{index_suffix}"
+    return copy
+
+
+def create_partitioned(connection, table, name: str, partitions: int, index_suffix: str = ""):
+    """Creates a partitioned copy of table and its partitions"""
+    logger.info("Creating %s with %d hash partitions", name, partitions)
+    partitioned_table(table, name, index_suffix).create(connection)
+    for remainder in range(partitions):
+        connection.execute(
+            text(
+                f"CREATE TABLE {name}_p{remainder} PARTITION OF {name} "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            )
+        )
+
+
+def is_partitioned(connection, name: str) -> bool:
+    """Returns True if the table is a partitioned table"""
+    return connection.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :name)"
+        ),
+        {"name": name},
+    ).scalar()
+
+
+def table_exists(connection, name: str) -> bool:
+    """Returns True if the table exists in the current schema"""
+    return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+def _copy_batch(connection, source: str, target: str, columns: str, after: int, limit=None):
+    """Copies the rows of source with ids above after, returns (last id, count)"""
+    limit_clause = f"ORDER BY id LIMIT {int(limit)}" if limit else ""
+    row = connection.execute(
+        text(
+            f"WITH moved AS (INSERT INTO {target} ({columns}) "
+            f"SELECT {columns} FROM {source} WHERE id > :after {limit_clause} RETURNING id) "
+            "SELECT max(id), count(*) FROM moved"
+        ),
+        {"after": after},
+    ).one()
+    return (row[0] or after), row[1]
+
+
+def migrate(engine, table, partitions: int, batch_size: int = 10000, echo=logger.info) -> int:
+    """Moves table into a hash partitioned table with the same name
+
+    Rows are copied in id order, one committed batch at a time, so an
+    interrupted run picks up where it stopped. The final step locks the
+    old table, copies rows inserted since, and swaps the tables. Updates
+    and deletes of rows that were already copied are not carried over,
+    so writers should be paused while this runs.
+    Returns the number of rows copied
+    """
+    name = table.name
+    target = f"{name}_partitioned"
+    retired = f"{name}_unpartitioned"
+    columns = ", ".join(column.name for column in table.columns)
+    with engine.begin() as connection:
+        if is_partitioned(connection, name):
+            echo(f"{name} is already partitioned")
+            return 0
+        if not table_exists(connection, target):
+            create_partitioned(connection, table, target, partitions, index_suffix="_new")
+        last = connection.execute(text(f"SELECT coalesce(max(id), 0) FROM {target}")).scalar()
+
+    copied = 0
+    while True:
+        with engine.begin() as connection:
+            last, count = _copy_batch(connection, name, target, columns, last, batch_size)
+        copied += count
+        echo(f"Copied {copied} rows up to id {last}")
+        if count < batch_size:
+            break
+
+    with engine.begin() as connection:
+        connection.execute(text(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+        last, count = _copy_batch(connection, name, target, columns, last)
+        copied += count
+        connection.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{target}', 'id'), "
+                f"greatest((SELECT last_value FROM {name}_id_seq), {int(last)}))"
+            )
+        )
+        connection.execute(text(f"ALTER TABLE {name} RENAME TO {retired}"))
+        connection.execute(text(f"ALTER INDEX {name}_pkey RENAME TO {retired}_pkey"))
+        for index in table.indexes:
+            connection.execute(text(f"ALTER INDEX {index.name} RENAME TO {index.name}_unpartitioned"))
+            connection.execute(text(f"ALTER INDEX {index.name}_new RENAME TO {index.name}"))
+        connection.execute(text(f"ALTER INDEX IF EXISTS ix_{name}_name_trgm RENAME TO ix_{name}_name_trgm_unpartitioned"))
+        connection.execute(text(f"ALTER TABLE {target} RENAME TO {name}"))
+        connection.execute(text(f"ALTER INDEX {target}_pkey RENAME TO {name}_pkey"))
+        for remainder in range(partitions):
+            connection.execute(text(f"ALTER TABLE IF EXISTS {target}_p{remainder} RENAME TO {name}_p{remainder}"))
+    echo(f"Swapped in the partitioned table, the old one is kept as {retired}")
+    return copied
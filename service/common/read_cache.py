@@ -0,0 +1,220 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Caching
+
+The decorators and helpers that serve the read routes from the shared
+hot cache, the identical reads in flight and the stale lookups, and that
+track the hot keys that are kept warm
+"""
+import json
+from functools import partial, wraps
+from flask import request
+from flask import current_app as app  # Import Flask application
+from flask_restx import marshal
+from flask_restx.utils import unpack
+from sqlalchemy.exc import InterfaceError, OperationalError
+from service.models import Recommendation, DeadlineExceededError, HotProduct, hot_cache, on_change
+from service.common import deadlines, status
+from service.common.cache import FAILED, STALE, SingleFlight, StaleCache
+from service.common.hot_keys import HotKeys, Refresher
+
+
+######################################################################
+# Shared Hot Cache Decorator
+######################################################################
+def hot_cached(func):
+    """Decorator to serve the marshalled list of a single product from the
+    cache shared by the workers, it must wrap the marshalling decorator
+    """
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        key = hot_key()
+        if key is None:
+            return func(*args, **kwargs)
+        body = hot_cache.get(key)
+        if body is not None:
+            return app.response_class(body, mimetype="application/json")
+        generation = hot_cache.generation
+        result = func(*args, **kwargs)
+        # a stale list would outlive its staleness in the shared cache
+        if isinstance(result, app.response_class):
+            if result.status_code == status.HTTP_200_OK and "Warning" not in result.headers:
+                hot_cache.set(key, result.get_data(), generation)
+            return result
+        data, code, headers = unpack(result)
+        if code == status.HTTP_200_OK and "Warning" not in headers:
+            hot_cache.set(key, (json.dumps(data) + "\n").encode(), generation)
+        return data, code, headers
+
+    return decorated
+
+
+def hot_key():
+    """Returns the shared cache key of a request for the list of one product,
+    or None for any other request
+    """
+    if not hot_cache.enabled or request.headers.get(app.config["RESTX_MASK_HEADER"]):
+        return None
+    args = request.args.to_dict()
+    if set(args) - {"top_k"} != {"product_id"}:
+        return None
+    try:
+        return product_key(int(args["product_id"]), int(args.get("top_k", 0)))
+    except ValueError:
+        return None
+
+
+def product_key(product_id: int, top_k: int = 0) -> str:
+    """Returns the shared cache key of the list of one product"""
+    return f"product:{product_id}:top:{top_k}"
+
+
+######################################################################
+# Hot Key Tracking
+######################################################################
+def hot_tracked(func):
+    """Decorator to count the lookups of the product_id query parameter,
+    it must wrap the cache so that hits are counted too
+    """
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        product_id = request.args.get("product_id", type=int)
+        if product_id is not None:
+            track("product_id", product_id)
+        return func(*args, **kwargs)
+
+    return decorated
+
+
+def track(kind: str, key: int):
+    """Counts a lookup of a product_id or an id in this worker"""
+    refresher.ensure_started()
+    hot_keys[kind].record(key)
+
+
+def warm_hot_products(product_ids) -> int:
+    """Loads the lists of the products into the shared cache, returns how many"""
+    # routes imports this module for its decorators
+    from service import routes  # pylint: disable=import-outside-toplevel
+
+    if not hot_cache.enabled:
+        return 0
+    warmed = 0
+    for product_id in product_ids:
+        generation = hot_cache.generation
+        rows = Recommendation.query_filter({"product_id": product_id})
+        data = marshal([row.serialize() for row in rows], routes.recommendation_model)
+        if hot_cache.set(product_key(product_id), (json.dumps(data) + "\n").encode(), generation):
+            warmed += 1
+    return warmed
+
+
+def warm_up_hot_products(limit: int) -> int:
+    """Loads the lists of the products the running pods looked up the most
+    into the shared cache, returns how many
+    """
+    return warm_hot_products(HotProduct.hottest(limit))
+
+
+def refresh_hot_keys(flask_app):
+    """Saves the hot products of this worker, warms the shared cache with
+    them and halves every count so the next round follows the new traffic
+    """
+    with flask_app.app_context():
+        hottest = hot_keys["product_id"].top(flask_app.config["HOT_KEYS_WARM_UP"])
+        HotProduct.record(hottest)
+        warmed = warm_hot_products(product_id for product_id, _ in hottest)
+        app.logger.debug("Warmed %d of %d hot products", warmed, len(hottest))
+    for tracker in hot_keys.values():
+        tracker.decay()
+
+
+hot_keys = {
+    kind: HotKeys(app.config["HOT_KEYS_TOP_K"], app.config["HOT_KEYS_WIDTH"], app.config["HOT_KEYS_DEPTH"])
+    for kind in ("product_id", "id")
+}
+refresher = Refresher(app.config["HOT_KEYS_INTERVAL"], partial(refresh_hot_keys, app._get_current_object()))
+
+
+######################################################################
+# Coalesced and Stale Reads
+######################################################################
+# Errors of a read that ran out of time or did not reach the database,
+# another request with its own deadline and connection may not get them
+DATABASE_ERRORS = (OperationalError, InterfaceError, DeadlineExceededError)
+
+# Identical reads in flight in this worker, forgotten after every write
+reads = SingleFlight()
+on_change(reads.forget)
+
+
+def coalesced(key, function):
+    """Returns function(), run once for the requests that ask for key at the same time
+
+    The result is shared between requests, so function must return data
+    that is not changed afterwards, like serialized Recommendations. When
+    the query fails on the deadline of the request that ran it or on the
+    database, the others run it again under their own deadlines
+    """
+    if not app.config.get("COALESCE_READS"):
+        return function()
+    remaining = deadlines.remaining_ms()
+    try:
+        return reads.do(
+            key, function, None if remaining is None else max(remaining, 0) / 1000, retry_on=DATABASE_ERRORS
+        )
+    except TimeoutError as error:
+        raise DeadlineExceededError("Request deadline exceeded") from error
+
+
+# Lookups served while they are read again, expired after every write
+stale_reads = StaleCache(
+    app.config["STALE_SOFT_TTL"],
+    app.config["STALE_HARD_TTL"],
+    app.config["STALE_IF_ERROR"],
+    app.config["STALE_CACHE_SIZE"],
+    errors=DATABASE_ERRORS,
+)
+on_change(stale_reads.expire)
+
+
+def revalidated(key, function):
+    """Returns function() and the response headers that tell how old it is
+
+    With SERVE_STALE the result is served from stale_reads, with an Age
+    header and a Warning when it is past its soft TTL or the database
+    could not be reached. It is read again in the background with a
+    deadline of STALE_REFRESH_TIMEOUT_MS
+    """
+    if not app.config.get("SERVE_STALE"):
+        return coalesced(key, function), {}
+    flask_app = app._get_current_object()
+
+    def refresh():
+        with flask_app.app_context(), deadlines.time_limit(flask_app.config["STALE_REFRESH_TIMEOUT_MS"]):
+            return function()
+
+    result, age, freshness = stale_reads.get(key, lambda: coalesced(key, function), refresh)
+    headers = {"Age": str(int(age))}
+    if freshness == STALE:
+        headers["Warning"] = '110 - "Response is Stale"'
+    elif freshness == FAILED:
+        headers["Warning"] = '111 - "Revalidation Failed"'
+    return result, headers
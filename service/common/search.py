@@ -0,0 +1,95 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Name Search
+
+This module contains the in memory name index used for prefix and
+substring searches on databases without trigram indexes, like SQLite
+"""
+import threading
+from bisect import bisect_left
+
+
+def like_pattern(text: str, match: str) -> str:
+    """Returns a LIKE pattern for text with its wildcards escaped"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    if match == "prefix":
+        return escaped + "%"
+    return "%" + escaped + "%"
+
+
+class NameIndex:
+    """Case insensitive prefix and substring index over names
+
+    Prefix searches bisect a sorted list of names, substring searches
+    intersect the trigram postings before checking each candidate
+    """
+
+    def __init__(self):
+        self.stale = True
+        self._names = []
+        self._ids = []
+        self._by_id = {}
+        self._trigrams = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _grams(text: str):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def build(self, rows):
+        """Rebuilds the index from (id, name) pairs"""
+        entries = sorted((name.lower(), id_) for id_, name in rows if name)
+        trigrams = {}
+        for name, id_ in entries:
+            for gram in self._grams(name):
+                trigrams.setdefault(gram, set()).add(id_)
+        with self._lock:
+            self._names = [name for name, _ in entries]
+            self._ids = [id_ for _, id_ in entries]
+            self._by_id = {id_: name for name, id_ in entries}
+            self._trigrams = trigrams
+            self.stale = False
+
+    def invalidate(self):
+        """Marks the index to be rebuilt before the next search"""
+        self.stale = True
+
+    def prefix(self, text: str) -> list:
+        """Returns the ids of names that start with text"""
+        text = text.lower()
+        with self._lock:
+            start = bisect_left(self._names, text)
+            end = start
+            while end < len(self._names) and self._names[end].startswith(text):
+                end += 1
+            return self._ids[start:end]
+
+    def contains(self, text: str) -> list:
+        """Returns the ids of names that contain text"""
+        text = text.lower()
+        with self._lock:
+            grams = self._grams(text)
+            if grams:
+                postings = sorted((self._trigrams.get(gram, set()) for gram in grams), key=len)
+                candidates = set.intersection(*postings)
+            else:
+                candidates = self._by_id.keys()
+            return [id_ for id_ in candidates if text in self._by_id[id_]]
+
+    def __len__(self):
+        return len(self._ids)
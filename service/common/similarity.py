@@ -0,0 +1,95 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Similarity Engine
+
+This module finds the most similar products by the cosine similarity of
+their feature vectors. Vectors are normalized once, then a block of rows
+is compared with every vector in one matrix product, so memory stays
+bounded by the block size times the number of products.
+"""
+import csv
+import numpy as np
+
+
+def read_csv(stream):
+    """Returns the product ids and vectors of rows of product_id, features..."""
+    ids, vectors = [], []
+    for row in csv.reader(stream):
+        if not row or not row[0].strip().lstrip("-").isdigit():
+            continue  # blank line or header
+        try:
+            ids.append(int(row[0]))
+            vectors.append([float(value) for value in row[1:]])
+        except ValueError as error:
+            raise ValueError(f"Invalid feature vector: {row}") from error
+    return ids, vectors
+
+
+def read_npy(path):
+    """Returns the product ids and vectors of a 2-D float .npy array
+
+    The first column holds the product ids, the rest the features. The
+    file is memory mapped rather than read
+    """
+    matrix = np.load(path, mmap_mode="r")
+    if matrix.ndim != 2 or matrix.dtype.kind != "f":
+        raise ValueError(f"Unsupported .npy array: {matrix.dtype} of shape {matrix.shape}")
+    return matrix[:, 0].astype(np.int64), matrix[:, 1:]
+
+
+def normalize(vectors):
+    """Returns the vectors as rows scaled to unit length, zero vectors stay zero"""
+    try:
+        matrix = np.asarray(vectors, dtype=np.float64)
+    except ValueError as error:
+        raise ValueError("Feature vectors must all have the same length") from error
+    if matrix.ndim != 2:
+        raise ValueError("Feature vectors must all have the same length")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def top_similar(ids, vectors, top_k=10, min_score=0.0, block_size=256, shard=(0, 1)):
+    """Yields (product_id, [(other_product_id, similarity), ...]) per product
+
+    Similarities of a block of rows against every vector are one matrix
+    product, reduced to the top_k of each row with argpartition before
+    the next block, instead of sorting whole rows. Only products whose
+    id modulo shard[1] is shard[0] get their neighbours
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    units = normalize(vectors)
+    missing = ~units.any(axis=1)
+    rows = np.flatnonzero(ids % shard[1] == shard[0])
+    top_k = min(top_k, len(ids))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = units[block] @ units.T
+        # a product is not its own neighbour and zero vectors have none
+        scores[(ids[block, None] == ids[None, :]) | missing[None, :] | missing[block, None]] = -np.inf
+        scores[scores < min_score] = -np.inf
+        if 0 < top_k < len(ids):
+            best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            best = np.argsort(-scores, axis=1)[:, :top_k]
+        for position, (row, columns) in enumerate(zip(block, best)):
+            found = scores[position, columns]
+            order = np.lexsort((ids[columns], -found))
+            yield int(ids[row]), [
+                (int(ids[columns[i]]), round(float(found[i]), 6)) for i in order if np.isfinite(found[i])
+            ]
@@ -0,0 +1,297 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Tracing
+
+This module records a span for every sampled request, with child spans
+for the model methods, the SQL statements and the marshalling of the
+response. Trace and span ids follow W3C Trace Context, so a trace
+started by the ingress carries on through its traceparent header.
+Finished traces are handed to an exporter, one request at a time.
+"""
+import importlib
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+MAX_STATEMENT_LENGTH = 500
+
+# The span of the request or of the innermost phase being traced
+current_span = ContextVar("current_span", default=None)
+# The exporter of finished traces, tracing is off without one
+exporter = None  # pylint: disable=invalid-name
+sample_rate = 0.0  # pylint: disable=invalid-name
+
+
+class Span:
+    """A timed phase of a request"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start", "end", "attributes", "error", "spans")
+
+    def __init__(self, name, trace_id, parent_id=None, spans=None, **attributes):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+        # every span of the trace, shared with the children
+        self.spans = [] if spans is None else spans
+        self.spans.append(self)
+
+    def child(self, name, **attributes):
+        """Starts a span of a phase of this one"""
+        return Span(name, self.trace_id, self.span_id, self.spans, **attributes)
+
+    def finish(self, error=None):
+        """Stops the clock, with the exception that ended the phase if any"""
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C traceparent of this span, always sampled"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        """Returns the span with the field names of OpenTelemetry"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class StreamExporter:
+    """Writes each span as a line of JSON to a stream, stdout by default"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        """Writes the spans of one trace"""
+        lines = "".join(json.dumps(span.to_dict()) + "\n" for span in spans)
+        with self._lock:
+            self.stream.write(lines)
+            self.stream.flush()
+
+
+class FileExporter(StreamExporter):
+    """Appends each span as a line of JSON to a file"""
+
+    def __init__(self, path):
+        super().__init__(open(path, "a", encoding="utf-8"))  # pylint: disable=consider-using-with
+
+
+def load_exporter(name: str):
+    """Returns the exporter named by TRACE_EXPORTER, or None to turn tracing off
+
+    "stdout", "file:<path>" or "<module>:<class>" of any class with an
+    export(spans) method
+    """
+    if not name:
+        return None
+    if name == "stdout":
+        return StreamExporter()
+    if name.startswith("file:"):
+        return FileExporter(name[5:])
+    module, _, cls = name.partition(":")
+    return getattr(importlib.import_module(module), cls)()
+
+
+def sampled(trace_id: str) -> bool:
+    """Decides from the trace id, so every service keeps the same traces"""
+    return int(trace_id[16:], 16) < sample_rate * 2**64
+
+
+######################################################################
+# Spans
+######################################################################
+@contextmanager
+def span(name, **attributes):
+    """Traces the enclosed phase as a child of the current span
+
+    Does nothing when the request is not sampled
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as error:
+        child.finish(error)
+        raise
+    else:
+        child.finish()
+    finally:
+        current_span.reset(token)
+
+
+def traced(name):
+    """Decorator to trace every call of a function as a span"""
+
+    def decorator(function):
+        @wraps(function)
+        def decorated(*args, **kwargs):
+            if current_span.get() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+
+        return decorated
+
+    return decorator
+
+
+def marshalled(marshaller):
+    """Applies a flask-restx marshalling decorator with a span around the
+    marshalling alone, which starts once the resource method has returned
+    """
+
+    def decorator(function):
+        started = ContextVar(f"marshal_{function.__name__}", default=None)
+
+        @wraps(function)
+        def resource_method(*args, **kwargs):
+            result = function(*args, **kwargs)
+            parent = current_span.get()
+            if parent is not None:
+                started.set(parent.child("marshal"))
+            return result
+
+        marshal = marshaller(resource_method)
+
+        @wraps(marshal)
+        def decorated(*args, **kwargs):
+            token = started.set(None)
+            try:
+                return marshal(*args, **kwargs)
+            finally:
+                if started.get() is not None:
+                    started.get().finish()
+                started.reset(token)
+
+        return decorated
+
+    return decorator
+
+
+######################################################################
+# Request and SQL hooks
+######################################################################
+def start_request():
+    """Starts the span of a request, continuing the trace of its traceparent"""
+    match = TRACEPARENT.match(request.headers.get("traceparent", ""))
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        keep = int(flags, 16) & 1
+    else:
+        trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+        keep = sampled(trace_id)
+    if not keep:
+        return
+    root = Span(
+        f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+        trace_id,
+        parent_id,
+        **{"http.method": request.method, "http.target": request.full_path.rstrip("?")},
+    )
+    current_span.set(root)
+
+
+def tag_response(response):
+    """Records the status and tells the client which trace to look for"""
+    root = current_span.get()
+    if root is not None:
+        root.attributes["http.status_code"] = response.status_code
+        response.headers["traceresponse"] = root.traceparent
+    return response
+
+
+def end_request(error=None):
+    """Finishes the trace of the request and exports it"""
+    root = current_span.get()
+    if root is None:
+        return
+    current_span.set(None)
+    root.finish(error)
+    try:
+        exporter.export(root.spans)
+    except Exception as export_error:  # pylint: disable=broad-except
+        logger.warning("Trace export failed: %s", export_error)
+
+
+def start_statement(_conn, _cursor, statement, _parameters, context, _executemany):
+    """Starts the span of a SQL statement"""
+    parent = current_span.get()
+    if parent is not None and context is not None:
+        context.trace_span = parent.child("db.query", **{"db.statement": statement[:MAX_STATEMENT_LENGTH]})
+
+
+def end_statement(_conn, _cursor, _statement, _parameters, context, _executemany):
+    """Finishes the span of a SQL statement"""
+    statement_span = getattr(context, "trace_span", None)
+    if statement_span is not None:
+        statement_span.finish()
+
+
+def fail_statement(exception_context):
+    """Finishes the span of a SQL statement that raised"""
+    statement_span = getattr(exception_context.execution_context, "trace_span", None)
+    if statement_span is not None and statement_span.end is None:
+        statement_span.finish(exception_context.original_exception)
+
+
+def init_tracing(app):
+    """Registers the tracing hooks when TRACE_EXPORTER is set"""
+    global exporter, sample_rate
+    exporter = load_exporter(app.config.get("TRACE_EXPORTER"))
+    sample_rate = app.config.get("TRACE_SAMPLE_RATE", 0.0)
+    if exporter is None:
+        return
+    app.before_request(start_request)
+    app.after_request(tag_response)
+    app.teardown_request(end_request)
+    if not event.contains(Engine, "before_cursor_execute", start_statement):
+        event.listen(Engine, "before_cursor_execute", start_statement)
+        event.listen(Engine, "after_cursor_execute", end_statement)
+        event.listen(Engine, "handle_error", fail_statement)
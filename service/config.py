@@ -17,4 +17,111 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
+API_KEY = os.getenv("API_KEY")
+# Keys of individual clients as "name:key,name:key", each of them has its own
+# rate limit bucket and is accepted wherever API_KEY is
+API_KEYS = dict(entry.split(":", 1) for entry in os.getenv("API_KEYS", "").split(",") if ":" in entry)
 LOGGING_LEVEL = logging.INFO
+
+# Write logs from a background thread and choose "text" or "json" output
+LOG_QUEUE = os.getenv("LOG_QUEUE", "False").lower() in ("true", "1", "yes")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Fraction of records below WARNING to keep per logger, e.g. "flask.app=0.1,service=0.5"
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        pair.partition("=") for pair in os.getenv("LOG_SAMPLE_RATES", "").split(",") if pair
+    )
+}
+# Times per second the same message below WARNING may be logged, 0 for no limit
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "0"))
+
+# Admission control, a limit of 0 turns it off
+# Rates are tokens per second, enforced separately by every worker
+RATE_LIMIT_PER_KEY = float(os.getenv("RATE_LIMIT_PER_KEY", "0"))
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "0"))
+# Proxies in front of the service whose X-Forwarded-For is trusted, so clients
+# without a key are limited by their own address and not the ingress's one
+PROXY_FIX_HOPS = int(os.getenv("PROXY_FIX_HOPS", "0"))
+MAX_QUEUE_TIME_MS = int(os.getenv("MAX_QUEUE_TIME_MS", "0"))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "1"))
+
+# Request deadlines in milliseconds, applied to PostgreSQL as statement_timeout
+# Clients may override the default with the X-Request-Timeout header
+REQUEST_TIMEOUT_MS = int(os.getenv("REQUEST_TIMEOUT_MS", "10000"))
+MAX_REQUEST_TIMEOUT_MS = int(os.getenv("MAX_REQUEST_TIMEOUT_MS", "30000"))
+
+# Retry the first database connection while PostgreSQL is starting
+RETRY_COUNT = int(os.getenv("RETRY_COUNT", "5"))
+RETRY_DELAY = float(os.getenv("RETRY_DELAY", "1"))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "2"))
+
+# Seconds to cache the database ping used by the readiness probe
+HEALTH_CHECK_TTL = float(os.getenv("HEALTH_CHECK_TTL", "5"))
+
+# Seconds to cache the aggregate statistics, writes in this worker clear them sooner
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "60"))
+
+# Share one database read among identical requests in flight in a worker
+COALESCE_READS = os.getenv("COALESCE_READS", "True").lower() in ("true", "1", "yes")
+
+# Have PostgreSQL build the JSON of list responses with json_agg, instead
+# of reading every row into Python to marshal it
+JSON_FROM_DB = os.getenv("JSON_FROM_DB", "False").lower() in ("true", "1", "yes")
+
+# Serve lookups by id and by product from a cache in each worker, reading
+# them again in the background once they are older than STALE_SOFT_TTL
+# seconds and before answering once older than STALE_HARD_TTL. While the
+# database is down entries are served up to STALE_IF_ERROR seconds longer
+SERVE_STALE = os.getenv("SERVE_STALE", "False").lower() in ("true", "1", "yes")
+STALE_SOFT_TTL = float(os.getenv("STALE_SOFT_TTL", "5"))
+STALE_HARD_TTL = float(os.getenv("STALE_HARD_TTL", "60"))
+STALE_IF_ERROR = float(os.getenv("STALE_IF_ERROR", "300"))
+STALE_CACHE_SIZE = int(os.getenv("STALE_CACHE_SIZE", "10000"))
+# Milliseconds a background refresh may run, as its statement_timeout
+STALE_REFRESH_TIMEOUT_MS = int(os.getenv("STALE_REFRESH_TIMEOUT_MS", "5000"))
+
+# Recommendation types that can be added before new type names are rejected,
+# their ids are SMALLINTs so it must stay below 32767
+MAX_RECOMMENDATION_TYPES = int(os.getenv("MAX_RECOMMENDATION_TYPES", "1000"))
+
+# Operations accepted in one POST /recommendations/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+
+# MiB of memory shared by the workers to cache the lists of hot products,
+# 0 turns it off. Only shared when gunicorn preloads the app
+SHARED_CACHE_MB = int(os.getenv("SHARED_CACHE_MB", "0"))
+# KiB per cached list, longer lists are not cached
+SHARED_CACHE_SLOT_KB = int(os.getenv("SHARED_CACHE_SLOT_KB", "16"))
+# Seconds a cached list is served, writes made by this service expire it sooner
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", "30"))
+
+# Lookups of the top hottest products and ids kept by each worker, counted
+# in a sketch of width by depth counters of 8 bytes
+HOT_KEYS_TOP_K = int(os.getenv("HOT_KEYS_TOP_K", "100"))
+HOT_KEYS_WIDTH = int(os.getenv("HOT_KEYS_WIDTH", "2048"))
+HOT_KEYS_DEPTH = int(os.getenv("HOT_KEYS_DEPTH", "4"))
+# Seconds between saving the hot products, warming the shared cache with
+# them and halving the counts, 0 turns it off
+HOT_KEYS_INTERVAL = float(os.getenv("HOT_KEYS_INTERVAL", "60"))
+# Hot product lists loaded into the shared cache before taking traffic
+HOT_KEYS_WARM_UP = int(os.getenv("HOT_KEYS_WARM_UP", "50"))
+
+# Where finished request traces go: "" for nowhere, "stdout", "file:<path>"
+# or "<module>:<class>" of an exporter with an export(spans) method
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")
+# Fraction of new traces to record, requests with a traceparent follow its sampled flag
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+
+# Hash partitions of the recommendation table on product_id, 0 for none
+# Only used when the table is first created, see flask db-partition
+PARTITION_COUNT = int(os.getenv("PARTITION_COUNT", "0"))
+
+# Seconds the change feed holds back new changes on top of the oldest open
+# transaction, which PostgreSQL already waits for so nothing commits late
+CHANGE_FEED_LAG = float(os.getenv("CHANGE_FEED_LAG", "0"))
+# Days to keep the tombstones of deleted recommendations, consumers that
+# fall further behind have to read the whole table again
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
@@ -1,18 +1,63 @@
+# pylint: disable=too-many-lines
 """
 Models for Recommendation
 
 All of the models are stored in this module
 """
 
+import math
+import heapq
 import logging
-from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime, timedelta
+from itertools import chain, groupby, islice
+from retry.api import retry_call
+from sqlalchemy import and_, bindparam, case, cast, delete, event, false as sa_false, func, literal, null, or_, select, text
+from sqlalchemy import literal_column, tuple_, update
+from sqlalchemy.types import Text, TypeDecorator
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError
 from flask_sqlalchemy import SQLAlchemy
+from service.common.cache import NameMap, SharedCache, TTLCache, MISSING
+from service.common.search import NameIndex, like_pattern
+from service.common import cursors, partitioning
+from service.common.tracing import traced
 
 logger = logging.getLogger("flask.app")
 
+# Operations accepted by Recommendation.apply_batch
+BATCH_OPERATIONS = ("create", "update", "delete")
+
+# Columns that identify a recommendation regardless of its id
+NATURAL_KEY = ("product_id", "recommended_product_id", "recommendation_type")
+
+# Columns read and serialized for every recommendation, in order
+COLUMNS = (
+    "id",
+    "name",
+    "product_id",
+    "recommended_product_id",
+    "recommendation_type",
+    "score",
+    "suppressed",
+    "created_at",
+    "updated_at",
+)
+
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Aggregate statistics are cached until they expire or the table changes
+stats_cache = TTLCache(ttl=60, max_size=32)
+
+# Serialized lists of hot products shared by the workers, opened in create_app
+hot_cache = SharedCache()
+
+# Functions to call after a transaction that wrote to the database commits
+change_listeners = []
+
+# Names searched in memory when the database has no trigram index
+name_index = NameIndex()
+
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
@@ -22,7 +67,400 @@ class PrimaryKeyNotSetError(Exception):
     """Used when tried to set primary key to None"""
 
 
-class Recommendation(db.Model):
+class DeadlineExceededError(Exception):
+    """Used when a request runs out of time before the database answers"""
+
+
+def on_change(listener):
+    """Registers a function to be called after every commit that wrote data"""
+    change_listeners.append(listener)
+    return listener
+
+
+# Writes to the other tables are bookkeeping that no cache depends on
+CHANGE_TRACKED_TABLES = ("recommendation",)
+
+
+@event.listens_for(db.session, "after_flush")
+def _track_flush(session, _flush_context):
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if instance.__table__.name in CHANGE_TRACKED_TABLES:
+            session.info["changed"] = True
+            return
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _track_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if getattr(table, "name", None) in CHANGE_TRACKED_TABLES:
+            orm_execute_state.session.info["changed"] = True
+
+
+@event.listens_for(db.session, "before_flush")
+def _create_types(session, _flush_context, _instances):
+    Recommendation.create_types(
+        instance.recommendation_type
+        for instance in chain(session.new, session.dirty)
+        if isinstance(instance, Recommendation) and instance.recommendation_type is not None
+    )
+
+
+@event.listens_for(db.session, "after_commit")
+def _notify_changes(session):
+    for name, row_id in session.info.pop("new_types", {}).items():
+        recommendation_types.add(row_id, name)
+    if session.info.pop("changed", False):
+        for listener in change_listeners:
+            listener()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_changes(session):
+    session.info.pop("new_types", None)
+    session.info.pop("changed", None)
+
+
+on_change(stats_cache.clear)
+on_change(name_index.invalidate)
+on_change(hot_cache.invalidate)
+
+
+def init_db(app):
+    """Creates the tables, retrying while the database is still starting up"""
+    recommendation_types.max_names = app.config["MAX_RECOMMENDATION_TYPES"]
+    retry_call(
+        create_tables,
+        fargs=[app.config.get("PARTITION_COUNT", 0)],
+        exceptions=OperationalError,
+        tries=app.config["RETRY_COUNT"],
+        delay=app.config["RETRY_DELAY"],
+        backoff=app.config["RETRY_BACKOFF"],
+        logger=logger,
+    )
+    if db.engine.dialect.name == "postgresql":
+        normalize_types()
+        add_missing_columns()
+        create_search_indexes()
+
+
+def create_tables(partitions=0):
+    """Creates any missing tables
+
+    On PostgreSQL a new recommendation table is hash partitioned on
+    product_id when partitions is set
+    """
+    recommendation_types.clear()
+    if partitions and db.engine.dialect.name == "postgresql":
+        table = Recommendation.__table__
+        with db.engine.begin() as connection:
+            RecommendationType.__table__.create(connection, checkfirst=True)
+            if not partitioning.table_exists(connection, table.name):
+                partitioning.create_partitioned(connection, table, table.name, partitions)
+    db.create_all()
+
+
+def normalize_types():
+    """Moves the type names of a table created before the type lookup table
+    into it, and replaces them with the SMALLINT ids of their rows
+
+    The table is locked while its rows are rewritten, the indexes that
+    used the old column are created again by add_missing_columns
+    """
+    exists = text(
+        "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'recommendation' AND column_name = 'recommendation_type')"
+    )
+    with db.engine.begin() as connection:
+        if not connection.execute(exists).scalar():
+            return
+        connection.execute(text("LOCK TABLE recommendation IN ACCESS EXCLUSIVE MODE"))
+        if not connection.execute(exists).scalar():
+            return  # another worker got here first
+        logger.info("Moving recommendation types into the recommendation_type table")
+        for statement in (
+            "INSERT INTO recommendation_type (name) SELECT DISTINCT recommendation_type FROM recommendation "
+            "ON CONFLICT (name) DO NOTHING",
+            "ALTER TABLE recommendation ADD COLUMN IF NOT EXISTS type_id smallint REFERENCES recommendation_type (id)",
+            "UPDATE recommendation r SET type_id = t.id FROM recommendation_type t WHERE t.name = r.recommendation_type",
+            "ALTER TABLE recommendation ALTER COLUMN type_id SET NOT NULL",
+            "ALTER TABLE recommendation DROP COLUMN recommendation_type",
+        ):
+            connection.execute(text(statement))
+    recommendation_types.clear()
+
+
+def add_missing_columns():
+    """Adds the columns and indexes of a table created before them
+
+    Rows that already exist are stamped with the time of the upgrade,
+    get a score of 0 and are not suppressed. A unique index that the
+    rows still violate is left for flask db-dedup to create
+    """
+    table = Recommendation.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            text(
+                "ALTER TABLE recommendation "
+                "ADD COLUMN IF NOT EXISTS created_at timestamp with time zone NOT NULL DEFAULT now(), "
+                "ADD COLUMN IF NOT EXISTS updated_at timestamp with time zone NOT NULL DEFAULT now(), "
+                "ADD COLUMN IF NOT EXISTS score double precision NOT NULL DEFAULT 0, "
+                "ADD COLUMN IF NOT EXISTS suppressed boolean NOT NULL DEFAULT false"
+            )
+        )
+    for index in table.indexes:
+        try:
+            with db.engine.begin() as connection:
+                index.create(connection, checkfirst=True)
+        except IntegrityError as error:
+            logger.warning("Index %s was not created, run flask db-dedup: %s", index.name, error.orig)
+
+
+def isoformat(column):
+    """Returns SQL that formats a timestamp column like datetime.isoformat(),
+    which json_build_object does not, as it trims the trailing zeros of the
+    microseconds
+    """
+    microseconds = func.extract("microseconds", column) % 1000000
+    return func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS') + case(
+        (microseconds == 0, ""), else_=func.to_char(column, ".US")
+    ) + func.to_char(column, "TZH:TZM")
+
+
+def insert(table):
+    """Returns an INSERT for table that supports ON CONFLICT on this database"""
+    if db.session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def create_search_indexes():
+    """Creates the trigram index that serves substring searches on names
+
+    The pg_trgm extension may not be available to our database user, in
+    which case substring searches fall back to scanning the table
+    """
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            connection.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_recommendation_name_trgm "
+                    "ON recommendation USING gin (lower(name) gin_trgm_ops)"
+                )
+            )
+    except SQLAlchemyError as error:
+        logger.warning("Trigram index not created: %s", error)
+
+
+class Tombstone(db.Model):
+    """
+    Class that records a deleted Recommendation for the change feed
+    """
+
+    __tablename__ = "recommendation_tombstone"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (db.Index("ix_recommendation_tombstone_deleted_at", "deleted_at", "id"),)
+
+    @classmethod
+    def bury(cls, rows):
+        """Records the (id, product_id) pairs of deleted Recommendations
+
+        Runs in the caller's transaction, an id deleted again is re-dated
+        """
+        rows = [{"id": id_, "product_id": product_id} for id_, product_id in rows]
+        if rows:
+            statement = insert(cls.__table__).values(rows)
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["id"],
+                    set_={"product_id": statement.excluded.product_id, "deleted_at": func.now()},
+                )
+            )
+
+    @classmethod
+    def purge(cls, older_than: timedelta) -> int:
+        """Deletes the tombstones older than older_than, returns how many"""
+        cutoff = datetime.now().astimezone() - older_than
+        count = db.session.execute(delete(cls).where(cls.deleted_at < cutoff)).rowcount
+        db.session.commit()
+        logger.info("Purged %d tombstones", count)
+        return count
+
+
+class JobCheckpoint(db.Model):
+    """
+    Class that records a finished shard of a batch job
+    """
+
+    __tablename__ = "job_checkpoint"
+
+    job = db.Column(db.String(63), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shards = db.Column(db.Integer, nullable=False)
+    worker = db.Column(db.Integer)
+    products = db.Column(db.Integer, nullable=False, default=0)
+    written = db.Column(db.Integer, nullable=False, default=0)
+    removed = db.Column(db.Integer, nullable=False, default=0)
+    seconds = db.Column(db.Float, nullable=False, default=0.0)
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    @classmethod
+    def finished(cls, job, shards) -> set:
+        """Returns the shards of job that are done, forgetting runs with another shard count"""
+        db.session.execute(delete(cls).where(cls.job == job, cls.shards != shards))
+        db.session.commit()
+        return set(db.session.execute(select(cls.shard).where(cls.job == job)).scalars())
+
+    @classmethod
+    def record(cls, job, shards, result):
+        """Records a finished shard from the result a worker reported"""
+        db.session.add(cls(job=job, shards=shards, **result))
+        db.session.commit()
+
+    @classmethod
+    def clear(cls, job):
+        """Forgets every shard of job so the next run starts over"""
+        db.session.execute(delete(cls).where(cls.job == job))
+        db.session.commit()
+
+
+class HotProduct(db.Model):
+    """
+    Class that records the most looked up products, so a new pod can
+    warm its caches with what the running ones have seen
+    """
+
+    __tablename__ = "hot_product"
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    lookups = db.Column(db.BigInteger, nullable=False)
+    seen_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    @classmethod
+    def record(cls, counts):
+        """Saves the (product_id, lookups) pairs counted by a worker
+
+        A product counted again takes the latest count, products that
+        no worker counted for a day are forgotten
+        """
+        rows = [{"product_id": product_id, "lookups": lookups} for product_id, lookups in counts]
+        if rows:
+            statement = insert(cls.__table__).values(rows)
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["product_id"],
+                    set_={"lookups": statement.excluded.lookups, "seen_at": func.now()},
+                )
+            )
+        cutoff = datetime.now().astimezone() - timedelta(days=1)
+        db.session.execute(delete(cls).where(cls.seen_at < cutoff))
+        db.session.commit()
+
+    @classmethod
+    def hottest(cls, limit: int) -> list:
+        """Returns the ids of up to limit products, most looked up first"""
+        statement = select(cls.product_id).order_by(cls.lookups.desc(), cls.product_id).limit(limit)
+        return list(db.session.execute(statement).scalars())
+
+
+class RecommendationType(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    Class that represents a type of Recommendation, stored once and
+    referenced by the SMALLINT id of its row
+    """
+
+    __tablename__ = "recommendation_type"
+
+    # SQLite only assigns ids to INTEGER PRIMARY KEY columns
+    id = db.Column(db.SmallInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    name = db.Column(db.String(63), nullable=False, unique=True)
+
+
+def _load_types():
+    with db.engine.connect() as connection:
+        return connection.execute(select(RecommendationType.id, RecommendationType.name)).all()
+
+
+# The names and ids of the recommendation types, read once per worker
+recommendation_types = NameMap(_load_types)
+
+
+def new_types() -> dict:
+    """Returns the types the session's transaction added, by name"""
+    return db.session.info.setdefault("new_types", {})
+
+
+def type_id(name):
+    """Returns the id of a type name, including one added by the session's
+    transaction, or None
+    """
+    row_id = db.session.info.get("new_types", {}).get(name)
+    return recommendation_types.id_of(name) if row_id is None else row_id
+
+
+def type_name(row_id):
+    """Returns the name of a type id, including one added by the session's
+    transaction, or None
+    """
+    name = recommendation_types.name_of(row_id)
+    if name is None:
+        name = next((key for key, value in db.session.info.get("new_types", {}).items() if value == row_id), None)
+    return name
+
+
+class TypeName(TypeDecorator):  # pylint: disable=too-many-ancestors
+    """Stores a recommendation type name as the id of its recommendation_type row
+
+    Queries compare and sort the ids, names that have no row match nothing
+    """
+
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        row_id = type_id(value)
+        return -1 if row_id is None else row_id
+
+    def process_literal_param(self, value, dialect):
+        return self.process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return type_name(value)
+
+
+class RecommendationRow:
+    """A Recommendation read with a Core select for the read paths
+
+    Holds the column values in slots, with no session, identity map or
+    change tracking, and serializes like a Recommendation
+    """
+
+    __slots__ = COLUMNS
+
+    def __init__(self, *values):
+        for column, value in zip(COLUMNS, values):
+            setattr(self, column, value)
+
+    def __repr__(self):
+        return f"<RecommendationRow {self.name} id=[{self.id}]>"
+
+    def serialize(self):
+        """Returns the column values as a dictionary"""
+        return {column: getattr(self, column) for column in COLUMNS}
+
+
+# Every query of the routes, the change feed, batches and jobs is a class
+# method of the model, which keeps each of them next to the schema it reads
+class Recommendation(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Recommendation
     """
@@ -34,11 +472,38 @@ class Recommendation(db.Model):
     name = db.Column(db.String(63))
     product_id = db.Column(db.Integer, nullable=False)
     recommended_product_id = db.Column(db.Integer, nullable=False)
-    recommendation_type = db.Column(db.String(63), nullable=False)
+    recommendation_type = db.Column(
+        "type_id", TypeName, db.ForeignKey("recommendation_type.id"), key="recommendation_type", nullable=False
+    )
+    score = db.Column(db.Float, nullable=False, server_default="0")
+    suppressed = db.Column(db.Boolean, nullable=False, server_default=sa_false())
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+    __table_args__ = (
+        db.Index(
+            "uq_recommendation_natural_key",
+            "product_id",
+            "recommended_product_id",
+            recommendation_type,
+            unique=True,
+        ),
+        db.Index(
+            "ix_recommendation_name_prefix",
+            func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+        db.Index("ix_recommendation_updated_at", "updated_at", "id"),
+        db.Index("ix_recommendation_top", "product_id", recommendation_type, score.desc()),
+        db.Index("ix_recommendation_recommended", "recommended_product_id", recommendation_type, "id"),
+    )
 
     def __repr__(self):
         return f"<Recommendation {self.name} id=[{self.id}]>"
 
+    @traced("Recommendation.create")
     def create(self):
         """create a record"""
         logger.info("Creating %s", self.name)
@@ -46,11 +511,15 @@ class Recommendation(db.Model):
         try:
             db.session.add(self)
             db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
 
+    @traced("Recommendation.update")
     def update(self):
         """update a record"""
         logger.info("Updating %s", self.name)
@@ -58,16 +527,21 @@ class Recommendation(db.Model):
             if self.id is None:
                 raise PrimaryKeyNotSetError()
             db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
 
+    @traced("Recommendation.delete")
     def delete(self):
         """delete a record"""
         logger.info("Deleting %s", self.name)
         try:
             db.session.delete(self)
+            Tombstone.bury([(self.id, self.product_id)])
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
@@ -82,15 +556,31 @@ class Recommendation(db.Model):
             "product_id": self.product_id,
             "recommended_product_id": self.recommended_product_id,
             "recommendation_type": self.recommendation_type,
+            "score": self.score,
+            "suppressed": self.suppressed,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
         }
 
     def deserialize(self, data):
         """Function that deserialize a record"""
+        for key, value in self.validate(data).items():
+            setattr(self, key, value)
+        return self
+
+    @classmethod
+    def validate(cls, data):
+        """Returns the column values of a record after checking them
+
+        The score is optional and defaults to 0
+        """
         try:
-            self.name = data["name"]
-            self.product_id = int(data["product_id"])
-            self.recommended_product_id = int(data["recommended_product_id"])
-            self.recommendation_type = data["recommendation_type"]
+            values = {
+                "name": data["name"],
+                "product_id": int(data["product_id"]),
+                "recommended_product_id": int(data["recommended_product_id"]),
+                "recommendation_type": cls.resolve_type(data["recommendation_type"]),
+            }
         except ValueError as error:
             raise DataValidationError(
                 "Invalid data type for product_id or recommended_product_id"
@@ -106,42 +596,687 @@ class Recommendation(db.Model):
                 "Invalid Recommendation: body of request contained bad or no data "
                 + str(error)
             ) from error
-        return self
+        try:
+            values["score"] = float(data.get("score") or 0)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError("Invalid data type for score") from error
+        if not math.isfinite(values["score"]):
+            raise DataValidationError("Invalid score: it must be a finite number")
+        return values
+
+    @staticmethod
+    def resolve_type(name):
+        """Returns name after checking that it can name a recommendation type
+
+        The row of a new type is only added when a record is written, see
+        create_types
+        """
+        if not isinstance(name, str) or not 0 < len(name) <= 63:
+            raise DataValidationError("Invalid recommendation_type: it must be 1 to 63 characters")
+        return name
+
+    @staticmethod
+    def create_types(names):
+        """Adds the recommendation_type rows that names are missing in the
+        caller's transaction, so a write that fails leaves none behind
+
+        Raises DataValidationError once there are MAX_RECOMMENDATION_TYPES
+        """
+        table = RecommendationType.__table__
+        existing = select(table.c.id).where(table.c.name == bindparam("name"))
+        for name in set(names):
+            if type_id(name) is not None:
+                continue
+            # another worker may have added it since this one last looked
+            row_id = db.session.execute(existing, {"name": name}).scalar()
+            if row_id is None:
+                if len(recommendation_types) + len(new_types()) >= recommendation_types.max_names:
+                    raise DataValidationError(
+                        f"Invalid recommendation_type: there are already {recommendation_types.max_names} types"
+                    )
+                statement = insert(table).values(name=name).on_conflict_do_nothing(index_elements=["name"])
+                row_id = db.session.execute(statement.returning(table.c.id)).scalar()
+            if row_id is None:
+                row_id = db.session.execute(existing, {"name": name}).scalar_one()
+            new_types()[name] = row_id
 
     ##################################################
     # CLASS METHODS
     ##################################################
 
     @classmethod
+    @traced("Recommendation.all")
     def all(cls):
         """Returns all of the Recommendations in the database"""
         logger.info("Processing all Recommendations")
         return cls.query.all()
 
     @classmethod
-    def find(cls, by_id):
-        """Finds a Recommendation by it's ID"""
+    @traced("Recommendation.find")
+    def find(cls, by_id, product_id=None):
+        """Finds a Recommendation by it's ID
+
+        Passing the product_id lets a partitioned table skip the
+        partitions that cannot hold it
+        """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.session.get(cls, by_id)
-
-    # @classmethod
-    # def find_by_name(cls, name):
-    #     """Returns all Recommendations with the given name
-
-    #     Args:
-    #         name (string): the name of the Recommendations you want to match
-    #     """
-    #     logger.info("Processing name query for %s ...", name)
-    #     return cls.query.filter(cls.name == name)
-
-    # @classmethod
-    # def query_filter(cls, filters):
-    #     """Return filtered list of recommendations"""
-    #     query = cls.query
-    #     if "recommended_product_id" in filters:
-    #         query = query.filter_by(
-    #             recommended_product_id=filters["recommended_product_id"]
-    #         )
-    #     if "recommendation_type" in filters:
-    #         query = query.filter_by(recommendation_type=filters["recommendation_type"])
-    #     return query.all()
+        if product_id is None:
+            return cls.query.session.get(cls, by_id)
+        return db.session.execute(
+            select(cls).where(*cls.id_condition(by_id, product_id))
+        ).scalar_one_or_none()
+
+    @classmethod
+    @traced("Recommendation.find_row")
+    def find_row(cls, by_id, product_id=None):
+        """Reads a Recommendation by its id without the ORM, or returns None"""
+        logger.info("Processing row lookup for id %s ...", by_id)
+        rows = cls.read_rows(cls.select_rows().where(*cls.id_condition(by_id, product_id)))
+        return rows[0] if rows else None
+
+    @classmethod
+    def select_rows(cls, source=None):
+        """Returns a Core select of the COLUMNS of the table or of a subquery of it"""
+        return select(*cls.row_columns(source))
+
+    @classmethod
+    def row_columns(cls, source=None) -> list:
+        """Returns the COLUMNS of the table or of a subquery of it, labelled
+        with their attribute names, so type_id is read as recommendation_type
+        """
+        source = cls.__table__ if source is None else source
+        return [source.c[column].label(column) for column in COLUMNS]
+
+    @classmethod
+    def read_rows(cls, query) -> list:
+        """Runs a select_rows() query and returns a RecommendationRow per row"""
+        return [RecommendationRow(*row) for row in db.session.execute(query)]
+
+    @classmethod
+    def id_condition(cls, by_id, product_id=None) -> list:
+        """Returns the conditions matching an id, with the partition key if known"""
+        conditions = [cls.id == by_id]
+        if product_id is not None:
+            conditions.append(cls.product_id == product_id)
+        return conditions
+
+    @classmethod
+    @traced("Recommendation.stats")
+    def stats(cls, top_k=10):
+        """Returns counts by type, the top products by fan-out and fan-in
+        and the degree distributions, all computed with SQL aggregates
+        """
+        cached = stats_cache.get(top_k)
+        if cached is not MISSING:
+            return cached
+        logger.info("Processing Recommendation statistics")
+        table = cls.__table__
+        count = func.count().label("count")
+        by_type = db.session.execute(
+            select(table.c.recommendation_type, count).group_by(table.c.recommendation_type)
+        ).all()
+        result = {
+            "total": sum(row.count for row in by_type),
+            "by_type": {row.recommendation_type: row.count for row in by_type},
+        }
+        for direction, column in (("out", table.c.product_id), ("in", table.c.recommended_product_id)):
+            top = db.session.execute(
+                select(column.label("product_id"), count)
+                .group_by(column)
+                .order_by(count.desc(), column)
+                .limit(top_k)
+            ).all()
+            result[f"top_fan_{direction}"] = [row._asdict() for row in top]
+            degrees = select(func.count().label("degree")).select_from(table).group_by(column).subquery()
+            distribution = db.session.execute(
+                select(degrees.c.degree, func.count().label("products"))
+                .group_by(degrees.c.degree)
+                .order_by(degrees.c.degree)
+            ).all()
+            result[f"{direction}_degree"] = [row._asdict() for row in distribution]
+        stats_cache.set(top_k, result)
+        return result
+
+    @classmethod
+    def upsert(cls, data):
+        """Inserts a Recommendation or updates the one with the same natural key
+
+        Returns the serialized record
+        """
+        return cls.upsert_many([data])[0]
+
+    @classmethod
+    @traced("Recommendation.upsert_many")
+    def upsert_many(cls, items, batch_size=1000):
+        """Inserts or updates many Recommendations with INSERT ... ON CONFLICT
+
+        Rows with the same natural key are collapsed, the last one wins.
+        Returns the serialized records in the order they were first seen
+        """
+        logger.info("Upserting %d Recommendations", len(items))
+        rows = cls.collapse(items)
+        try:
+            results = cls.upsert_rows(rows, batch_size)
+            db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error upserting records")
+            raise DataValidationError(e) from e
+        return results
+
+    @classmethod
+    def collapse(cls, items) -> list:
+        """Returns the validated values of items, one per natural key"""
+        rows = {}
+        for data in items:
+            values = cls.validate(data)
+            rows[tuple(values[key] for key in NATURAL_KEY)] = values
+        return list(rows.values())
+
+    @classmethod
+    def upsert_rows(cls, rows, batch_size=1000) -> list:
+        """Upserts validated rows in the caller's transaction, returns them as written"""
+        table = cls.__table__
+        cls.create_types([row["recommendation_type"] for row in rows])
+        results = []
+        for start in range(0, len(rows), batch_size):
+            statement = insert(table).values(rows[start:start + batch_size])
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c[key] for key in NATURAL_KEY],
+                set_={
+                    "name": statement.excluded.name,
+                    "score": statement.excluded.score,
+                    "updated_at": func.now(),
+                },
+            ).returning(*cls.row_columns())
+            results.extend(dict(row) for row in db.session.execute(statement).mappings())
+        return results
+
+    @classmethod
+    def replace_generated(cls, recommendation_type, recommendations, name, batch_size=1000):
+        """Writes generated Recommendations of one type in place of the ones
+        each product had before
+
+        recommendations yields (product_id, [(recommended_product_id, score)]).
+        Each batch of about batch_size rows is one transaction that upserts
+        the new rows and deletes the older rows of the same products, so
+        readers see either the old or the new set of a product.
+        Returns the number of rows written and the number removed
+        """
+        started = db.session.execute(select(func.now())).scalar()
+        written = removed = 0
+        products, items = [], []
+        for product_id, pairs in chain(recommendations, [(None, ())]):
+            if product_id is not None:
+                products.append(product_id)
+                items.extend(
+                    {
+                        "name": name,
+                        "product_id": product_id,
+                        "recommended_product_id": other_id,
+                        "recommendation_type": recommendation_type,
+                        "score": score,
+                    }
+                    for other_id, score in pairs
+                )
+            if products and (len(items) >= batch_size or product_id is None):
+                counts = cls._replace_batch(recommendation_type, products, items, started, batch_size)
+                written, removed = written + counts[0], removed + counts[1]
+                logger.info("Wrote %d %s Recommendations", written, recommendation_type)
+                products, items = [], []
+        return written, removed
+
+    @classmethod
+    def _replace_batch(cls, recommendation_type, products, items, started, batch_size):
+        """Replaces the rows of a batch of products in one transaction"""
+        try:
+            written = len(cls.upsert_rows(cls.collapse(items), batch_size))
+            removed = cls.delete_where(
+                cls.recommendation_type == recommendation_type,
+                cls.product_id.in_(products),
+                cls.updated_at < started,
+            )
+            db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error replacing %s records", recommendation_type)
+            raise DataValidationError(e) from e
+        return written, removed
+
+    @classmethod
+    def remove_duplicates(cls, batch_size=1000):
+        """Deletes all but the oldest row of every natural key, a batch at a time
+
+        Returns the number of rows that were deleted
+        """
+        table = cls.__table__
+        ranked = select(
+            table.c.id,
+            func.row_number()
+            .over(partition_by=[table.c[key] for key in NATURAL_KEY], order_by=table.c.id)
+            .label("rank"),
+        ).subquery()
+        duplicates = select(ranked.c.id).where(ranked.c.rank > 1).limit(batch_size)
+        removed = 0
+        while True:
+            count = cls.delete_where(table.c.id.in_(duplicates))
+            db.session.commit()
+            removed += count
+            logger.info("Removed %d duplicate Recommendations", removed)
+            if count < batch_size:
+                return removed
+
+    @classmethod
+    @traced("Recommendation.update_by_id")
+    def update_by_id(cls, by_id, data, product_id=None):
+        """Updates a Recommendation with a single UPDATE ... RETURNING
+
+        product_id is the current one, used to find the partition.
+        Returns the serialized record, or None if there is no such id,
+        even when data is invalid
+        """
+        logger.info("Updating id %s in place", by_id)
+        try:
+            values = cls.validate(data)
+        except DataValidationError:
+            found = select(cls.id).where(*cls.id_condition(by_id, product_id))
+            if db.session.execute(found).first() is None:
+                return None
+            raise
+        statement = (
+            update(cls).where(*cls.id_condition(by_id, product_id)).values(**values).returning(*cls.row_columns())
+        )
+        try:
+            cls.create_types([values["recommendation_type"]])
+            row = db.session.execute(statement).mappings().one_or_none()
+            db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error updating id: %s", by_id)
+            raise DataValidationError(e) from e
+        return dict(row) if row else None
+
+    @classmethod
+    @traced("Recommendation.delete_by_id")
+    def delete_by_id(cls, by_id, product_id=None):
+        """Deletes a Recommendation with a single DELETE
+
+        product_id is used to find the partition.
+        Returns True if a record was deleted
+        """
+        logger.info("Deleting id %s in place", by_id)
+        try:
+            count = cls.delete_where(*cls.id_condition(by_id, product_id))
+            db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error deleting id: %s", by_id)
+            raise DataValidationError(e) from e
+        return count > 0
+
+    @classmethod
+    def delete_where(cls, *conditions) -> int:
+        """Deletes the matching Recommendations and leaves tombstones for them
+
+        Runs in the caller's transaction, returns the number deleted
+        """
+        deleted = db.session.execute(
+            delete(cls).where(*conditions).returning(cls.id, cls.product_id)
+        ).all()
+        Tombstone.bury(deleted)
+        return len(deleted)
+
+    @classmethod
+    @traced("Recommendation.apply_batch")
+    def apply_batch(cls, operations, atomic=True) -> list:
+        """Applies an ordered list of creates, updates and deletes in one transaction
+
+        Every operation is validated before any is applied. Consecutive
+        creates are one multi-row INSERT and consecutive deletes one
+        DELETE, updates run one UPDATE each. An atomic batch is rolled
+        back when any operation fails, including an update or delete of a
+        missing record. When atomic is False an operation that fails is
+        reported and the others still apply.
+        Returns a result per operation with the HTTP status it would
+        have had on its own, and the record or the error
+        """
+        logger.info("Applying a batch of %d operations, atomic=%s", len(operations), atomic)
+        results = [{} for _ in operations]
+        steps = cls._check_operations(operations, results, atomic)
+        try:
+            cls.create_types(values["recommendation_type"] for _, (_, _, _, values) in steps if values)
+            cls._apply_steps(steps, results, atomic)
+            db.session.commit()
+        except (DataValidationError, DeadlineExceededError):
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error applying a batch of operations")
+            raise DataValidationError(e) from e
+        return results
+
+    @classmethod
+    def _check_operations(cls, operations, results, atomic) -> list:
+        """Returns (index, step) for each valid operation of a batch
+
+        An invalid operation fails an atomic batch, otherwise its result
+        is set to the error
+        """
+        steps = []
+        for index, operation in enumerate(operations):
+            try:
+                steps.append((index, cls.check_operation(operation)))
+            except DataValidationError as error:
+                if atomic:
+                    raise DataValidationError(f"Operation {index}: {error}") from error
+                results[index] = {"status": 400, "error": str(error)}
+        return steps
+
+    @classmethod
+    def _apply_steps(cls, steps, results, atomic):
+        """Applies the runs of operations of one kind in order and sets their results"""
+        for kind, run in groupby(steps, key=lambda step: step[1][0]):
+            run = list(run)
+            applied = cls._apply_run(kind, run) if atomic else cls._apply_best_effort(kind, run)
+            for index, result in applied:
+                if atomic and result["status"] == 404:
+                    by_id = dict(run)[index][1]
+                    raise DataValidationError(f"Operation {index}: Recommendation with id '{by_id}' was not found")
+                results[index] = result
+
+    @classmethod
+    def check_operation(cls, operation) -> tuple:
+        """Returns the kind, id, partition key and values of a batch operation"""
+        if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPERATIONS:
+            raise DataValidationError(f"Invalid operation: op must be one of {list(BATCH_OPERATIONS)}")
+        kind = operation["op"]
+        by_id = product_id = values = None
+        try:
+            if kind != "create":
+                by_id = int(operation["id"])
+            if operation.get("product_id") is not None:
+                product_id = int(operation["product_id"])
+        except (KeyError, TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid operation: {kind} needs an integer id") from error
+        if kind != "delete":
+            values = cls.validate(operation.get("data"))
+        return kind, by_id, product_id, values
+
+    @classmethod
+    def _apply_run(cls, kind, run) -> list:
+        """Applies consecutive operations of one kind in the caller's
+        transaction, returns (index, result) for each of them
+        """
+        table = cls.__table__
+        if kind == "create":
+            rows = db.session.execute(
+                insert(table).returning(*cls.row_columns(), sort_by_parameter_order=True),
+                [values for _, (_, _, _, values) in run],
+            ).mappings()
+            return [(index, {"status": 201, "recommendation": dict(row)}) for (index, _), row in zip(run, rows)]
+        if kind == "update":
+            applied = []
+            for index, (_, by_id, product_id, values) in run:
+                row = db.session.execute(
+                    update(cls).where(*cls.id_condition(by_id, product_id)).values(**values).returning(*cls.row_columns())
+                ).mappings().one_or_none()
+                applied.append((index, {"status": 200, "recommendation": dict(row)} if row else {"status": 404}))
+            return applied
+        deleted = db.session.execute(
+            delete(cls)
+            .where(or_(*(and_(*cls.id_condition(by_id, product_id)) for _, (_, by_id, product_id, _) in run)))
+            .returning(cls.id, cls.product_id)
+        ).all()
+        Tombstone.bury(deleted)
+        found = {row.id for row in deleted}
+        applied = []
+        for index, (_, by_id, _, _) in run:
+            applied.append((index, {"status": 204 if by_id in found else 404}))
+            found.discard(by_id)
+        return applied
+
+    @classmethod
+    def _apply_best_effort(cls, kind, run) -> list:
+        """Applies a run in a savepoint, one operation at a time if the run fails"""
+        try:
+            with db.session.begin_nested():
+                return cls._apply_run(kind, run)
+        except SQLAlchemyError as error:
+            if len(run) == 1:
+                return [(run[0][0], {"status": 400, "error": str(getattr(error, "orig", None) or error)})]
+        return [result for step in run for result in cls._apply_best_effort(kind, [step])]
+
+    @classmethod
+    @traced("Recommendation.changes")
+    def changes(cls, since=None, limit=100, lag=0):
+        """Returns the next changes after the since cursor, oldest first
+
+        Upserts and deletes are merged on (time changed, id). A row is
+        stamped with the start of the transaction that wrote it, so on
+        PostgreSQL only changes older than the oldest transaction still
+        open are returned, since that one may yet commit rows stamped
+        before any later change. Changes younger than lag seconds are
+        held back as well.
+        Returns a list of changes and the cursor to continue from
+        """
+        logger.info("Processing changes since %s", since)
+        try:
+            after = cursors.decode(since, datetime, int) if since else None
+        except ValueError as error:
+            raise DataValidationError(str(error)) from error
+        feeds = (
+            ("upsert", cls, cls.updated_at, lambda row: {"recommendation": row.serialize()}),
+            ("delete", Tombstone, Tombstone.deleted_at, lambda row: {"product_id": row.product_id}),
+        )
+        changes = []
+        for op, model, changed_at, details in feeds:
+            query = select(model).order_by(changed_at, model.id).limit(limit)
+            if after:
+                query = query.where(tuple_(changed_at, model.id) > tuple_(*after))
+            if lag:
+                query = query.where(changed_at <= func.now() - timedelta(seconds=lag))
+            if db.session.get_bind().dialect.name == "postgresql":
+                query = query.where(changed_at < cls.commit_watermark())
+            for row in db.session.execute(query).scalars():
+                changes.append(
+                    {"op": op, "id": row.id, "changed_at": getattr(row, changed_at.key), **details(row)}
+                )
+        changes = sorted(changes, key=lambda change: (change["changed_at"], change["id"]))[:limit]
+        if changes:
+            since = cursors.encode(changes[-1]["changed_at"], changes[-1]["id"])
+        return changes, since
+
+    @staticmethod
+    def commit_watermark():
+        """Returns SQL for the start of the oldest transaction still open
+
+        Every change stamped before it has been committed or rolled back.
+        The sessions of other roles are only seen by a role that has
+        pg_read_all_stats, so the feed must read as the role that writes
+        """
+        return (
+            select(func.min(literal_column("xact_start")))
+            .select_from(text("pg_stat_activity"))
+            .where(literal_column("datname") == func.current_database())
+            .where(literal_column("backend_type") == "client backend")
+            .scalar_subquery()
+        )
+
+    @classmethod
+    def find_by_name(cls, name, match="exact"):
+        """Returns all Recommendations with the given name
+
+        Args:
+            name (string): the name of the Recommendations you want to match
+            match (string): "exact", "prefix" or "contains", ignoring case
+                for the last two
+        """
+        logger.info("Processing %s name query for %s ...", match, name)
+        return cls.query.filter(cls.name_condition(name, match))
+
+    @classmethod
+    def name_condition(cls, name, match="exact"):
+        """Returns the filter for a name search
+
+        PostgreSQL serves prefix searches from the text_pattern_ops index and
+        substring searches from the trigram index, other databases use the
+        in memory name index instead of scanning the table
+        """
+        if match == "exact":
+            return cls.name == name
+        if db.session.get_bind().dialect.name == "postgresql":
+            return func.lower(cls.name).like(like_pattern(name.lower(), match), escape="\\")
+        if name_index.stale:
+            cls.build_name_index()
+        ids = name_index.prefix(name) if match == "prefix" else name_index.contains(name)
+        return cls.id.in_(ids)
+
+    @classmethod
+    def build_name_index(cls):
+        """Loads every name into the in memory name index"""
+        logger.info("Building the in memory name index")
+        name_index.build(db.session.execute(select(cls.id, cls.name)).all())
+
+    @classmethod
+    def filter_conditions(cls, filters, name_match="exact") -> list:
+        """Returns the conditions for the filters that are set
+
+        Suppressed Recommendations are always left out
+        """
+        conditions = [cls.suppressed.is_(False)]
+        if filters.get("name") is not None:
+            conditions.append(cls.name_condition(filters["name"], name_match))
+        for column in ("product_id", "recommended_product_id", "recommendation_type"):
+            if filters.get(column) is not None:
+                conditions.append(getattr(cls, column) == filters[column])
+        if filters.get("min_score") is not None:
+            conditions.append(cls.score >= filters["min_score"])
+        return conditions
+
+    @classmethod
+    @traced("Recommendation.query_filter")
+    def query_filter(cls, filters, name_match="exact"):
+        """Return filtered list of recommendations as RecommendationRows"""
+        logger.info("Processing query for %s ...", filters)
+        return cls.read_rows(cls.select_rows().where(*cls.filter_conditions(filters, name_match)))
+
+    @classmethod
+    @traced("Recommendation.query_json")
+    def query_json(cls, filters, fields, name_match="exact") -> str:
+        """Returns the filtered Recommendations as a JSON array built by PostgreSQL
+
+        fields are the (key, attribute) pairs of every object in the
+        array, in order, a key whose attribute is not a column is null.
+        The array comes back as text, the rows are never read into Python
+        """
+        logger.info("Processing JSON query for %s ...", filters)
+        rows = cls.select_rows().where(*cls.filter_conditions(filters, name_match)).subquery()
+        types = RecommendationType.__table__
+        columns = {column: rows.c[column] for column in COLUMNS}
+        columns["recommendation_type"] = types.c.name
+        for column in ("created_at", "updated_at"):
+            columns[column] = isoformat(columns[column])
+        pairs = chain.from_iterable((literal(key), columns.get(attribute, null())) for key, attribute in fields)
+        query = select(func.coalesce(cast(func.json_agg(func.json_build_object(*pairs)), Text), "[]")).select_from(
+            rows.join(types, types.c.id == rows.c.recommendation_type)
+        )
+        return db.session.execute(query).scalar_one()
+
+    @classmethod
+    @traced("Recommendation.recommended_by")
+    def recommended_by(cls, product_id, recommendation_type=None, after=None, limit=100):
+        """Returns a page of the Recommendations that point at product_id
+
+        Pages are ordered by type id and id, the order of the
+        (recommended_product_id, type_id, id) index, and
+        suppressed rows are included.
+        Returns the Recommendations and the cursor of the next page, or
+        None on the last page
+        """
+        logger.info("Processing reverse lookup for product %s after %s", product_id, after)
+        query = cls.select_rows().where(cls.recommended_product_id == product_id)
+        if recommendation_type is not None:
+            query = query.where(cls.recommendation_type == recommendation_type)
+        if after:
+            try:
+                key = cursors.decode(after, str, int)
+            except ValueError as error:
+                raise DataValidationError(str(error)) from error
+            query = query.where(
+                tuple_(cls.recommendation_type, cls.id) > tuple_(literal(key[0], TypeName), key[1])
+            )
+        rows = cls.read_rows(query.order_by(cls.recommendation_type, cls.id).limit(limit + 1))
+        if len(rows) <= limit:
+            return rows, None
+        return rows[:limit], cursors.encode(rows[limit - 1].recommendation_type, rows[limit - 1].id)
+
+    @classmethod
+    @traced("Recommendation.suppress_recommended")
+    def suppress_recommended(cls, product_id, suppressed=True, recommendation_type=None) -> int:
+        """Hides the Recommendations that point at product_id from forward
+        lookups, or shows them again, in a single UPDATE
+
+        Returns the number of Recommendations that changed
+        """
+        logger.info("Setting suppressed to %s for recommendations of product %s", suppressed, product_id)
+        conditions = [cls.recommended_product_id == product_id, cls.suppressed.is_not(suppressed)]
+        if recommendation_type is not None:
+            conditions.append(cls.recommendation_type == recommendation_type)
+        try:
+            count = db.session.execute(update(cls).where(*conditions).values(suppressed=suppressed)).rowcount
+            db.session.commit()
+        except DeadlineExceededError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error("Error suppressing recommendations of product: %s", product_id)
+            raise DataValidationError(e) from e
+        return count
+
+    @classmethod
+    @traced("Recommendation.top")
+    def top(cls, top_k, filters, name_match="exact"):
+        """Returns the top_k highest scored RecommendationRows of each product
+
+        With a product_id every type is read from the (product_id,
+        type_id, score) index and the sorted runs are merged
+        on a heap. Without one a window function ranks every product.
+        """
+        logger.info("Processing top %d query for %s ...", top_k, filters)
+        conditions = cls.filter_conditions(filters, name_match)
+        best = (cls.score.desc(), cls.id)
+        if filters.get("product_id") is None:
+            rank = func.row_number().over(partition_by=cls.product_id, order_by=best).label("rank")
+            ranked = cls.select_rows().add_columns(rank).where(*conditions).subquery()
+            return cls.read_rows(
+                cls.select_rows(ranked)
+                .where(ranked.c.rank <= top_k)
+                .order_by(ranked.c.product_id, ranked.c.score.desc(), ranked.c.id)
+            )
+        if filters.get("recommendation_type") is not None:
+            types = [filters["recommendation_type"]]
+        else:
+            types = db.session.execute(
+                select(cls.recommendation_type).where(*conditions).distinct()
+            ).scalars().all()
+        runs = [
+            cls.read_rows(
+                cls.select_rows().where(*conditions, cls.recommendation_type == kind).order_by(*best).limit(top_k)
+            )
+            for kind in types
+        ]
+        return list(islice(heapq.merge(*runs, key=lambda row: (-row.score, row.id)), top_k))
@@ -23,13 +23,16 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Recommendations from the inventory of pets in the PetShop
 """
 
+import os
 import secrets
 from functools import wraps
 from flask import request
 from flask import current_app as app  # Import Flask application
 from flask_restx import Resource, fields, reqparse
-from service.models import Recommendation
+from service.models import Recommendation, db
 from service.common import status  # HTTP Status Codes
+from service.common import admission, health, tracing
+from service.common.read_cache import coalesced, hot_cached, hot_keys, hot_tracked, revalidated, track
 from . import api
 
 
@@ -42,6 +45,32 @@ def index():
     return app.send_static_file("index.html")
 
 
+######################################################################
+# Kubernetes liveness and readiness probes
+######################################################################
+@app.route("/health/live")
+@admission.exempt
+def liveness():
+    """Liveness probe that answers without doing any I/O"""
+    return {"status": "OK"}, status.HTTP_200_OK
+
+
+@app.route("/health/ready")
+@admission.exempt
+def readiness():
+    """Readiness probe based on the cached database ping and warm-up state"""
+    database_ok = health.database.ping()
+    ready = database_ok and health.warm_up.complete
+    return (
+        {
+            "status": "OK" if ready else "UNAVAILABLE",
+            "database": "OK" if database_ok else "DOWN",
+            "warm_up": health.warm_up.status(),
+        },
+        status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=8080)
 
@@ -63,6 +92,9 @@ create_model = api.model(
             required=True,
             description="The type of recommendation (e.g., similar, complementary, etc.)",
         ),
+        "score": fields.Float(
+            required=False, default=0.0, description="How strong the recommendation is, higher is better"
+        ),
     },
 )
 
@@ -74,9 +106,232 @@ recommendation_model = api.inherit(
         "_id": fields.String(
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "suppressed": fields.Boolean(
+            readOnly=True, description="Hidden from lookups by product, see /products/{id}/recommended-by"
+        ),
+        "created_at": fields.DateTime(readOnly=True, description="When the recommendation was created"),
+        "updated_at": fields.DateTime(readOnly=True, description="When the recommendation was last written"),
+    },
+)
+
+# The (key, attribute) of every field of a marshalled Recommendation, in order
+RECOMMENDATION_FIELDS = [(key, field.attribute or key) for key, field in recommendation_model.resolved.items()]
+
+product_count_model = api.model(
+    "ProductCount",
+    {
+        "product_id": fields.Integer(description="The ID of the product"),
+        "count": fields.Integer(description="The number of recommendations"),
+    },
+)
+
+degree_count_model = api.model(
+    "DegreeCount",
+    {
+        "degree": fields.Integer(description="The number of recommendations of a product"),
+        "products": fields.Integer(description="The number of products with that degree"),
+    },
+)
+
+stats_model = api.model(
+    "RecommendationStats",
+    {
+        "total": fields.Integer(description="The number of recommendations"),
+        "by_type": fields.Raw(description="The number of recommendations of each type"),
+        "top_fan_out": fields.List(
+            fields.Nested(product_count_model),
+            description="The products that recommend the most products",
+        ),
+        "top_fan_in": fields.List(
+            fields.Nested(product_count_model),
+            description="The products that are recommended the most",
+        ),
+        "out_degree": fields.List(
+            fields.Nested(degree_count_model),
+            description="How many products make each number of recommendations",
+        ),
+        "in_degree": fields.List(
+            fields.Nested(degree_count_model),
+            description="How many products receive each number of recommendations",
+        ),
+    },
+)
+
+hot_key_model = api.model(
+    "HotKey",
+    {
+        "key": fields.Integer(description="The product_id or id that was looked up"),
+        "lookups": fields.Integer(description="The estimated number of lookups, halved every interval"),
+    },
+)
+
+hot_keys_model = api.model(
+    "HotKeys",
+    {
+        "worker": fields.Integer(description="The process id of the worker that counted the lookups"),
+        "lookups": fields.Raw(description="The number of lookups of each kind, halved every interval"),
+        "product_id": fields.List(fields.Nested(hot_key_model), description="The hottest products"),
+        "id": fields.List(fields.Nested(hot_key_model), description="The hottest recommendation ids"),
+    },
+)
+
+change_model = api.model(
+    "RecommendationChange",
+    {
+        "op": fields.String(enum=["upsert", "delete"], description="What happened to the recommendation"),
+        "id": fields.Integer(description="The id of the recommendation"),
+        "changed_at": fields.DateTime(description="When it happened"),
+        "product_id": fields.Integer(description="The product of a deleted recommendation"),
+        "recommendation": fields.Nested(
+            recommendation_model, allow_null=True, description="The recommendation as written"
+        ),
+    },
+)
+
+changes_model = api.model(
+    "RecommendationChanges",
+    {
+        "changes": fields.List(fields.Nested(change_model), description="The changes, oldest first"),
+        "next": fields.String(description="The cursor to pass as since to get the changes after these"),
+    },
+)
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument(
+    "since",
+    type=str,
+    location="args",
+    required=False,
+    help="The next cursor of the previous batch, leave out to start from the beginning",
+)
+changes_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    default=100,
+    help="Maximum number of changes to return",
+)
+
+batch_operation_model = api.model(
+    "BatchOperation",
+    {
+        "op": fields.String(required=True, enum=["create", "update", "delete"], description="What to do"),
+        "id": fields.Integer(required=False, description="The id to update or delete"),
+        "product_id": fields.Integer(required=False, description="The current product_id, finds the partition"),
+        "data": fields.Nested(create_model, required=False, description="The recommendation to create or update"),
+    },
+)
+
+batch_model = api.model(
+    "Batch",
+    {
+        "operations": fields.List(
+            fields.Nested(batch_operation_model), required=True, description="The operations, applied in order"
+        ),
+        "atomic": fields.Boolean(
+            required=False, default=True, description="Apply all or none, false applies the ones that succeed"
+        ),
+    },
+)
+
+batch_result_model = api.model(
+    "BatchResult",
+    {
+        "status": fields.Integer(description="The HTTP status of the operation"),
+        "recommendation": fields.Nested(recommendation_model, allow_null=True, description="What was written"),
+        "error": fields.String(description="Why the operation failed"),
     },
 )
 
+batch_results_model = api.model(
+    "BatchResults",
+    {
+        "results": fields.List(
+            fields.Nested(batch_result_model, skip_none=True), description="One result per operation, in order"
+        )
+    },
+)
+
+recommended_by_model = api.model(
+    "RecommendedBy",
+    {
+        "recommendations": fields.List(
+            fields.Nested(recommendation_model), description="The recommendations that point at the product"
+        ),
+        "next": fields.String(description="The cursor of the next page, null on the last page"),
+    },
+)
+
+suppress_model = api.model(
+    "Suppress",
+    {
+        "suppressed": fields.Boolean(
+            required=True, description="True hides the recommendations from lookups by product, false shows them"
+        ),
+        "recommendation_type": fields.String(required=False, description="Only change recommendations of this type"),
+    },
+)
+
+suppressed_count_model = api.model(
+    "SuppressedCount",
+    {"updated": fields.Integer(description="The number of recommendations that changed")},
+)
+
+recommended_by_args = reqparse.RequestParser()
+recommended_by_args.add_argument(
+    "recommendation_type",
+    type=str,
+    location="args",
+    required=False,
+    help="Only return recommendations of this type",
+)
+recommended_by_args.add_argument(
+    "after",
+    type=str,
+    location="args",
+    required=False,
+    help="The next cursor of the previous page",
+)
+recommended_by_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    default=100,
+    help="Maximum number of recommendations to return",
+)
+
+stats_args = reqparse.RequestParser()
+stats_args.add_argument(
+    "top_k",
+    type=int,
+    location="args",
+    required=False,
+    default=10,
+    help="Number of top products to return",
+)
+
+hot_keys_args = reqparse.RequestParser()
+hot_keys_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    required=False,
+    default=20,
+    help="Number of hot keys of each kind to return",
+)
+
+# The partition key, lets a partitioned table look in a single partition
+partition_args = reqparse.RequestParser()
+partition_args.add_argument(
+    "product_id",
+    type=int,
+    location="args",
+    required=False,
+    help="Current product ID of the recommendation",
+)
+
 # Query string arguments
 recommendation_args = reqparse.RequestParser()
 recommendation_args.add_argument(
@@ -86,6 +341,15 @@ recommendation_args.add_argument(
     required=False,
     help="Filter recommendations by name",
 )
+recommendation_args.add_argument(
+    "name_match",
+    type=str,
+    location="args",
+    required=False,
+    default="exact",
+    choices=("exact", "prefix", "contains"),
+    help="How to match the name filter, prefix and contains ignore case",
+)
 recommendation_args.add_argument(
     "product_id",
     type=int,
@@ -107,6 +371,20 @@ recommendation_args.add_argument(
     required=False,
     help="Filter recommendations by type",
 )
+recommendation_args.add_argument(
+    "min_score",
+    type=float,
+    location="args",
+    required=False,
+    help="Filter recommendations scored at least this much",
+)
+recommendation_args.add_argument(
+    "top_k",
+    type=int,
+    location="args",
+    required=False,
+    help="Return the best scored recommendations of each product, highest first",
+)
 
 
 ######################################################################
@@ -117,11 +395,7 @@ def token_required(func):
 
     @wraps(func)
     def decorated(*args, **kwargs):
-        token = None
-        if "X-Api-Key" in request.headers:
-            token = request.headers["X-Api-Key"]
-
-        if app.config.get("API_KEY") and app.config["API_KEY"] == token:
+        if api_client(request.headers.get("X-Api-Key")) is not None:
             return func(*args, **kwargs)
 
         return {"message": "Invalid or missing token"}, 401
@@ -129,6 +403,100 @@ def token_required(func):
     return decorated
 
 
+######################################################################
+# Rate Limiting Decorator
+######################################################################
+def rate_limited(func):
+    """Decorator to apply the global and per client token buckets"""
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        admission.check_rate(client_key())
+        return func(*args, **kwargs)
+
+    return decorated
+
+
+def client_key():
+    """Returns the rate limit key of the client that holds the API key of
+    the request, or else its address, so made up keys cannot get fresh buckets
+    """
+    client = api_client(request.headers.get("X-Api-Key"))
+    if client is not None:
+        return f"key:{client}"
+    return request.remote_addr
+
+
+def api_client(token):
+    """Returns the name of the client whose API key token is, or None
+
+    API_KEY is shared by the clients that are not in API_KEYS
+    """
+    if not token:
+        return None
+    keys = {"shared": app.config.get("API_KEY"), **app.config.get("API_KEYS", {})}
+    for client, key in keys.items():
+        if key and secrets.compare_digest(token.encode(), key.encode()):
+            return client
+    return None
+
+
+######################################################################
+# Database JSON Decorator
+######################################################################
+def json_from_db(func):
+    """Decorator to answer a list request with the JSON array PostgreSQL
+    builds, without reading the rows into Python, when JSON_FROM_DB is set.
+    It must wrap the marshalling decorator
+
+    Falls back to marshalling on other databases, with an X-Fields mask
+    and for top_k, whose rows are merged in Python
+    """
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        if (
+            not app.config.get("JSON_FROM_DB")
+            or db.engine.dialect.name != "postgresql"
+            or request.headers.get(app.config["RESTX_MASK_HEADER"])
+        ):
+            return func(*args, **kwargs)
+        top_k, name_match, filters = list_args()
+        if top_k is not None:
+            return func(*args, **kwargs)
+
+        def query():
+            return (Recommendation.query_json(filters, RECOMMENDATION_FIELDS, name_match) + "\n").encode()
+
+        key = ("json", name_match, tuple(sorted(filters.items())))
+        if "product_id" in filters:
+            body, headers = revalidated(key, query)
+        else:
+            body, headers = coalesced(key, query), {}
+        return app.response_class(body, status.HTTP_200_OK, headers, mimetype="application/json")
+
+    return decorated
+
+
+def list_args():
+    """Returns the top_k, name_match and filters of a list request, or aborts"""
+    known = {argument.name for argument in recommendation_args.args}
+    if not set(request.args).issubset(known):
+        app.logger.error("Invalid query parameters: %s", list(request.args))
+        api.abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Query parameters must be one of {sorted(known)}",
+            error="Invalid query parameter",
+        )
+    args = recommendation_args.parse_args()
+    name_match = args.pop("name_match")
+    top_k = args.pop("top_k")
+    filters = {key: value for key, value in args.items() if value is not None}
+    if top_k is not None and not 0 < top_k <= 1000:
+        abort(status.HTTP_400_BAD_REQUEST, "top_k must be between 1 and 1000")
+    return top_k, name_match, filters
+
+
 ######################################################################
 # Function to generate a random API key (good for testing)
 ######################################################################
@@ -157,7 +525,9 @@ class RecommendationResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_recommendation")
     @api.response(404, "Product Recommendation not found")
-    @api.marshal_with(recommendation_model)
+    @api.expect(partition_args, validate=True)
+    @tracing.marshalled(api.marshal_with(recommendation_model))
+    @rate_limited
     def get(self, id):
         """
         Retrieve a single Product Recommendation
@@ -165,13 +535,20 @@ class RecommendationResource(Resource):
         This endpoint will return a Product Recommendation based on its id
         """
         app.logger.info("Request to retrieve a product recommendation with id [%s]", id)
-        recommendation = Recommendation.find(id)
-        if not recommendation:
+        args = partition_args.parse_args()
+        track("id", id)
+
+        def find():
+            recommendation = Recommendation.find_row(id, args["product_id"])
+            return recommendation.serialize() if recommendation else None
+
+        result, headers = revalidated(("find", id, args["product_id"]), find)
+        if not result:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Product Recommendation with id '{id}' was not found.",
             )
-        return recommendation.serialize(), status.HTTP_200_OK
+        return result, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT RECOMMENDATION
@@ -179,8 +556,9 @@ class RecommendationResource(Resource):
     @api.doc("update_recommendation", security="apikey")
     @api.response(404, "Product Recommendation not found")
     @api.response(400, "The posted Product Recommendation data was not valid")
-    @api.expect(recommendation_model)
-    @api.marshal_with(recommendation_model)
+    @api.expect(recommendation_model, partition_args)
+    @tracing.marshalled(api.marshal_with(recommendation_model))
+    @rate_limited
     def put(self, id):
         """
         Update a Product Recommendation
@@ -188,24 +566,23 @@ class RecommendationResource(Resource):
         This endpoint will update a Product Recommendation based on the body that is posted
         """
         app.logger.info("Request to update a product recommendation with id [%s]", id)
-        recommendation = Recommendation.find(id)
+        app.logger.debug("Payload = %s", api.payload)
+        args = partition_args.parse_args()
+        recommendation = Recommendation.update_by_id(id, api.payload, args["product_id"])
         if not recommendation:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Product Recommendation with id '{id}' was not found.",
             )
-        app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
-        recommendation.deserialize(data)
-        recommendation.id = id
-        recommendation.update()
-        return recommendation.serialize(), status.HTTP_200_OK
+        return recommendation, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # DELETE A PRODUCT RECOMMENDATION
     # ------------------------------------------------------------------
     @api.doc("delete_recommendation", security="apikey")
     @api.response(204, "Product Recommendation deleted")
+    @api.expect(partition_args, validate=True)
+    @rate_limited
     def delete(self, id):
         """
         Delete a Product Recommendation
@@ -213,9 +590,8 @@ class RecommendationResource(Resource):
         This endpoint will delete a Product Recommendation based on the id specified in the path
         """
         app.logger.info("Request to delete a product recommendation with id [%s]", id)
-        recommendation = Recommendation.find(id)
-        if recommendation:
-            recommendation.delete()
+        args = partition_args.parse_args()
+        if Recommendation.delete_by_id(id, args["product_id"]):
             app.logger.info("Product Recommendation with id [%s] was deleted", id)
 
         return "", status.HTTP_204_NO_CONTENT
@@ -233,17 +609,35 @@ class RecommendationCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_recommendations")
     @api.expect(recommendation_args, validate=True)
-    @api.marshal_list_with(recommendation_model)
+    @rate_limited
+    @hot_tracked
+    @hot_cached
+    @json_from_db
+    @tracing.marshalled(api.marshal_list_with(recommendation_model))
     def get(self):
         """Returns all of the Product Recommendations"""
         app.logger.info("Request to list Product Recommendations...")
-        recommendations = []
-        app.logger.info("Returning unfiltered list.")
-        recommendations = Recommendation.all()
-
-        app.logger.info("[%s] Product Recommendations returned", len(recommendations))
-        results = [recommendation.serialize() for recommendation in recommendations]
-        return results, status.HTTP_200_OK
+        top_k, name_match, filters = list_args()
+
+        def query():
+            if top_k is not None:
+                recommendations = Recommendation.top(top_k, filters, name_match)
+            elif filters:
+                app.logger.info("Filtering by %s", filters)
+                recommendations = Recommendation.query_filter(filters, name_match)
+            else:
+                app.logger.info("Returning unfiltered list.")
+                recommendations = Recommendation.query_filter({})
+            with tracing.span("serialize", rows=len(recommendations)):
+                return [recommendation.serialize() for recommendation in recommendations]
+
+        key = ("list", top_k, name_match, tuple(sorted(filters.items())))
+        if "product_id" in filters:
+            results, headers = revalidated(key, query)
+        else:
+            results, headers = coalesced(key, query), {}
+        app.logger.info("[%s] Product Recommendations returned", len(results))
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT RECOMMENDATION
@@ -251,7 +645,8 @@ class RecommendationCollection(Resource):
     @api.doc("create_recommendation", security="apikey")
     @api.response(400, "The posted data was not valid")
     @api.expect(create_model)
-    @api.marshal_with(recommendation_model, code=201)
+    @tracing.marshalled(api.marshal_with(recommendation_model, code=201))
+    @rate_limited
     def post(self):
         """
         Creates a Product Recommendation
@@ -277,9 +672,246 @@ class RecommendationCollection(Resource):
 
 
 ######################################################################
-#  U T I L I T Y   F U N C T I O N S
+#  PATH: /recommendations/stats
+######################################################################
+@api.route("/recommendations/stats")
+class RecommendationStats(Resource):
+    """Aggregate statistics about the Product Recommendations"""
+
+    # ------------------------------------------------------------------
+    # RETRIEVE THE STATISTICS
+    # ------------------------------------------------------------------
+    @api.doc("get_recommendation_stats")
+    @api.expect(stats_args, validate=True)
+    @tracing.marshalled(api.marshal_with(stats_model))
+    @rate_limited
+    def get(self):
+        """Returns counts by type, top products and degree distributions"""
+        app.logger.info("Request for Product Recommendation statistics")
+        args = stats_args.parse_args()
+        if not 0 < args["top_k"] <= 1000:
+            abort(status.HTTP_400_BAD_REQUEST, "top_k must be between 1 and 1000")
+        return Recommendation.stats(args["top_k"]), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/changes
 ######################################################################
+@api.route("/recommendations/changes")
+class RecommendationChanges(Resource):
+    """Feed of the Product Recommendations that were written or deleted"""
 
+    # ------------------------------------------------------------------
+    # RETRIEVE THE NEXT CHANGES
+    # ------------------------------------------------------------------
+    @api.doc("list_recommendation_changes")
+    @api.response(400, "The cursor or limit was not valid")
+    @api.expect(changes_args, validate=True)
+    @tracing.marshalled(api.marshal_with(changes_model))
+    @rate_limited
+    def get(self):
+        """
+        Returns the changes after a cursor
+
+        Consumers keep the next cursor and poll with it to stay in sync,
+        a batch shorter than the limit means they have caught up
+        """
+        args = changes_args.parse_args()
+        app.logger.info("Request for Product Recommendation changes since %s", args["since"])
+        if not 0 < args["limit"] <= 1000:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and 1000")
+        changes, cursor = Recommendation.changes(
+            args["since"], args["limit"], app.config.get("CHANGE_FEED_LAG", 0)
+        )
+        return {"changes": changes, "next": cursor}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/upsert
+######################################################################
+@api.route("/recommendations/upsert")
+class RecommendationUpsert(Resource):
+    """Creates or updates a Product Recommendation by its natural key"""
+
+    # ------------------------------------------------------------------
+    # UPSERT A PRODUCT RECOMMENDATION
+    # ------------------------------------------------------------------
+    @api.doc("upsert_recommendation", security="apikey")
+    @api.response(400, "The posted data was not valid")
+    @api.expect(create_model)
+    @tracing.marshalled(api.marshal_with(recommendation_model))
+    @rate_limited
+    def put(self):
+        """
+        Creates or updates a Product Recommendation
+
+        The product_id, recommended_product_id and recommendation_type identify
+        the recommendation, so the same request can safely be retried
+        """
+        app.logger.info("Request to upsert a Product Recommendation")
+        app.logger.debug("Payload = %s", api.payload)
+        recommendation = Recommendation.upsert(api.payload)
+        return recommendation, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/upsert/bulk
+######################################################################
+@api.route("/recommendations/upsert/bulk")
+class RecommendationBulkUpsert(Resource):
+    """Creates or updates many Product Recommendations by their natural key"""
+
+    # ------------------------------------------------------------------
+    # UPSERT A LIST OF PRODUCT RECOMMENDATIONS
+    # ------------------------------------------------------------------
+    @api.doc("upsert_recommendations", security="apikey")
+    @api.response(400, "The posted data was not valid")
+    @api.expect([create_model])
+    @tracing.marshalled(api.marshal_list_with(recommendation_model))
+    @rate_limited
+    def put(self):
+        """
+        Creates or updates a list of Product Recommendations
+
+        All of the recommendations are written in one transaction
+        """
+        app.logger.info("Request to upsert a list of Product Recommendations")
+        if not isinstance(api.payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Expected a list of Product Recommendations")
+        recommendations = Recommendation.upsert_many(api.payload)
+        app.logger.info("[%s] Product Recommendations upserted", len(recommendations))
+        return recommendations, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/batch
+######################################################################
+@api.route("/recommendations/batch")
+class RecommendationBatch(Resource):
+    """Applies many creates, updates and deletes in one request"""
+
+    # ------------------------------------------------------------------
+    # APPLY A BATCH OF OPERATIONS
+    # ------------------------------------------------------------------
+    @api.doc("apply_recommendation_batch", security="apikey")
+    @api.response(400, "The posted operations were not valid or the batch was rolled back")
+    @api.expect(batch_model)
+    @tracing.marshalled(api.marshal_with(batch_results_model))
+    @rate_limited
+    def post(self):
+        """
+        Applies an ordered list of operations in one transaction
+
+        Atomic batches are applied completely or not at all. Otherwise each
+        operation that fails is reported in its result and the rest apply
+        """
+        app.logger.info("Request to apply a batch of operations")
+        data = api.payload
+        operations = data.get("operations") if isinstance(data, dict) else None
+        if not isinstance(operations, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Expected a list of operations")
+        if len(operations) > app.config["MAX_BATCH_SIZE"]:
+            abort(status.HTTP_400_BAD_REQUEST, f"A batch holds at most {app.config['MAX_BATCH_SIZE']} operations")
+        results = Recommendation.apply_batch(operations, data.get("atomic", True) is not False)
+        app.logger.info("[%s] operations applied", len(results))
+        return {"results": results}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{id}/recommended-by
+######################################################################
+@api.route("/products/<int:product_id>/recommended-by")
+@api.param("product_id", "The recommended product")
+class ProductRecommendedBy(Resource):
+    """
+    The Product Recommendations that point at a product
+
+    GET /products/{id}/recommended-by - Returns a page of them
+    PUT /products/{id}/recommended-by - Suppresses or restores all of them
+    """
+
+    # ------------------------------------------------------------------
+    # LIST THE RECOMMENDATIONS OF A PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc("list_recommended_by")
+    @api.response(400, "The cursor or limit was not valid")
+    @api.expect(recommended_by_args, validate=True)
+    @tracing.marshalled(api.marshal_with(recommended_by_model))
+    @rate_limited
+    def get(self, product_id):
+        """Returns a page of the Product Recommendations that recommend a product"""
+        args = recommended_by_args.parse_args()
+        app.logger.info("Request for the recommendations of product [%s]", product_id)
+        if not 0 < args["limit"] <= 1000:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and 1000")
+        recommendations, cursor = Recommendation.recommended_by(
+            product_id, args["recommendation_type"], args["after"], args["limit"]
+        )
+        with tracing.span("serialize", rows=len(recommendations)):
+            results = [recommendation.serialize() for recommendation in recommendations]
+        return {"recommendations": results, "next": cursor}, status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # SUPPRESS THE RECOMMENDATIONS OF A PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc("suppress_recommended_by", security="apikey")
+    @api.response(400, "The posted data was not valid")
+    @api.expect(suppress_model)
+    @tracing.marshalled(api.marshal_with(suppressed_count_model))
+    @rate_limited
+    def put(self, product_id):
+        """
+        Suppresses or restores the Product Recommendations of a product
+
+        Suppressed recommendations are kept but left out of lookups by
+        product, for example while the product is out of stock
+        """
+        app.logger.info("Request to suppress the recommendations of product [%s]", product_id)
+        data = api.payload
+        if not isinstance(data, dict) or not isinstance(data.get("suppressed"), bool):
+            abort(status.HTTP_400_BAD_REQUEST, "suppressed must be true or false")
+        count = Recommendation.suppress_recommended(
+            product_id, data["suppressed"], data.get("recommendation_type")
+        )
+        app.logger.info("[%s] Product Recommendations changed", count)
+        return {"updated": count}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /admin/hot-keys
+######################################################################
+@api.route("/admin/hot-keys")
+class HotKeysResource(Resource):
+    """The most looked up products and ids of the worker that answers"""
+
+    # ------------------------------------------------------------------
+    # RETRIEVE THE HOT KEYS
+    # ------------------------------------------------------------------
+    @api.doc("get_hot_keys", security="apikey")
+    @api.response(401, "Invalid or missing token")
+    @api.expect(hot_keys_args, validate=True)
+    @token_required
+    @tracing.marshalled(api.marshal_with(hot_keys_model))
+    def get(self):
+        """
+        Returns the hottest product_id and id lookups
+
+        The counts are estimated by a count-min sketch in each worker, so
+        they may be a little high and only cover the worker that answers
+        """
+        args = hot_keys_args.parse_args()
+        if not 0 < args["limit"] <= app.config["HOT_KEYS_TOP_K"]:
+            abort(status.HTTP_400_BAD_REQUEST, f"limit must be between 1 and {app.config['HOT_KEYS_TOP_K']}")
+        result = {"worker": os.getpid(), "lookups": {}}
+        for kind, tracker in hot_keys.items():
+            result["lookups"][kind] = tracker.lookups
+            result[kind] = [{"key": key, "lookups": lookups} for key, lookups in tracker.top(args["limit"])]
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
 
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
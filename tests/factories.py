@@ -3,7 +3,7 @@ Test Factory to make fake objects for testing
 """
 
 import factory
-from factory.fuzzy import FuzzyChoice
+from factory.fuzzy import FuzzyChoice, FuzzyFloat
 from service.models import Recommendation
 
 
@@ -20,3 +20,4 @@ class RecommendationFactory(factory.Factory):
     product_id = factory.Faker("random_int", min=1, max=1000)
     recommended_product_id = factory.Faker("random_int", min=1, max=1000)
     recommendation_type = FuzzyChoice(["cross-sell", "up-sell", "accessory"])
+    score = FuzzyFloat(0, 1)
@@ -0,0 +1,185 @@
+"""
+Test cases for Admission Control
+"""
+
+import time
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask, request
+from werkzeug.exceptions import TooManyRequests
+from wsgi import app
+from service.common import admission, error_handlers, status
+from service.common.admission import TokenBucket, BucketStore, queue_time
+
+BASE_URL = "/api/recommendations"
+
+
+######################################################################
+#  T O K E N   B U C K E T   T E S T   C A S E S
+######################################################################
+class TestTokenBucket(TestCase):
+    """Token Bucket Tests"""
+
+    def test_consume_until_empty(self):
+        """It should allow a burst up to the capacity and then ask to wait"""
+        bucket = TokenBucket(rate=1.0, capacity=3)
+        for _ in range(3):
+            self.assertEqual(bucket.consume(), 0.0)
+        wait = bucket.consume()
+        self.assertGreater(wait, 0.0)
+        self.assertLessEqual(wait, 1.0)
+
+    def test_refill(self):
+        """It should refill tokens over time without exceeding capacity"""
+        bucket = TokenBucket(rate=10.0, capacity=2)
+        bucket.consume(2)
+        bucket.updated -= 10
+        self.assertEqual(bucket.consume(), 0.0)
+        self.assertAlmostEqual(bucket.tokens, 1.0, places=2)
+
+    def test_store_reuses_and_evicts(self):
+        """It should reuse buckets per key and evict the least recently used"""
+        store = BucketStore(max_keys=2)
+        first = store.get("a", 1.0, 5)
+        self.assertIs(store.get("a", 1.0, 5), first)
+        self.assertIsNot(store.get("a", 2.0, 5), first)
+        store.get("b", 1.0, 5)
+        store.get("c", 1.0, 5)
+        self.assertEqual(len(store), 2)
+        self.assertIsNot(store.get("a", 2.0, 5), first)
+        store.clear()
+        self.assertEqual(len(store), 0)
+
+    def test_queue_time(self):
+        """It should parse X-Request-Start in seconds, milliseconds and microseconds"""
+        started = time.time() - 2
+        self.assertAlmostEqual(queue_time(f"t={started:.3f}"), 2, places=0)
+        self.assertAlmostEqual(queue_time(str(int(started * 1e3))), 2, places=0)
+        self.assertAlmostEqual(queue_time(str(int(started * 1e6))), 2, places=0)
+        self.assertEqual(queue_time(None), 0.0)
+        self.assertEqual(queue_time("garbage"), 0.0)
+
+
+######################################################################
+#  A D M I S S I O N   R O U T E   T E S T   C A S E S
+######################################################################
+class TestAdmissionRoutes(TestCase):
+    """Rate Limiting and Load Shedding Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        admission.buckets.clear()
+        self.saved = {
+            key: app.config[key]
+            for key in (
+                "RATE_LIMIT_PER_KEY",
+                "RATE_LIMIT_GLOBAL",
+                "RATE_LIMIT_BURST",
+                "MAX_IN_FLIGHT",
+                "MAX_QUEUE_TIME_MS",
+            )
+        }
+
+    def tearDown(self):
+        """Restore the admission settings"""
+        app.config.update(self.saved)
+        admission.buckets.clear()
+
+    def test_rate_limit_per_key(self):
+        """It should return 429 with Retry-After once a client's bucket is empty"""
+        app.config.update(RATE_LIMIT_PER_KEY=0.1, RATE_LIMIT_BURST=2)
+        headers = {"X-Api-Key": app.config["API_KEY"]}
+        for _ in range(2):
+            response = self.client.get(f"{BASE_URL}/0", headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/0", headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+        # other clients are not affected
+        response = self.client.get(f"{BASE_URL}/0")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rate_limit_per_client_key(self):
+        """It should give every client in API_KEYS a bucket of its own"""
+        app.config.update(RATE_LIMIT_PER_KEY=0.1, RATE_LIMIT_BURST=2)
+        with patch.dict(app.config, {"API_KEYS": {"batch": "batch-key", "web": "web-key"}}):
+            statuses = [
+                self.client.get(f"{BASE_URL}/0", headers={"X-Api-Key": "batch-key"}).status_code for _ in range(3)
+            ]
+            self.assertEqual(statuses[-1], status.HTTP_429_TOO_MANY_REQUESTS)
+            response = self.client.get(f"{BASE_URL}/0", headers={"X-Api-Key": "web-key"})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(len(admission.buckets), 2)
+            response = self.client.get("/api/admin/hot-keys", headers={"X-Api-Key": "web-key"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get("/api/admin/hot-keys", headers={"X-Api-Key": "made-up"})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_forwarded_client_address(self):
+        """It should limit clients by their forwarded address behind trusted proxies"""
+        proxied = Flask("proxied")
+        proxied.config.update(app.config, PROXY_FIX_HOPS=1)
+        proxied.add_url_rule("/", "address", lambda: request.remote_addr)
+        admission.init_admission(proxied)
+        response = proxied.test_client().get("/", headers={"X-Forwarded-For": "10.1.2.3"})
+        self.assertEqual(response.get_data(as_text=True), "10.1.2.3")
+
+    def test_rate_limit_made_up_keys(self):
+        """It should limit made up API keys by the address of the client"""
+        app.config.update(RATE_LIMIT_PER_KEY=0.1, RATE_LIMIT_BURST=2)
+        statuses = [
+            self.client.get(f"{BASE_URL}/0", headers={"X-Api-Key": f"random-{i}"}).status_code for i in range(3)
+        ]
+        self.assertEqual(statuses[-1], status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(len(admission.buckets), 1)
+        response = self.client.get(f"{BASE_URL}/0", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rate_limit_global(self):
+        """It should return 429 once the global bucket is empty"""
+        app.config.update(RATE_LIMIT_GLOBAL=0.1, RATE_LIMIT_BURST=1)
+        response = self.client.get(f"{BASE_URL}/0", headers={"X-Api-Key": "a"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/0", headers={"X-Api-Key": "b"})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_shed_on_in_flight(self):
+        """It should return 503 with Retry-After when too many requests are in flight"""
+        app.config.update(MAX_IN_FLIGHT=1)
+        with patch.object(admission.in_flight, "count", 1):
+            response = self.client.get("/")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(response.get_json()["error"], "Service Unavailable")
+        self.assertEqual(admission.in_flight.count, 0)
+
+    def test_shed_on_queue_time(self):
+        """It should return 503 when a request waited too long in the ingress queue"""
+        app.config.update(MAX_QUEUE_TIME_MS=100)
+        started = f"t={time.time() - 5:.3f}"
+        response = self.client.get(f"{BASE_URL}/0", headers={"X-Request-Start": started})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response.headers)
+        response = self.client.get(f"{BASE_URL}/0", headers={"X-Request-Start": f"t={time.time():.3f}"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(admission.in_flight.count, 0)
+
+    def test_too_many_requests_handler(self):
+        """It should format a 429 with a Retry-After header"""
+        with app.test_request_context("/"):
+            body, code, headers = error_handlers.too_many_requests(
+                TooManyRequests("slow down", retry_after=3)
+            )
+        self.assertEqual(code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(body.get_json()["error"], "Too Many Requests")
+        self.assertEqual(headers["Retry-After"], "3")
@@ -0,0 +1,356 @@
+"""
+Test cases for the Caches
+"""
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from service.common.cache import NameMap, SharedCache, StaleCache, TTLCache, SingleFlight, MISSING
+from service.common.cache import FAILED, FRESH, STALE
+
+
+######################################################################
+#  T T L   C A C H E   T E S T   C A S E S
+######################################################################
+class TestTTLCache(TestCase):
+    """TTL Cache Tests"""
+
+    def test_get_and_set(self):
+        """It should return what was stored until it is cleared"""
+        cache = TTLCache(ttl=60)
+        self.assertIs(cache.get("key"), MISSING)
+        self.assertIsNone(cache.get("key", None))
+        cache.set("key", [1, 2])
+        self.assertEqual(cache.get("key"), [1, 2])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_expiry(self):
+        """It should forget entries after the time to live"""
+        cache = TTLCache(ttl=0)
+        cache.set("key", "value")
+        self.assertIs(cache.get("key"), MISSING)
+        self.assertEqual(len(cache), 0)
+
+    def test_max_size(self):
+        """It should evict the least recently used entry when full"""
+        cache = TTLCache(ttl=60, max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("c"), 3)
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def _wait_for(self, condition):
+        """Waits up to a second for condition() to be true"""
+        deadline = time.monotonic() + 1
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(condition())
+
+    def test_share_call(self):
+        """It should run one call for the callers of the same key in flight"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def read():
+            calls.append(1)
+            release.wait(1)
+            return [len(calls)]
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            leader = pool.submit(flight.do, "key", read)
+            self._wait_for(lambda: len(flight) == 1)
+            followers = [pool.submit(flight.do, "key", read) for _ in range(3)]
+            self._wait_for(lambda: flight.joined == 3)
+            release.set()
+            results = [future.result() for future in [leader, *followers]]
+        self.assertEqual(results, [[1]] * 4)
+        self.assertIs(results[0], results[3])
+        self.assertEqual(len(flight), 0)
+        self.assertEqual(flight.do("key", read), [2])
+
+    def test_share_error(self):
+        """It should raise the error of the call to every caller in flight"""
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(1)
+            raise ValueError("boom")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            leader = pool.submit(flight.do, "key", fail)
+            self._wait_for(lambda: len(flight) == 1)
+            follower = pool.submit(flight.do, "key", fail)
+            self._wait_for(lambda: flight.joined == 1)
+            release.set()
+            self.assertRaises(ValueError, leader.result)
+            self.assertRaises(ValueError, follower.result)
+
+    def test_retry_error(self):
+        """It should run the call again for each caller when it fails with a retried error"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def read():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(1)
+                raise TimeoutError("out of time")
+            return "read"
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            leader = pool.submit(flight.do, "key", read, retry_on=(TimeoutError,))
+            self._wait_for(lambda: len(flight) == 1)
+            followers = [pool.submit(flight.do, "key", read, retry_on=(TimeoutError,)) for _ in range(2)]
+            self._wait_for(lambda: flight.joined == 2)
+            release.set()
+            self.assertRaises(TimeoutError, leader.result)
+            self.assertEqual([future.result() for future in followers], ["read", "read"])
+        self.assertEqual(len(calls), 3)
+
+    def test_timeout_and_forget(self):
+        """It should stop waiting at the timeout and start anew after forget"""
+        flight = SingleFlight()
+        release = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(flight.do, "key", lambda: release.wait(1) and "old")
+            self._wait_for(lambda: len(flight) == 1)
+            self.assertRaises(TimeoutError, flight.do, "key", lambda: "new", timeout=0.01)
+            flight.forget()
+            self.assertEqual(flight.do("key", lambda: "new"), "new")
+            release.set()
+            self.assertEqual(leader.result(), "old")
+
+
+def _write_in_child(cache):
+    """Writes to the cache from a forked worker"""
+    cache.set("from-child", b"hello", cache.generation)
+    cache.invalidate()
+    cache.set("after", b"new", cache.generation)
+
+
+######################################################################
+#  S T A L E   C A C H E   T E S T   C A S E S
+######################################################################
+class TestStaleCache(TestCase):
+    """Stale While Revalidate Cache Tests"""
+
+    def setUp(self):
+        self.cache = StaleCache(soft_ttl=60, hard_ttl=60, stale_if_error=60, errors=(ConnectionError,))
+
+    def test_fresh(self):
+        """It should read a missing key once and serve it until its soft TTL"""
+        calls = []
+
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(self.cache.get("key", load), (1, 0.0, FRESH))
+        value, age, freshness = self.cache.get("key", load)
+        self.assertEqual((value, freshness), (1, FRESH))
+        self.assertGreater(age, 0)
+        self.assertEqual(len(calls), 1)
+        self.cache.soft_ttl = self.cache.hard_ttl = 0
+        self.assertEqual(self.cache.get("key", load)[0], 2)
+
+    def test_stale_while_revalidate(self):
+        """It should serve a stale entry at once and read it again in the background"""
+        refreshed = threading.Event()
+        release = threading.Event()
+
+        def refresh():
+            release.wait(5)
+            refreshed.set()
+            return "new"
+
+        self.cache.get("key", lambda: "old")
+        self.cache.soft_ttl = 0
+        self.assertEqual(self.cache.get("key", None, refresh)[::2], ("old", STALE))
+        # a refresh already running is not started again
+        self.assertEqual(self.cache.get("key", None, self.fail)[::2], ("old", STALE))
+        release.set()
+        self.assertTrue(refreshed.wait(5))
+        self.cache.soft_ttl = 60
+        for _ in range(50):
+            if self.cache.get("key", None)[0] == "new":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get("key", None)[::2], ("new", FRESH))
+
+    def test_refresh_after_write(self):
+        """It should not store a refresh that was read before a write"""
+        release = threading.Event()
+        self.cache.get("key", lambda: "old")
+        self.cache.soft_ttl = 0
+        self.cache.get("key", None, lambda: release.wait(5) and "before the write")
+        self.cache.expire()
+        release.set()
+        for _ in range(500):
+            if not self.cache._refreshing:  # pylint: disable=protected-access
+                break
+            time.sleep(0.01)
+        self.cache.soft_ttl = 60
+        self.assertEqual(self.cache.get("key", lambda: "after the write")[::2], ("after the write", FRESH))
+
+    def test_serve_stale_on_error(self):
+        """It should serve an expired entry while the database is down"""
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise ConnectionError("database is down")
+
+        self.cache.get("key", lambda: "old")
+        self.cache.expire()
+        self.assertEqual(self.cache.get("key", down)[::2], ("old", FAILED))
+        self.assertEqual(self.cache.get("key", down)[::2], ("old", FAILED))
+        self.assertEqual(len(calls), 1)  # the second one did not wait on the database
+        with self.assertRaises(ConnectionError):
+            self.cache.get("other", down)
+        self.cache.failed_until = 0
+        with self.assertRaises(TypeError):
+            self.cache.get("key", lambda: None + 1)
+        self.cache.stale_if_error = 0
+        self.cache.hard_ttl = 0
+        with self.assertRaises(ConnectionError):
+            self.cache.get("key", down)
+        self.assertEqual(self.cache.get("key", lambda: "back"), ("back", 0.0, FRESH))
+        self.assertEqual(self.cache.failed_until, 0)
+
+    def test_max_size(self):
+        """It should drop the least recently used entries"""
+        self.cache.max_size = 2
+        for key in "abc":
+            self.cache.get(key, lambda key=key: key)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get("a", lambda: "again")[0], "again")
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+######################################################################
+#  S H A R E D   C A C H E   T E S T   C A S E S
+######################################################################
+class TestSharedCache(TestCase):
+    """Shared Cache Tests"""
+
+    def setUp(self):
+        self.cache = SharedCache()
+        self.cache.open(4096, slot_size=1024, ttl=60)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_and_set(self):
+        """It should return what was stored for the same key only"""
+        self.assertEqual(self.cache.slots, 3)
+        self.assertIsNone(self.cache.get("key"))
+        self.assertTrue(self.cache.set("key", b'[{"id": 1}]', self.cache.generation))
+        self.assertEqual(self.cache.get("key"), b'[{"id": 1}]')
+        self.assertTrue(self.cache.set("key", b"[]", self.cache.generation))
+        self.assertEqual(self.cache.get("key"), b"[]")
+        self.cache.open(1024, slot_size=1024)
+        self.cache.set("key", b"[]", self.cache.generation)
+        self.cache.set("other", b"[]", self.cache.generation)
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(self.cache.set("key", b"x" * 1024, self.cache.generation))
+        self.assertFalse(self.cache.set("k" * 65, b"", self.cache.generation))
+
+    def test_invalidate(self):
+        """It should not store or return values read before an invalidate"""
+        generation = self.cache.generation
+        self.cache.set("key", b"old", generation)
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(self.cache.set("key", b"old", generation))
+        self.assertTrue(self.cache.set("key", b"new", self.cache.generation))
+        self.assertEqual(self.cache.get("key"), b"new")
+
+    def test_expiry_and_close(self):
+        """It should forget entries after the time to live and when closed"""
+        self.cache.ttl = 0
+        self.cache.set("key", b"value", self.cache.generation)
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.close()
+        self.assertFalse(self.cache.enabled)
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(self.cache.set("key", b"value", 0))
+        self.cache.invalidate()
+        self.assertEqual(self.cache.generation, 0)
+
+    def test_shared_with_forked_workers(self):
+        """It should share entries and invalidations with forked processes"""
+        self.cache.set("from-parent", b"hi", self.cache.generation)
+        child = multiprocessing.get_context("fork").Process(target=_write_in_child, args=(self.cache,))
+        child.start()
+        child.join(5)
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(self.cache.generation, 1)
+        self.assertIsNone(self.cache.get("from-parent"))
+        self.assertIsNone(self.cache.get("from-child"))
+        self.assertEqual(self.cache.get("after"), b"new")
+
+
+######################################################################
+#  N A M E   M A P   T E S T   C A S E S
+######################################################################
+class TestNameMap(TestCase):
+    """Name Map Tests"""
+
+    def test_lookup_and_add(self):
+        """It should read the table only for names and ids it does not know"""
+        rows = [(1, "up-sell")]
+        loads = []
+
+        def load():
+            loads.append(1)
+            return list(rows)
+
+        names = NameMap(load)
+        self.assertEqual(names.id_of("up-sell"), 1)
+        self.assertEqual(names.name_of(1), "up-sell")
+        self.assertEqual(len(loads), 1)
+        self.assertIsNone(names.id_of("cross-sell"))
+        names.add(2, "cross-sell")
+        self.assertEqual(names.id_of("cross-sell"), 2)
+        self.assertEqual(names.name_of(2), "cross-sell")
+        self.assertEqual(len(names), 2)
+        self.assertIsNone(names.name_of(3))
+        rows.append((2, "cross-sell"))
+        names.clear()
+        self.assertEqual(names.id_of("cross-sell"), 2)
+
+    def test_missing_names(self):
+        """It should not read the table again for a name it just missed"""
+        rows = []
+        loads = []
+
+        def load():
+            loads.append(1)
+            return list(rows)
+
+        names = NameMap(load, miss_ttl=60)
+        for _ in range(3):
+            self.assertIsNone(names.id_of("made-up"))
+        self.assertEqual(len(loads), 1)
+        rows.append((1, "made-up"))
+        self.assertIsNone(names.id_of("made-up"))
+        names.clear()
+        self.assertEqual(names.id_of("made-up"), 1)
+        self.assertEqual(len(loads), 2)
@@ -2,12 +2,23 @@
 CLI Command Extensions for Flask
 """
 import os
+import tempfile
+from datetime import timedelta
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.models import Recommendation
+from service.common.cli_commands import (  # noqa: E402
+    bench_reads,
+    db_create,
+    db_dedup,
+    db_partition,
+    db_purge_tombstones,
+    recommend_cooccurrence,
+    recommend_similar,
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -23,3 +34,107 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.db')
+    @patch('service.common.cli_commands.Recommendation')
+    def test_db_dedup(self, recommendation_mock, db_mock):
+        """It should call the db-dedup command"""
+        recommendation_mock.remove_duplicates.return_value = 3
+        index = MagicMock()
+        recommendation_mock.__table__ = MagicMock(indexes=[index])
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_dedup, ["--batch-size", "50"])
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Removed 3 duplicate recommendations", result.output)
+        recommendation_mock.remove_duplicates.assert_called_once_with(50)
+        index.create.assert_called_once_with(db_mock.engine, checkfirst=True)
+
+    @patch('service.common.cli_commands.create_search_indexes')
+    @patch('service.common.cli_commands.partitioning')
+    @patch('service.common.cli_commands.db')
+    def test_db_partition(self, db_mock, partitioning_mock, create_search_indexes_mock):
+        """It should call the db-partition command"""
+        db_mock.engine.dialect.name = "postgresql"
+        partitioning_mock.migrate.return_value = 7
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_partition, ["--partitions", "4", "--drop-old"])
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Copied 7 recommendations into 4 partitions", result.output)
+        self.assertEqual(partitioning_mock.migrate.call_args.args[2:], (4, 10000))
+        create_search_indexes_mock.assert_called_once()
+        db_mock.engine.begin.assert_called_once()
+
+    @patch('service.common.cli_commands.db')
+    def test_db_partition_needs_postgresql(self, db_mock):
+        """It should refuse to partition other databases"""
+        db_mock.engine.dialect.name = "sqlite"
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_partition)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Partitioning needs PostgreSQL", result.output)
+
+    @patch('service.common.cli_commands.Tombstone')
+    def test_db_purge_tombstones(self, tombstone_mock):
+        """It should call the db-purge-tombstones command"""
+        tombstone_mock.purge.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_purge_tombstones, ["--days", "7"])
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 2 tombstones older than 7 days", result.output)
+        tombstone_mock.purge.assert_called_once_with(timedelta(days=7))
+
+    @patch('service.common.cli_commands.Recommendation')
+    def test_recommend_cooccurrence(self, recommendation_mock):
+        """It should call the recommend-cooccurrence command"""
+        recommendation_mock.replace_generated.return_value = (2, 0)
+        log = "order_id,product_id\n1,10\n1,20\n2,10\n2,20\n3,30\n"
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(
+                recommend_cooccurrence, ["-", "--format", "csv", "--top-n", "5", "--shards", "1"], input=log
+            )
+            self.assertEqual(result.exit_code, 0)
+        self.assertIn("Counted 3 orders, 3 products and 1 pairs", result.output)
+        self.assertIn("Wrote 2 recommendations for 3 products, removed 0", result.output)
+        kind, top, _, batch_size = recommendation_mock.replace_generated.call_args.args
+        self.assertEqual((kind, batch_size), ("cross-sell", 1000))
+        # 30 was bought alone, so its older cross-sells are removed
+        self.assertEqual(top, [(10, [(20, 1.5)]), (20, [(10, 1.5)]), (30, [])])
+
+    def test_recommend_cooccurrence_bad_log(self):
+        """It should report order events it cannot read"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(recommend_cooccurrence, ["-"], input='{"order_id": 1}\n')
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Invalid order event", result.output)
+
+    @patch('service.common.cli_commands.Recommendation')
+    def test_recommend_similar(self, recommendation_mock):
+        """It should call the recommend-similar command"""
+        recommendation_mock.replace_generated.side_effect = lambda kind, rows, name, size: (len(list(rows)), 1)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "vectors.csv")
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("1,1,0\n2,1,1\n")
+            with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+                result = self.runner.invoke(recommend_similar, [path, "--top-k", "3", "--shards", "1"])
+                self.assertEqual(result.exit_code, 0)
+                self.assertIn("Wrote 2 recommendations for 2 products, removed 1", result.output)
+                result = self.runner.invoke(recommend_similar, [os.path.join(folder, "missing.npy")])
+                self.assertEqual(result.exit_code, 2)
+                with open(path, "w", encoding="utf-8") as file:
+                    file.write("1,1,0\n2,1\n")
+                result = self.runner.invoke(recommend_similar, [path])
+                self.assertEqual(result.exit_code, 1)
+                self.assertIn("same length", result.output)
+
+    def test_bench_reads(self):
+        """It should compare the read paths and leave the table as it was"""
+        with app.app_context():
+            before = Recommendation.query.count()
+            with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+                result = self.runner.invoke(bench_reads, ["--rows", "20", "--repeat", "1"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn(f"Reading {before + 20} recommendations", result.output)
+            self.assertRegex(result.output, r"orm: +[\d,]+ rows/s +[\d.]+ MiB peak")
+            self.assertRegex(result.output, r"core: +[\d,]+ rows/s")
+            self.assertEqual(Recommendation.query.count(), before)
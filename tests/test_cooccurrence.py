@@ -0,0 +1,88 @@
+"""
+Test cases for the Co-occurrence Engine
+"""
+
+import io
+import math
+from unittest import TestCase
+from unittest.mock import patch
+from service.common.cooccurrence import CooccurrenceMatrix, read_baskets, read_events
+
+
+######################################################################
+#  C O - O C C U R R E N C E   T E S T   C A S E S
+######################################################################
+class TestCooccurrence(TestCase):
+    """Co-occurrence Engine Tests"""
+
+    def setUp(self):
+        self.matrix = CooccurrenceMatrix(max_basket_size=3)
+        for basket in ({1, 2}, {1, 2, 3}, {1, 3}, {4}, {1, 2, 3, 4}):
+            self.matrix.add(basket)
+
+    def test_read_events(self):
+        """It should read order events from CSV and NDJSON"""
+        csv_log = io.StringIO("order_id,product_id\na,1\na,2\n")
+        self.assertEqual(list(read_events(csv_log)), [("a", 1), ("a", 2)])
+        ndjson_log = io.StringIO('{"order_id": 7, "product_id": 3}\n\n')
+        self.assertEqual(list(read_events(ndjson_log, "ndjson")), [("7", 3)])
+        bad_log = io.StringIO("order_id,product_id\na,shoe\n")
+        self.assertRaises(ValueError, list, read_events(bad_log))
+
+    def test_read_baskets(self):
+        """It should group the events of an order across chunks"""
+        events = [("a", 1), ("b", 5), ("a", 2), ("c", 1), ("a", 3), ("d", 4), ("d", 4)]
+        baskets = list(read_baskets(events, chunk_size=2))
+        self.assertEqual(sorted(map(sorted, baskets)), [[1], [1, 2, 3], [4], [5]])
+
+    def test_counts(self):
+        """It should count orders per product and pair, skipping large orders"""
+        self.assertEqual(self.matrix.orders, 4)
+        self.assertEqual(self.matrix.skipped, 1)
+        first, second, counts = self.matrix.pairs()
+        self.assertEqual(dict(zip(self.matrix.product_ids.tolist(), self.matrix.product_counts.tolist()))[1], 3)
+        pairs = dict(zip(zip(first.tolist(), second.tolist()), counts.tolist()))
+        self.assertEqual(pairs[(1, 2)], 2)
+        self.assertNotIn((2, 1), pairs)
+
+    def test_counts_across_chunks(self):
+        """It should merge the counts of every chunk of baskets"""
+        matrix = CooccurrenceMatrix(chunk_size=2)
+        for basket in ({1, 2}, {-5, 2}, {1, 2, 3}, {2**31 - 1, -(2**31)}, {7}):
+            matrix.add(basket)
+        first, second, counts = matrix.pairs()
+        pairs = dict(zip(zip(first.tolist(), second.tolist()), counts.tolist()))
+        self.assertEqual(pairs, {(1, 2): 2, (-5, 2): 1, (1, 3): 1, (2, 3): 1, (-(2**31), 2**31 - 1): 1})
+        self.assertEqual(matrix.product_counts[matrix.product_ids == 2].tolist(), [3])
+        matrix.add({2**31})
+        self.assertRaises(ValueError, matrix.flush)
+
+    def test_scores(self):
+        """It should score pairs both ways by lift or PMI"""
+        lift = {(a, b): score for a, b, score in zip(*self.matrix.scores("lift", min_count=1))}
+        self.assertAlmostEqual(lift[(1, 2)], 2 * 4 / (3 * 2))
+        self.assertEqual(lift[(1, 2)], lift[(2, 1)])
+        pmi = {(a, b): score for a, b, score in zip(*self.matrix.scores("pmi", min_count=2))}
+        self.assertAlmostEqual(pmi[(1, 3)], math.log2(lift[(1, 3)]))
+        self.assertNotIn((2, 3), pmi)
+
+    def test_top(self):
+        """It should keep the best scored products of each product"""
+        top = dict(self.matrix.top(top_n=1, min_count=1))
+        self.assertEqual(top[3], [(1, 4 / 3)])
+        # 2 and 3 tie for product 1, the lower id wins
+        self.assertEqual(top[1], [(2, 4 / 3)])
+        self.assertEqual(top[4], [])
+
+    def test_top_shard(self):
+        """It should list every product in a shard, scored or not"""
+        self.matrix.add({6})
+        self.assertEqual([product_id for product_id, _ in self.matrix.top(min_count=1, shard=(0, 2))], [2, 4, 6])
+        self.assertEqual(dict(self.matrix.top(min_count=3, shard=(0, 2))), {2: [], 4: [], 6: []})
+
+    def test_rank_once(self):
+        """It should rank the pairs once for every shard"""
+        with patch.object(self.matrix, "scores", wraps=self.matrix.scores) as scores:
+            for shard in range(4):
+                list(self.matrix.top(shard=(shard, 4)))
+            self.assertEqual(scores.call_count, 1)
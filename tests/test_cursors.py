@@ -0,0 +1,26 @@
+"""
+Test cases for the Pagination Cursors
+"""
+
+from datetime import datetime, timezone
+from unittest import TestCase
+from service.common import cursors
+
+
+######################################################################
+#  C U R S O R   T E S T   C A S E S
+######################################################################
+class TestCursors(TestCase):
+    """Cursor Tests"""
+
+    def test_round_trip(self):
+        """It should decode the values a cursor was encoded with"""
+        changed_at = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        cursor = cursors.encode(changed_at, 42)
+        self.assertEqual(cursors.decode(cursor, datetime, int), (changed_at, 42))
+        self.assertEqual(cursors.decode(cursors.encode(7), int), (7,))
+
+    def test_invalid_cursors(self):
+        """It should not decode cursors it did not make"""
+        for cursor in ("nonsense", "!!", cursors.encode(1), cursors.encode("yesterday", 1), cursors.encode({}, 1)):
+            self.assertRaises(ValueError, cursors.decode, cursor, datetime, int)
@@ -0,0 +1,85 @@
+"""
+Test cases for the Gunicorn configuration
+"""
+
+import os
+import runpy
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+CONFIG = os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py")
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConf(TestCase):
+    """Gunicorn Configuration Tests"""
+
+    def setUp(self):
+        with patch.dict(os.environ, {"WEB_CONCURRENCY": "3"}):
+            self.conf = runpy.run_path(CONFIG)
+        self.root = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.root.cleanup)
+
+    def _write(self, path, content):
+        path = os.path.join(self.root.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content + "\n")
+
+    def test_settings(self):
+        """It should read the overrides from the environment"""
+        self.assertEqual(self.conf["workers"], 3)
+        self.assertEqual(self.conf["worker_class"], "gthread")
+        self.assertTrue(self.conf["preload_app"])
+        self.assertEqual(self.conf["max_requests_jitter"], 100)
+
+    def test_async_workers_not_preloaded(self):
+        """It should not preload the app for workers that patch the standard library"""
+        for worker_class in ("gevent", "eventlet"):
+            with patch.dict(os.environ, {"WEB_CONCURRENCY": "3", "GUNICORN_WORKER_CLASS": worker_class}):
+                self.assertFalse(runpy.run_path(CONFIG)["preload_app"])
+        env = {"WEB_CONCURRENCY": "3", "GUNICORN_WORKER_CLASS": "gevent", "GUNICORN_PRELOAD": "true"}
+        with patch.dict(os.environ, env):
+            self.assertTrue(runpy.run_path(CONFIG)["preload_app"])
+
+    def test_cgroup_v2_limits(self):
+        """It should read the CPU and memory limits of cgroup v2"""
+        self._write("cpu.max", "50000 100000")
+        self._write("memory.max", str(128 * 2**20))
+        self.assertEqual(self.conf["cpu_limit"](self.root.name), 0.5)
+        self.assertEqual(self.conf["memory_limit"](self.root.name), 128 * 2**20)
+        self._write("cpu.max", "max 100000")
+        self._write("memory.max", "max")
+        self.assertEqual(self.conf["cpu_limit"](self.root.name), os.cpu_count())
+        self.assertIsNone(self.conf["memory_limit"](self.root.name))
+
+    def test_cgroup_v1_limits(self):
+        """It should read the CPU and memory limits of cgroup v1"""
+        self._write("cpu/cpu.cfs_quota_us", "200000")
+        self._write("cpu/cpu.cfs_period_us", "100000")
+        self._write("memory/memory.limit_in_bytes", str(2**63 - 4096))
+        self.assertEqual(self.conf["cpu_limit"](self.root.name), 2)
+        self.assertIsNone(self.conf["memory_limit"](self.root.name))
+
+    def test_worker_count(self):
+        """It should size the workers to the CPUs and memory"""
+        worker_count = self.conf["worker_count"]
+        self.assertEqual(worker_count(0.5), 2)
+        self.assertEqual(worker_count(2), 5)
+        self.assertEqual(worker_count(2, 128 * 2**20, 64), 2)
+        self.assertEqual(worker_count(2, 32 * 2**20, 64), 1)
+
+    def test_post_fork(self):
+        """It should drop inherited connections and restart the log listener"""
+        server = MagicMock()
+        with patch("service.models.db") as db, \
+                patch("service.common.log_handlers.restart_listener") as restart_listener:
+            self.conf["post_fork"](server, MagicMock())
+            db.engine.dispose.assert_called_once_with(close=False)
+            restart_listener.assert_called_once()
+            server.cfg.preload_app = False
+            self.conf["post_fork"](server, MagicMock())
+            restart_listener.assert_called_once()
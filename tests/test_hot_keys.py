@@ -0,0 +1,134 @@
+"""
+Test cases for Hot Key Detection
+"""
+
+import threading
+from unittest import TestCase
+from service.common.hot_keys import CountMinSketch, HotKeys, Refresher
+
+
+######################################################################
+#  C O U N T - M I N   S K E T C H   T E S T   C A S E S
+######################################################################
+class TestCountMinSketch(TestCase):
+    """Count-Min Sketch Tests"""
+
+    def test_estimates(self):
+        """It should never estimate a count below the true count"""
+        sketch = CountMinSketch(width=64, depth=4)
+        counts = {key: key % 7 + 1 for key in range(200)}
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.add(key, count), count)
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(sum(sketch.counters), 4 * sum(counts.values()))
+
+    def test_exact_when_wide(self):
+        """It should count exactly when there are few keys for the width"""
+        sketch = CountMinSketch(width=4096, depth=4)
+        for _ in range(5):
+            sketch.add("hot")
+        sketch.add("cold")
+        self.assertEqual(sketch.estimate("hot"), 5)
+        self.assertEqual(sketch.estimate("cold"), 1)
+        self.assertEqual(sketch.estimate("never"), 0)
+
+    def test_halve_and_clear(self):
+        """It should halve and clear every counter"""
+        sketch = CountMinSketch(width=256, depth=2)
+        sketch.add(1, 9)
+        sketch.halve()
+        self.assertEqual(sketch.estimate(1), 4)
+        sketch.clear()
+        self.assertEqual(sketch.estimate(1), 0)
+
+
+######################################################################
+#  H O T   K E Y S   T E S T   C A S E S
+######################################################################
+class TestHotKeys(TestCase):
+    """Hot Key Tracker Tests"""
+
+    def test_top_keys(self):
+        """It should keep the heaviest hitters in a bounded heap"""
+        tracker = HotKeys(top_k=3, width=1024, depth=4)
+        for key in range(1, 51):
+            for _ in range(key if key % 10 == 0 else 1):
+                tracker.record(key)
+        self.assertEqual(len(tracker), 3)
+        self.assertEqual(tracker.top(), [(50, 50), (40, 40), (30, 30)])
+        self.assertEqual(tracker.top(1), [(50, 50)])
+        self.assertEqual(tracker.lookups, 45 + 150)
+        self.assertLessEqual(len(tracker._heap), 4 * tracker.top_k)  # pylint: disable=protected-access
+
+    def test_new_hot_key(self):
+        """It should let a key that turns hot push out the coldest one"""
+        tracker = HotKeys(top_k=2, width=1024)
+        for key, count in ((1, 5), (2, 3)):
+            for _ in range(count):
+                tracker.record(key)
+        for _ in range(4):
+            tracker.record(3)
+        self.assertEqual(tracker.top(), [(1, 5), (3, 4)])
+
+    def test_decay(self):
+        """It should halve the counts and drop the keys that fade away"""
+        tracker = HotKeys(top_k=10, width=1024)
+        for _ in range(6):
+            tracker.record("hot")
+        tracker.record("cold")
+        tracker.decay()
+        self.assertEqual(tracker.top(), [("hot", 3)])
+        self.assertEqual(tracker.lookups, 3)
+        tracker.record("hot")
+        self.assertEqual(tracker.top(), [("hot", 4)])
+        tracker.clear()
+        self.assertEqual((tracker.top(), tracker.lookups), ([], 0))
+
+    def test_concurrent_records(self):
+        """It should count every lookup made from many threads"""
+        tracker = HotKeys(top_k=5, width=1024)
+
+        def lookups():
+            for key in range(100):
+                tracker.record(key % 5)
+
+        threads = [threading.Thread(target=lookups) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tracker.lookups, 400)
+        self.assertEqual(sorted(tracker.top()), [(key, 80) for key in range(5)])
+
+
+######################################################################
+#  R E F R E S H E R   T E S T   C A S E S
+######################################################################
+class TestRefresher(TestCase):
+    """Periodic Refresh Tests"""
+
+    def test_refresh(self):
+        """It should call the function every interval from one thread per process"""
+        calls = []
+        refreshed = threading.Event()
+
+        def refresh():
+            calls.append(1)
+            if len(calls) == 2:
+                refreshed.set()
+            raise RuntimeError("keeps going")
+
+        refresher = Refresher(0.01, refresh)
+        refresher.ensure_started()
+        refresher.ensure_started()
+        try:
+            self.assertTrue(refreshed.wait(timeout=5))
+        finally:
+            refresher.stop()
+
+    def test_disabled(self):
+        """It should not start a thread without an interval"""
+        refresher = Refresher(0, lambda: None)
+        refresher.ensure_started()
+        self.assertIsNone(refresher._pid)  # pylint: disable=protected-access
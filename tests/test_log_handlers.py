@@ -0,0 +1,137 @@
+"""
+Test cases for the Log Handlers
+"""
+
+import sys
+import json
+import logging
+from logging.handlers import QueueHandler
+from unittest import TestCase
+from flask import Flask
+from service.common import log_handlers
+from service.common.log_handlers import (
+    SamplingFilter,
+    RateLimitFilter,
+    RequestContextFilter,
+    JsonFormatter,
+)
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted records in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def make_record(name="service", level=logging.INFO, msg="Processing lookup for id %s ..."):
+    """Creates a log record the way a logger would"""
+    return logging.LogRecord(name, level, __file__, 1, msg, (1,), None)
+
+
+######################################################################
+#  L O G   H A N D L E R   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Log Handler Tests"""
+
+    def setUp(self):
+        """Creates a throw away app logging to a list"""
+        self.handler = ListHandler()
+        self.gunicorn_logger = logging.getLogger("test.gunicorn")
+        self.gunicorn_logger.handlers = [self.handler]
+        self.gunicorn_logger.setLevel(logging.INFO)
+        self.app = Flask("logtest")
+
+        @self.app.route("/")
+        def index():
+            self.app.logger.info("Handling request")
+            return ""
+
+    def tearDown(self):
+        """Stops any listener that was started"""
+        log_handlers.stop_listener()
+
+    def test_sampling_filter(self):
+        """It should keep one in N records below WARNING for sampled loggers"""
+        sampler = SamplingFilter({"service": 0.25, "other": 1.0})
+        kept = [sampler.filter(make_record()) for _ in range(8)]
+        self.assertEqual(kept.count(True), 2)
+        self.assertTrue(sampler.filter(make_record(level=logging.WARNING)))
+        self.assertTrue(all(sampler.filter(make_record(name="other")) for _ in range(4)))
+
+    def test_rate_limit_filter(self):
+        """It should drop repeats of a message past its burst"""
+        limiter = RateLimitFilter(per_second=0.001, burst=3)
+        kept = [limiter.filter(make_record()) for _ in range(5)]
+        self.assertEqual(kept, [True, True, True, False, False])
+        self.assertTrue(limiter.filter(make_record(msg="Another message")))
+        self.assertTrue(limiter.filter(make_record(level=logging.ERROR)))
+        limiter.max_keys = 1
+        self.assertTrue(limiter.filter(make_record(msg="Yet another message")))
+        self.assertEqual(len(limiter.buckets), 1)
+
+    def test_json_formatter(self):
+        """It should format records as JSON with the request id and latency"""
+        record = make_record()
+        RequestContextFilter().filter(record)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "Processing lookup for id 1 ...")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertIsNone(entry["request_id"])
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = self.gunicorn_logger.makeRecord(
+                "service", logging.ERROR, __file__, 1, "failed", (), sys.exc_info()
+            )
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertIn("ValueError: boom", entry["exception"])
+
+    def test_text_logging(self):
+        """It should log through the gunicorn handlers in text by default"""
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.assertEqual(self.app.logger.handlers, [self.handler])
+        self.assertIsNone(log_handlers.listener)
+        self.assertIn("[INFO] [log_handlers] Logging handler established", self.handler.lines[-1])
+
+    def test_restart_listener(self):
+        """It should start a new listener on the same queue after a fork"""
+        log_handlers.restart_listener()
+        self.assertIsNone(log_handlers.listener)
+        queue_handler = log_handlers.start_listener([self.handler])
+        inherited = log_handlers.listener
+        inherited.stop()  # as if its thread was lost in the fork
+        log_handlers.restart_listener()
+        self.assertIsNot(log_handlers.listener, inherited)
+        self.assertIs(log_handlers.listener.queue, queue_handler.queue)
+        queue_handler.handle(make_record(msg="Forked worker %s"))
+        log_handlers.stop_listener()
+        self.assertEqual(self.handler.lines, ["Forked worker 1"])
+
+    def test_queued_json_logging(self):
+        """It should write JSON records from the listener thread"""
+        self.app.config.update(
+            LOG_QUEUE=True,
+            LOG_FORMAT="json",
+            LOG_SAMPLE_RATES={"logtest": 0.5},
+            LOG_RATE_LIMIT=100,
+        )
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.assertIsInstance(self.app.logger.handlers[0], QueueHandler)
+        client = self.app.test_client()
+        response = client.get("/", headers={"X-Request-ID": "abc123"})
+        self.assertEqual(response.headers["X-Request-ID"], "abc123")
+        response = client.get("/")
+        self.assertEqual(len(response.headers["X-Request-ID"]), 32)
+        log_handlers.stop_listener()
+        entries = [json.loads(line) for line in self.handler.lines]
+        requests = [entry for entry in entries if entry["message"] == "Handling request"]
+        # the sampler keeps every other record of the same message
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0]["request_id"], "abc123")
+        self.assertGreaterEqual(requests[0]["latency_ms"], 0)
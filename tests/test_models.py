@@ -4,12 +4,18 @@ Test cases for Pet Model
 """
 
 import os
+import json
 import logging
+from datetime import timedelta
+from types import SimpleNamespace
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+from sqlalchemy import delete, inspect, select, text, update
 from sqlalchemy.exc import SQLAlchemyError
+from flask import Flask
 from wsgi import app
-from service.models import Recommendation, DataValidationError, db
+from service.models import Recommendation, Tombstone, HotProduct, DataValidationError, DeadlineExceededError, db, name_index
+from service.models import RecommendationType, add_missing_columns, create_tables, normalize_types, recommendation_types
 from .factories import RecommendationFactory
 
 
@@ -37,6 +43,7 @@ class TestRecommendation(TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Recommendation).delete()  # clean up the last tests
+        db.session.query(Tombstone).delete()
         db.session.commit()
 
     @classmethod
@@ -178,6 +185,508 @@ class TestRecommendation(TestCase):
             recommendation.recommendation_type, data["recommendation_type"]
         )
 
+    def test_update_by_id(self):
+        """It should Update a Recommendation in a single statement"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        data = RecommendationFactory().serialize()
+        updated = Recommendation.update_by_id(recommendation.id, data)
+        self.assertEqual(updated["id"], recommendation.id)
+        self.assertEqual(updated["name"], data["name"])
+        self.assertEqual(updated["product_id"], data["product_id"])
+        self.assertEqual(updated["recommendation_type"], data["recommendation_type"])
+        db.session.expire_all()
+        found = Recommendation.find(recommendation.id)
+        self.assertEqual(found.serialize(), updated)
+
+    def test_update_by_id_not_found(self):
+        """It should return None when updating a Recommendation that does not exist"""
+        data = RecommendationFactory().serialize()
+        self.assertIsNone(Recommendation.update_by_id(0, data))
+
+    def test_update_by_id_not_found_bad_data(self):
+        """It should return None for an id that does not exist before checking the data"""
+        self.assertIsNone(Recommendation.update_by_id(0, {"name": "missing fields"}))
+
+    def test_update_by_id_bad_data(self):
+        """It should not Update a Recommendation in place with bad data"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        data = {"name": "missing fields"}
+        self.assertRaises(
+            DataValidationError, Recommendation.update_by_id, recommendation.id, data
+        )
+
+    def test_delete_by_id(self):
+        """It should Delete a Recommendation in a single statement"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        self.assertTrue(Recommendation.delete_by_id(recommendation.id))
+        self.assertEqual(Recommendation.query.count(), 0)
+        self.assertFalse(Recommendation.delete_by_id(recommendation.id))
+
+    def test_deletes_leave_tombstones(self):
+        """It should record the id and product of every deleted Recommendation"""
+        recommendations = [RecommendationFactory(product_id=i) for i in range(1, 4)]
+        for recommendation in recommendations:
+            recommendation.create()
+        recommendations[0].delete()
+        Recommendation.delete_by_id(recommendations[1].id)
+        tombstones = {row.id: row.product_id for row in Tombstone.query}
+        self.assertEqual(tombstones, {recommendations[0].id: 1, recommendations[1].id: 2})
+        self.assertEqual(Tombstone.purge(timedelta(days=1)), 0)
+        self.assertEqual(Tombstone.purge(timedelta(days=-1)), 2)
+
+    def test_hot_products(self):
+        """It should save the latest lookup counts of the hot products"""
+        db.session.query(HotProduct).delete()
+        HotProduct.record([(1, 10), (2, 30), (3, 20)])
+        HotProduct.record([(1, 40), (4, 5)])
+        self.assertEqual(HotProduct.hottest(3), [1, 2, 3])
+        db.session.execute(text("UPDATE hot_product SET seen_at = now() - interval '2 days' WHERE product_id = 2"))
+        HotProduct.record([])
+        self.assertEqual(HotProduct.hottest(10), [1, 3, 4])
+
+    def test_change_listeners(self):
+        """It should notify the listeners of writes to recommendations only"""
+        notify = Mock()
+        with patch("service.models.change_listeners", [notify]):
+            HotProduct.record([(1, 10)])
+            db.session.execute(delete(HotProduct))
+            db.session.commit()
+            notify.assert_not_called()
+            RecommendationFactory().create()
+            notify.assert_called_once()
+            db.session.execute(update(Recommendation).values(score=0.5))
+            db.session.commit()
+            self.assertEqual(notify.call_count, 2)
+
+    def test_timestamps(self):
+        """It should stamp Recommendations when they are created and written"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        self.assertIsNotNone(recommendation.created_at)
+        self.assertEqual(recommendation.created_at, recommendation.updated_at)
+        db.session.execute(
+            Recommendation.__table__.update().values(updated_at=recommendation.updated_at - timedelta(hours=1))
+        )
+        db.session.commit()
+        data = Recommendation.upsert(recommendation.serialize())
+        self.assertGreater(data["updated_at"], data["created_at"])
+
+    def test_changes(self):
+        """It should page through upserts and deletes in the order they happened"""
+        recommendations = []
+        for _ in range(4):
+            recommendations.append(RecommendationFactory())
+            recommendations[-1].create()
+        recommendations[0].delete()
+        changes, cursor = Recommendation.changes(limit=3)
+        self.assertEqual([change["op"] for change in changes], ["upsert"] * 3)
+        self.assertEqual([change["id"] for change in changes], [r.id for r in recommendations[1:]])
+        changes, cursor = Recommendation.changes(cursor, limit=3)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]["op"], "delete")
+        self.assertEqual(changes[0]["id"], recommendations[0].id)
+        self.assertEqual(changes[0]["product_id"], recommendations[0].product_id)
+        self.assertEqual(Recommendation.changes(cursor), ([], cursor))
+        Recommendation.update_by_id(recommendations[1].id, recommendations[1].serialize())
+        changes, _ = Recommendation.changes(cursor)
+        self.assertEqual([change["id"] for change in changes], [recommendations[1].id])
+        self.assertEqual(changes[0]["recommendation"]["name"], recommendations[1].name)
+        self.assertEqual(Recommendation.changes(cursor, lag=60), ([], cursor))
+        self.assertRaises(DataValidationError, Recommendation.changes, "not a cursor")
+
+    def test_changes_wait_for_open_transactions(self):
+        """It should hold back changes until every older transaction has ended"""
+        with db.engine.connect() as other:
+            other.execute(text("SELECT 1"))
+            recommendation = RecommendationFactory()
+            recommendation.create()
+            self.assertEqual(Recommendation.changes(), ([], None))
+            db.session.commit()
+            other.rollback()
+        changes, _ = Recommendation.changes()
+        self.assertEqual([change["id"] for change in changes], [recommendation.id])
+
+    def test_upsert_recommendation(self):
+        """It should insert a new Recommendation and update it on a retry"""
+        data = RecommendationFactory().serialize()
+        created = Recommendation.upsert(data)
+        self.assertIsNotNone(created["id"])
+        data["name"] = "Renamed"
+        updated = Recommendation.upsert(data)
+        self.assertEqual(updated["id"], created["id"])
+        self.assertEqual(updated["name"], "Renamed")
+        self.assertEqual(Recommendation.query.count(), 1)
+
+    def test_upsert_many_recommendations(self):
+        """It should upsert a list of Recommendations collapsing repeated keys"""
+        first = RecommendationFactory().serialize()
+        second = RecommendationFactory(product_id=first["product_id"] + 1).serialize()
+        repeat = dict(first, name="Last one wins")
+        results = Recommendation.upsert_many([first, second, repeat], batch_size=1)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]["name"], "Last one wins")
+        self.assertEqual(Recommendation.query.count(), 2)
+        self.assertRaises(DataValidationError, Recommendation.upsert_many, [{"name": "bad"}])
+
+    def test_unique_natural_key(self):
+        """It should not Create two Recommendations with the same natural key"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        duplicate = Recommendation().deserialize(recommendation.serialize())
+        self.assertRaises(DataValidationError, duplicate.create)
+
+    def test_remove_duplicates(self):
+        """It should remove all but the oldest of each duplicated Recommendation"""
+        index = next(i for i in Recommendation.__table__.indexes if i.name == "uq_recommendation_natural_key")
+        index.drop(db.engine)
+        try:
+            data = RecommendationFactory().serialize()
+            for _ in range(5):
+                Recommendation().deserialize(data).create()
+            RecommendationFactory(product_id=data["product_id"] + 1).create()
+            oldest = min(row.id for row in Recommendation.query.filter_by(product_id=data["product_id"]))
+            removed = Recommendation.remove_duplicates(batch_size=2)
+            self.assertEqual(removed, 4)
+            self.assertEqual(Recommendation.query.count(), 2)
+            self.assertIsNotNone(Recommendation.find(oldest))
+        finally:
+            index.create(db.engine)
+
+    def test_missing_index_with_duplicates(self):
+        """It should leave the natural key index to db-dedup while duplicates remain"""
+        index = next(i for i in Recommendation.__table__.indexes if i.name == "uq_recommendation_natural_key")
+        index.drop(db.engine)
+        try:
+            data = RecommendationFactory().serialize()
+            for _ in range(2):
+                Recommendation().deserialize(data).create()
+            add_missing_columns()
+            names = [i["name"] for i in inspect(db.engine).get_indexes("recommendation")]
+            self.assertNotIn(index.name, names)
+            self.assertEqual(Recommendation.remove_duplicates(), 1)
+        finally:
+            index.create(db.engine)
+
+    def test_normalize_types(self):
+        """It should move the type names of an older table into the lookup table"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        recommendation_id = recommendation.id
+        db.session.remove()
+        with db.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE recommendation ADD COLUMN recommendation_type varchar(63)"))
+            connection.execute(text("UPDATE recommendation SET recommendation_type = 'legacy'"))
+            connection.execute(text("ALTER TABLE recommendation DROP COLUMN type_id"))
+        normalize_types()
+        normalize_types()
+        add_missing_columns()
+        self.assertEqual(Recommendation.find(recommendation_id).recommendation_type, "legacy")
+        self.assertEqual(Recommendation.query_filter({"recommendation_type": "legacy"})[0].id, recommendation_id)
+        with db.engine.connect() as connection:
+            indexes = {index["name"] for index in inspect(connection).get_indexes("recommendation")}
+        self.assertTrue({index.name for index in Recommendation.__table__.indexes} <= indexes)
+
+    def test_create_types(self):
+        """It should only add a new type in the transaction of a write that commits"""
+        names = select(RecommendationType.name).where(RecommendationType.name.like("new-type-%"))
+        data = {**RecommendationFactory().serialize(), "recommendation_type": "new-type-1"}
+        try:
+            Recommendation().deserialize(data)
+            self.assertRaises(
+                DataValidationError, Recommendation.apply_batch, [{"op": "create", "data": data}, {"op": "delete", "id": 0}]
+            )
+            self.assertEqual(db.session.execute(names).scalars().all(), [])
+            self.assertIsNone(recommendation_types.id_of("new-type-1"))
+            results = Recommendation.apply_batch([{"op": "create", "data": data}])
+            self.assertEqual(results[0]["recommendation"]["recommendation_type"], "new-type-1")
+            self.assertIsNotNone(recommendation_types.id_of("new-type-1"))
+            with patch.object(recommendation_types, "max_names", len(recommendation_types)):
+                recommendation = Recommendation().deserialize({**data, "recommendation_type": "new-type-2"})
+                self.assertRaises(DataValidationError, recommendation.create)
+            self.assertEqual(db.session.execute(names).scalars().all(), ["new-type-1"])
+        finally:
+            db.session.rollback()
+            db.session.query(Recommendation).delete()
+            db.session.execute(delete(RecommendationType).where(RecommendationType.name.like("new-type-%")))
+            db.session.commit()
+            recommendation_types.clear()
+
+    def test_upsert_with_database_error(self):
+        """It should handle database errors during upserts"""
+        data = RecommendationFactory().serialize()
+        with patch(
+            "service.models.db.session.execute",
+            side_effect=SQLAlchemyError("Mocked exception"),
+        ):
+            self.assertRaises(DataValidationError, Recommendation.upsert, data)
+        with patch(
+            "service.models.db.session.execute",
+            side_effect=DeadlineExceededError("Request deadline exceeded"),
+        ):
+            self.assertRaises(DeadlineExceededError, Recommendation.upsert, data)
+
+    def test_stats(self):
+        """It should compute counts, top products and degree distributions"""
+        for product_id, recommended_product_id, kind in (
+            (1, 10, "cross-sell"),
+            (1, 11, "cross-sell"),
+            (1, 12, "up-sell"),
+            (2, 10, "up-sell"),
+            (3, 10, "accessory"),
+        ):
+            Recommendation(
+                name="stats",
+                product_id=product_id,
+                recommended_product_id=recommended_product_id,
+                recommendation_type=kind,
+            ).create()
+        stats = Recommendation.stats(top_k=2)
+        self.assertEqual(stats["total"], 5)
+        self.assertEqual(stats["by_type"], {"cross-sell": 2, "up-sell": 2, "accessory": 1})
+        self.assertEqual(stats["top_fan_out"], [{"product_id": 1, "count": 3}, {"product_id": 2, "count": 1}])
+        self.assertEqual(stats["top_fan_in"][0], {"product_id": 10, "count": 3})
+        self.assertEqual(stats["out_degree"], [{"degree": 1, "products": 2}, {"degree": 3, "products": 1}])
+        self.assertEqual(stats["in_degree"], [{"degree": 1, "products": 2}, {"degree": 3, "products": 1}])
+
+    def test_stats_cache(self):
+        """It should cache the statistics until the table changes"""
+        RecommendationFactory().create()
+        self.assertEqual(Recommendation.stats()["total"], 1)
+        with patch("service.models.db.session.execute") as execute:
+            self.assertEqual(Recommendation.stats()["total"], 1)
+            execute.assert_not_called()
+        RecommendationFactory().create()
+        self.assertEqual(Recommendation.stats()["total"], 2)
+        Recommendation.delete_by_id(0)
+        self.assertEqual(Recommendation.stats()["total"], 2)
+        db.session.query(Recommendation).delete()
+        db.session.rollback()
+        self.assertEqual(Recommendation.stats()["total"], 2)
+
+    def _create_named(self, *names, start=1):
+        """Creates a Recommendation for each name"""
+        for product_id, name in enumerate(names, start=start):
+            Recommendation(
+                name=name,
+                product_id=product_id,
+                recommended_product_id=1,
+                recommendation_type="cross-sell",
+            ).create()
+
+    def test_find_by_name(self):
+        """It should find Recommendations by exact name, prefix and substring"""
+        self._create_named("Running Shoes", "running socks", "Rain 100% Jacket", "Shoe Horn")
+        self.assertEqual(Recommendation.find_by_name("Running Shoes").count(), 1)
+        self.assertEqual(Recommendation.find_by_name("run", "prefix").count(), 2)
+        self.assertEqual(Recommendation.find_by_name("SHOE", "contains").count(), 2)
+        self.assertEqual(Recommendation.find_by_name("100%", "contains").count(), 1)
+        self.assertEqual(Recommendation.find_by_name("1_0", "contains").count(), 0)
+
+    def test_create_on_sqlite(self):
+        """It should Create a Recommendation and its type on SQLite"""
+        lite = Flask("lite")
+        lite.config.update(app.config, SQLALCHEMY_DATABASE_URI="sqlite://")
+        db.init_app(lite)
+        try:
+            with lite.app_context():
+                create_tables()
+                recommendation = RecommendationFactory(recommendation_type="cross-sell")
+                recommendation.create()
+                self.assertIsNotNone(recommendation.id)
+                found = Recommendation.find(recommendation.id)
+                self.assertEqual(found.recommendation_type, "cross-sell")
+                self.assertEqual(db.session.scalars(select(RecommendationType.id)).all(), [1])
+                db.session.remove()
+        finally:
+            recommendation_types.clear()
+
+    def test_find_by_name_in_memory(self):
+        """It should search names in memory when the database has no trigram index"""
+        self._create_named("Running Shoes", "running socks", "Shoe Horn")
+        sqlite = SimpleNamespace(dialect=SimpleNamespace(name="sqlite"))
+        with patch("service.models.db.session.get_bind", return_value=sqlite):
+            self.assertEqual(Recommendation.find_by_name("run", "prefix").count(), 2)
+            self.assertFalse(name_index.stale)
+            self._create_named("Runner Up", start=10)
+            self.assertTrue(name_index.stale)
+            self.assertEqual(Recommendation.find_by_name("run", "prefix").count(), 3)
+            self.assertEqual(Recommendation.find_by_name("shoe", "contains").count(), 2)
+
+    def test_query_filter(self):
+        """It should filter Recommendations by every column"""
+        self._create_named("Running Shoes", "running socks", "Shoe Horn")
+        self.assertEqual(len(Recommendation.query_filter({"product_id": 2})), 1)
+        self.assertEqual(len(Recommendation.query_filter({"name": "run"}, "prefix")), 2)
+        filters = {"name": "run", "recommendation_type": "up-sell"}
+        self.assertEqual(Recommendation.query_filter(filters, "prefix"), [])
+
+    def test_query_json(self):
+        """It should build the JSON array of the filtered Recommendations in the database"""
+        self._create_named("Running Shoes", "running socks", "Shoe Horn")
+        fields = [("label", "name"), ("type", "recommendation_type"), ("missing", "no_such_column")]
+        rows = json.loads(Recommendation.query_json({"name": "run"}, fields, "prefix"))
+        self.assertEqual(
+            sorted(rows, key=lambda row: row["label"]),
+            [
+                {"label": "Running Shoes", "type": "cross-sell", "missing": None},
+                {"label": "running socks", "type": "cross-sell", "missing": None},
+            ],
+        )
+        self.assertEqual(list(rows[0]), ["label", "type", "missing"])
+        self.assertEqual(Recommendation.query_json({"product_id": 0}, fields), "[]")
+        row = Recommendation.query_filter({"product_id": 2})[0].serialize()
+        fields = [(column, column) for column in row]
+        (built,) = json.loads(Recommendation.query_json({"product_id": 2}, fields))
+        row.update(created_at=row["created_at"].isoformat(), updated_at=row["updated_at"].isoformat())
+        self.assertEqual(built, row)
+        for stamp in ("2024-05-01 12:30:00+00", "2024-05-01 12:30:00.000120+00", "2024-05-01 12:30:00.5+00"):
+            db.session.execute(text(f"UPDATE recommendation SET created_at = '{stamp}' WHERE product_id = 2"))
+            row = Recommendation.query_filter({"product_id": 2})[0]
+            (built,) = json.loads(Recommendation.query_json({"product_id": 2}, [("created_at", "created_at")]))
+            self.assertEqual(built["created_at"], row.created_at.isoformat())
+
+    def test_score(self):
+        """It should validate the score and default it to 0"""
+        data = RecommendationFactory().serialize()
+        self.assertEqual(Recommendation().deserialize({**data, "score": "0.5"}).score, 0.5)
+        self.assertEqual(Recommendation().deserialize({**data, "score": None}).score, 0.0)
+        del data["score"]
+        self.assertEqual(Recommendation().deserialize(data).score, 0.0)
+        for score in ("high", float("inf"), [1]):
+            self.assertRaises(DataValidationError, Recommendation().deserialize, {**data, "score": score})
+
+    def _create_scored(self, *rows):
+        """Creates recommendations from (product_id, type, score) rows"""
+        for i, (product_id, kind, score) in enumerate(rows):
+            RecommendationFactory(
+                product_id=product_id, recommended_product_id=i, recommendation_type=kind, score=score
+            ).create()
+
+    def test_top(self):
+        """It should return the best scored Recommendations of each product"""
+        self._create_scored(
+            (1, "up-sell", 0.9), (1, "up-sell", 0.3), (1, "cross-sell", 0.7),
+            (1, "cross-sell", 0.8), (1, "accessory", 0.1), (2, "up-sell", 0.5), (2, "up-sell", 0.6),
+        )
+        top = Recommendation.top(3, {"product_id": 1})
+        self.assertEqual([r.score for r in top], [0.9, 0.8, 0.7])
+        top = Recommendation.top(3, {"product_id": 1, "recommendation_type": "up-sell"})
+        self.assertEqual([r.score for r in top], [0.9, 0.3])
+        top = Recommendation.top(5, {"product_id": 1, "min_score": 0.5})
+        self.assertEqual([r.score for r in top], [0.9, 0.8, 0.7])
+        top = Recommendation.top(1, {})
+        self.assertEqual([(r.product_id, r.score) for r in top], [(1, 0.9), (2, 0.6)])
+        self.assertEqual(len(Recommendation.query_filter({"min_score": 0.6})), 4)
+
+    def test_replace_generated(self):
+        """It should write generated Recommendations and drop the stale ones"""
+        self._create_scored((1, "cross-sell", 0.5), (1, "up-sell", 0.5), (3, "cross-sell", 0.5))
+        db.session.execute(
+            Recommendation.__table__.update().values(updated_at=Recommendation.updated_at - timedelta(hours=1))
+        )
+        db.session.commit()
+        top = {1: [(1, 2.5), (7, 1.5)], 2: [(1, 3.0)]}
+        written, removed = Recommendation.replace_generated("cross-sell", top.items(), "Bought together", batch_size=2)
+        self.assertEqual((written, removed), (3, 1))
+        self.assertEqual(Recommendation.find_by_name("Bought together").count(), 3)
+        rows = Recommendation.query_filter({"product_id": 1, "recommendation_type": "cross-sell"})
+        self.assertEqual(sorted((r.recommended_product_id, r.score) for r in rows), [(1, 2.5), (7, 1.5)])
+        top = {1: [(7, 1.0)], 3: []}
+        written, removed = Recommendation.replace_generated("cross-sell", top.items(), "Bought together")
+        self.assertEqual((written, removed), (1, 2))
+        self.assertEqual(len(Recommendation.query_filter({"product_id": 1})), 2)
+        self.assertEqual(Recommendation.query_filter({"product_id": 3}), [])
+
+    def test_recommended_by(self):
+        """It should page through the Recommendations that point at a product"""
+        for product_id, kind in ((1, "up-sell"), (2, "cross-sell"), (3, "up-sell"), (4, "cross-sell"), (5, "accessory")):
+            RecommendationFactory(product_id=product_id, recommended_product_id=9, recommendation_type=kind).create()
+        RecommendationFactory(product_id=1, recommended_product_id=8).create()
+        page, cursor = Recommendation.recommended_by(9, limit=2)
+        self.assertEqual(len(page), 2)
+        seen = list(page)
+        while cursor:
+            page, cursor = Recommendation.recommended_by(9, after=cursor, limit=2)
+            seen.extend(page)
+        # in the order of the index, by type id then id
+        keys = [(recommendation_types.id_of(r.recommendation_type), r.id) for r in seen]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(sorted(r.product_id for r in seen), [1, 2, 3, 4, 5])
+        page, cursor = Recommendation.recommended_by(9, "up-sell")
+        self.assertEqual(([r.product_id for r in page], cursor), ([1, 3], None))
+        self.assertRaises(DataValidationError, Recommendation.recommended_by, 9, after="nonsense")
+
+    def test_suppress_recommended(self):
+        """It should hide the Recommendations of a product from lookups by product"""
+        self._create_scored((1, "up-sell", 0.9), (2, "up-sell", 0.8), (2, "cross-sell", 0.7))
+        Recommendation.query.update({"recommended_product_id": 9})
+        db.session.commit()
+        self.assertEqual(Recommendation.suppress_recommended(9, recommendation_type="up-sell"), 2)
+        self.assertEqual(Recommendation.suppress_recommended(9, recommendation_type="up-sell"), 0)
+        self.assertEqual([r.score for r in Recommendation.query_filter({})], [0.7])
+        self.assertEqual([r.score for r in Recommendation.top(3, {"product_id": 2})], [0.7])
+        page, _ = Recommendation.recommended_by(9)
+        self.assertEqual(len(page), 3)
+        self.assertTrue(Recommendation.find(page[1].id).serialize()["suppressed"])
+        self.assertEqual(Recommendation.suppress_recommended(9, False), 2)
+        self.assertEqual(len(Recommendation.query_filter({"recommended_product_id": 9})), 3)
+
+    def test_apply_batch(self):
+        """It should apply creates, updates and deletes in order in one transaction"""
+        first, second = RecommendationFactory(), RecommendationFactory()
+        first.create()
+        operations = [
+            {"op": "create", "data": second.serialize()},
+            {"op": "update", "id": first.id, "data": {**first.serialize(), "name": "renamed"}},
+            {"op": "create", "data": {**second.serialize(), "recommendation_type": "other"}},
+            {"op": "delete", "id": first.id, "product_id": first.product_id},
+        ]
+        results = Recommendation.apply_batch(operations)
+        self.assertEqual([result["status"] for result in results], [201, 200, 201, 204])
+        self.assertEqual(results[1]["recommendation"]["name"], "renamed")
+        self.assertEqual(results[2]["recommendation"]["recommendation_type"], "other")
+        self.assertEqual(
+            sorted(r.id for r in Recommendation.all()),
+            [results[0]["recommendation"]["id"], results[2]["recommendation"]["id"]],
+        )
+        self.assertEqual(db.session.query(Tombstone).count(), 1)
+
+    def test_apply_batch_atomic(self):
+        """It should apply none of an atomic batch when one operation fails"""
+        data = RecommendationFactory().serialize()
+        self.assertRaises(
+            DataValidationError, Recommendation.apply_batch, [{"op": "create", "data": data}, {"op": "upsert"}]
+        )
+        self.assertRaises(
+            DataValidationError, Recommendation.apply_batch, [{"op": "create", "data": data}, {"op": "delete"}]
+        )
+        self.assertRaises(
+            DataValidationError, Recommendation.apply_batch, [{"op": "create", "data": data}] * 2
+        )
+        for missing in ({"op": "delete", "id": 0}, {"op": "update", "id": 0, "data": data}):
+            with self.assertRaisesRegex(DataValidationError, "Operation 1: .* '0' was not found"):
+                Recommendation.apply_batch([{"op": "create", "data": data}, missing])
+        self.assertEqual(Recommendation.all(), [])
+        self.assertEqual(db.session.query(Tombstone).count(), 0)
+
+    def test_apply_batch_best_effort(self):
+        """It should report the operations that fail and apply the others"""
+        data = RecommendationFactory().serialize()
+        operations = [
+            {"op": "create", "data": data},
+            {"op": "create", "data": data},
+            {"op": "create", "data": {**data, "product_id": "one"}},
+            {"op": "create", "data": {**data, "recommendation_type": "other"}},
+            {"op": "delete", "id": 0},
+        ]
+        results = Recommendation.apply_batch(operations, atomic=False)
+        self.assertEqual([result["status"] for result in results], [201, 400, 400, 201, 404])
+        self.assertIn("uq_recommendation_natural_key", results[1]["error"])
+        self.assertEqual(len(Recommendation.all()), 2)
+
     def test_deserialize_missing_data(self):
         """It should not deserialize a Recommendation with missing data"""
         data = {"name": "Sample Recommendation"}
@@ -228,3 +737,23 @@ class TestRecommendation(TestCase):
                 recommendation.delete()
             self.assertTrue(mock_delete.called)
             self.assertIn("Mocked exception", str(context.exception))
+
+    def test_in_place_writes_with_database_error(self):
+        """It should handle database errors during in place updates and deletes"""
+        data = RecommendationFactory().serialize()
+        with patch(
+            "service.models.db.session.execute",
+            side_effect=SQLAlchemyError("Mocked exception"),
+        ):
+            self.assertRaises(DataValidationError, Recommendation.update_by_id, 1, data)
+            self.assertRaises(DataValidationError, Recommendation.delete_by_id, 1)
+
+    def test_in_place_writes_past_deadline(self):
+        """It should not turn a deadline error into a validation error"""
+        data = RecommendationFactory().serialize()
+        with patch(
+            "service.models.db.session.execute",
+            side_effect=DeadlineExceededError("Request deadline exceeded"),
+        ):
+            self.assertRaises(DeadlineExceededError, Recommendation.update_by_id, 1, data)
+            self.assertRaises(DeadlineExceededError, Recommendation.delete_by_id, 1)
@@ -6,10 +6,12 @@ TestRecommendation API Service Test Suite
 import os
 import logging
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError
 from wsgi import app
 from service import routes
-from service.common import status
-from service.models import db, Recommendation
+from service.common import read_cache, status
+from service.models import db, hot_cache, HotProduct, Recommendation, Tombstone
 from .factories import RecommendationFactory
 from urllib.parse import quote_plus
 
@@ -42,9 +44,10 @@ class TestYourResourceService(TestCase):
 
     def setUp(self):
         """Runs before each test"""
-        self.app = app.test_client()
+        self.client = app.test_client()
         self.headers = {"X-Api-Key": app.config["API_KEY"]}
         db.session.query(Recommendation).delete()  # clean up the last tests
+        db.session.query(Tombstone).delete()
         db.session.commit()
 
     @classmethod
@@ -54,8 +57,11 @@ class TestYourResourceService(TestCase):
 
     def tearDown(self):
         """Clear the database"""
-        resp = self.app.delete(BASE_URL, headers=self.headers)
-        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        db.session.rollback()
+        db.session.query(Recommendation).delete()
+        db.session.query(Tombstone).delete()
+        db.session.commit()
+        db.session.remove()
 
     ######################################################################
     #  P L A C E   T E S T   C A S E S   H E R E
@@ -110,6 +116,116 @@ class TestYourResourceService(TestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertIsNone(Recommendation.find(recommendation.id))
 
+    def test_update_recommendation(self):
+        """It should Update an existing Recommendation"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        data = recommendation.serialize()
+        data["name"] = "Updated"
+        response = self.client.put(f"{BASE_URL}/{recommendation.id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json["name"], "Updated")
+        self.assertEqual(response.json["product_id"], recommendation.product_id)
+
+    def test_update_recommendation_not_found(self):
+        """It should not Update a Recommendation that does not exist"""
+        data = RecommendationFactory().serialize()
+        response = self.client.put(f"{BASE_URL}/0", json=data)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_recommendation_not_found_bad_data(self):
+        """It should not find a Recommendation that does not exist before checking the data"""
+        response = self.client.put(f"{BASE_URL}/0", json={"name": "missing fields"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_recommendation_bad_data(self):
+        """It should not Update a Recommendation with bad data"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        response = self.client.put(
+            f"{BASE_URL}/{recommendation.id}", json={"name": "missing fields"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recommendation_with_partition_key(self):
+        """It should look a Recommendation up by id and product_id"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        url = f"{BASE_URL}/{recommendation.id}"
+        response = self.client.get(url, query_string={"product_id": recommendation.product_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, query_string={"product_id": recommendation.product_id + 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        data = recommendation.serialize()
+        response = self.client.put(url, json=data, query_string={"product_id": recommendation.product_id + 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.delete(url, query_string={"product_id": recommendation.product_id})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIsNone(Recommendation.find(recommendation.id))
+
+    def test_upsert_recommendation(self):
+        """It should Create a Recommendation and then Update it by its natural key"""
+        data = RecommendationFactory().serialize()
+        del data["id"]
+        response = self.client.put(f"{BASE_URL}/upsert", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data["name"] = "Retried"
+        response = self.client.put(f"{BASE_URL}/upsert", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json["name"], "Retried")
+        self.assertEqual(Recommendation.query.count(), 1)
+
+    def test_bulk_upsert_recommendations(self):
+        """It should Create or Update a list of Recommendations"""
+        items = [RecommendationFactory(product_id=n).serialize() for n in range(1, 4)]
+        response = self.client.put(f"{BASE_URL}/upsert/bulk", json=items)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json), 3)
+        response = self.client.put(f"{BASE_URL}/upsert/bulk", json=items)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Recommendation.query.count(), 3)
+
+    def test_recommendation_stats(self):
+        """It should return aggregate statistics about the Recommendations"""
+        recommendations = self._create_recommendations(3)
+        response = self.client.get(f"{BASE_URL}/stats", query_string="top_k=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["total"], 3)
+        self.assertEqual(sum(data["by_type"].values()), 3)
+        self.assertLessEqual(len(data["top_fan_out"]), 2)
+        self.assertIn(data["top_fan_out"][0]["product_id"], [r.product_id for r in recommendations])
+        self.assertEqual(sum(d["degree"] * d["products"] for d in data["out_degree"]), 3)
+
+    def test_recommendation_changes(self):
+        """It should return the changes after a cursor"""
+        recommendations = self._create_recommendations(3)
+        self.client.delete(f"{BASE_URL}/{recommendations[0].id}")
+        with patch.dict(app.config, {"CHANGE_FEED_LAG": 0}):
+            response = self.client.get(f"{BASE_URL}/changes", query_string="limit=2")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertEqual([change["id"] for change in data["changes"]], [r.id for r in recommendations[1:]])
+            self.assertEqual(data["changes"][0]["recommendation"]["name"], recommendations[1].name)
+            self.assertIsNotNone(data["changes"][0]["changed_at"])
+            response = self.client.get(f"{BASE_URL}/changes", query_string={"since": data["next"]})
+            data = response.get_json()
+            self.assertEqual(len(data["changes"]), 1)
+            self.assertEqual(data["changes"][0]["op"], "delete")
+            self.assertIsNone(data["changes"][0]["recommendation"])
+
+    def test_query_top_k(self):
+        """It should Query the best scored Recommendations of a product"""
+        for i, score in enumerate((0.2, 0.9, 0.5)):
+            RecommendationFactory(product_id=7, recommended_product_id=i, score=score).create()
+        response = self.client.get(BASE_URL, query_string="product_id=7&top_k=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["score"] for r in response.get_json()], [0.9, 0.5])
+        response = self.client.get(BASE_URL, query_string="product_id=7&min_score=0.4")
+        self.assertEqual(len(response.get_json()), 2)
+        response = self.client.get(BASE_URL, query_string="top_k=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def _create_recommendations(self, count):
         """Factory method to create recommendations in bulk"""
         recommendations = []
@@ -142,6 +258,202 @@ class TestYourResourceService(TestCase):
                 recommendation["recommended_product_id"], test_recommended_product_id
             )
 
+    def test_recommended_by(self):
+        """It should page through and suppress the Recommendations of a product"""
+        for product_id in range(1, 4):
+            RecommendationFactory(product_id=product_id, recommended_product_id=9).create()
+        url = "/api/products/9/recommended-by"
+        response = self.client.get(url, query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data["recommendations"]), 2)
+        response = self.client.get(url, query_string={"limit": 2, "after": data["next"]})
+        data = response.get_json()
+        self.assertEqual((len(data["recommendations"]), data["next"]), (1, None))
+        response = self.client.put(url, json={"suppressed": True}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["updated"], 3)
+        self.assertEqual(self.client.get(BASE_URL).get_json(), [])
+        self.assertTrue(all(r["suppressed"] for r in self.client.get(url).get_json()["recommendations"]))
+
+    def test_apply_batch(self):
+        """It should apply a batch of operations and return their results"""
+        recommendation = self._create_recommendations(1)[0]
+        data = RecommendationFactory().serialize()
+        operations = [{"op": "create", "data": data}, {"op": "delete", "id": recommendation.id}]
+        response = self.client.post(
+            f"{BASE_URL}/batch", json={"operations": operations}, headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [201, 204])
+        self.assertEqual(results[0]["recommendation"]["name"], data["name"])
+        self.assertNotIn("recommendation", results[1])
+        response = self.client.post(
+            f"{BASE_URL}/batch", json={"operations": [{"op": "create", "data": data}], "atomic": False}
+        )
+        self.assertEqual(response.get_json()["results"][0]["status"], status.HTTP_400_BAD_REQUEST)
+        operations[0]["data"] = RecommendationFactory().serialize()
+        response = self.client.post(f"{BASE_URL}/batch", json={"operations": operations}, headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("was not found", response.get_json()["message"])
+        self.assertEqual(Recommendation.query.count(), 1)
+
+    def test_query_hot_cache(self):
+        """It should serve the list of a product from the shared cache until a write"""
+        recommendation = self._create_recommendations(1)[0]
+        url = f"{BASE_URL}?product_id={recommendation.product_id}"
+        hot_cache.open(2**16, slot_size=2**12)
+        try:
+            first = self.client.get(url)
+            with patch("service.models.Recommendation.query_filter") as query_mock:
+                cached = self.client.get(url)
+                query_mock.assert_not_called()
+            self.assertEqual(cached.get_json(), first.get_json())
+            recommendation.score = 0.5
+            recommendation.update()
+            self.assertEqual(self.client.get(url).get_json()[0]["score"], 0.5)
+            self.assertEqual(
+                self.client.get(url, headers={"X-Fields": "name"}).get_json(), [{"name": recommendation.name}]
+            )
+        finally:
+            hot_cache.close()
+
+    def test_hot_keys(self):
+        """It should count the product_id and id lookups of the hottest keys"""
+        for tracker in read_cache.hot_keys.values():
+            tracker.clear()
+        recommendations = self._create_recommendations(2)
+        for _ in range(3):
+            self.client.get(f"{BASE_URL}?product_id={recommendations[0].product_id}")
+        self.client.get(f"{BASE_URL}?product_id={recommendations[1].product_id}&top_k=5")
+        self.client.get(f"{BASE_URL}/{recommendations[1].id}")
+        response = self.client.get("/api/admin/hot-keys")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get("/api/admin/hot-keys", query_string="limit=0", headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/api/admin/hot-keys", headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["lookups"], {"product_id": 4, "id": 1})
+        self.assertEqual(
+            data["product_id"],
+            [
+                {"key": recommendations[0].product_id, "lookups": 3},
+                {"key": recommendations[1].product_id, "lookups": 1},
+            ],
+        )
+        self.assertEqual(data["id"], [{"key": recommendations[1].id, "lookups": 1}])
+
+    def test_warm_hot_products(self):
+        """It should save the hot products and load their lists into the shared cache"""
+        for tracker in read_cache.hot_keys.values():
+            tracker.clear()
+        recommendation = self._create_recommendations(1)[0]
+        url = f"{BASE_URL}?product_id={recommendation.product_id}"
+        self.assertEqual(read_cache.warm_hot_products([recommendation.product_id]), 0)
+        read_cache.hot_keys["product_id"].record(recommendation.product_id)
+        read_cache.hot_keys["product_id"].record(recommendation.product_id)
+        hot_cache.open(2**16, slot_size=2**12)
+        try:
+            read_cache.refresh_hot_keys(app)
+            with patch("service.models.Recommendation.query_filter") as query_mock:
+                response = self.client.get(url)
+                query_mock.assert_not_called()
+            self.assertEqual(response.get_json()[0]["name"], recommendation.name)
+        finally:
+            hot_cache.close()
+        self.assertIn(recommendation.product_id, HotProduct.hottest(10))
+        # halved to 1 by the refresh, then counted again by the GET
+        self.assertEqual(read_cache.hot_keys["product_id"].top(), [(recommendation.product_id, 2)])
+
+    def test_serve_stale(self):
+        """It should serve lookups while they are refreshed and while the database is down"""
+        recommendation = self._create_recommendations(1)[0]
+        url = f"{BASE_URL}/{recommendation.id}"
+        list_url = f"{BASE_URL}?product_id={recommendation.product_id}"
+        app.config["SERVE_STALE"] = True
+        try:
+            response = self.client.get(url)
+            self.assertEqual(response.headers["Age"], "0")
+            self.assertNotIn("Warning", response.headers)
+            self.assertEqual(len(self.client.get(list_url).get_json()), 1)
+            read_cache.stale_reads.soft_ttl = 0
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.headers["Warning"], '110 - "Response is Stale"')
+            read_cache.stale_reads.soft_ttl = read_cache.stale_reads.hard_ttl = 0
+            with patch(
+                "service.models.Recommendation.find_row", side_effect=OperationalError("SELECT", {}, Exception())
+            ):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["name"], recommendation.name)
+            self.assertEqual(response.headers["Warning"], '111 - "Revalidation Failed"')
+            read_cache.stale_reads.failed_until = 0
+            recommendation.delete()
+            self.assertEqual(self.client.get(list_url).get_json(), [])
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            app.config["SERVE_STALE"] = False
+            read_cache.stale_reads.soft_ttl = app.config["STALE_SOFT_TTL"]
+            read_cache.stale_reads.hard_ttl = app.config["STALE_HARD_TTL"]
+            read_cache.stale_reads.failed_until = 0
+            read_cache.stale_reads.clear()
+
+    def test_query_json_from_db(self):
+        """It should answer list requests with the JSON built by the database"""
+        recommendations = self._create_recommendations(3)
+        product_id = recommendations[0].product_id
+        urls = [BASE_URL, f"{BASE_URL}?product_id={product_id}", f"{BASE_URL}?name={quote_plus(recommendations[1].name)}"]
+        marshalled = [self.client.get(url).get_json() for url in urls]
+        app.config["JSON_FROM_DB"] = True
+        try:
+            with patch("service.models.Recommendation.query_filter") as query_mock:
+                built = [self.client.get(url) for url in urls]
+                query_mock.assert_not_called()
+            for response, expected in zip(built, marshalled):
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.content_type, "application/json")
+                self.assertEqual(
+                    sorted(response.get_json(), key=lambda row: row["name"]),
+                    sorted(expected, key=lambda row: row["name"]),
+                )
+            self.assertEqual(
+                self.client.get(urls[1], headers={"X-Fields": "name"}).get_json(),
+                [{"name": recommendations[0].name}],
+            )
+            self.assertEqual(len(self.client.get(f"{urls[1]}&top_k=1").get_json()), 1)
+            response = self.client.get(BASE_URL, query_string="invalid_param=value")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            hot_cache.open(2**16, slot_size=2**12)
+            try:
+                self.client.get(urls[1])
+                with patch("service.models.Recommendation.query_json") as query_mock:
+                    self.assertEqual(self.client.get(urls[1]).get_json(), built[1].get_json())
+                    query_mock.assert_not_called()
+            finally:
+                hot_cache.close()
+        finally:
+            app.config["JSON_FROM_DB"] = False
+
+    def test_query_by_name_prefix(self):
+        """It should Query Recommendations by name prefix and substring"""
+        for product_id, name in enumerate(["Running Shoes", "running socks", "Shoe Horn"], start=1):
+            RecommendationFactory(name=name, product_id=product_id).create()
+        response = self.client.get(BASE_URL, query_string="name=run&name_match=prefix")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+        response = self.client.get(BASE_URL, query_string="name=shoe&name_match=contains")
+        self.assertEqual(sorted(r["name"] for r in response.get_json()), ["Running Shoes", "Shoe Horn"])
+        response = self.client.get(BASE_URL, query_string="name=Shoe Horn")
+        self.assertEqual(len(response.get_json()), 1)
+
+    def test_query_bad_name_match(self):
+        """It should not Query Recommendations with an unknown name_match"""
+        response = self.client.get(BASE_URL, query_string="name=run&name_match=fuzzy")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_invalid_query_parameters(self):
         """It should return error for invalid query parameters"""
         response = self.client.get(BASE_URL, query_string="invalid_param=value")
@@ -197,6 +509,41 @@ class TestSadPaths(TestCase):
         response = self.client.post(BASE_URL, json=data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_bulk_upsert_not_a_list(self):
+        """It should not bulk upsert a body that is not a list"""
+        response = self.client.put(f"{BASE_URL}/upsert/bulk", json={"name": "one"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recommendation_stats_bad_top_k(self):
+        """It should not return statistics for an out of range top_k"""
+        response = self.client.get(f"{BASE_URL}/stats", query_string="top_k=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_recommendation_changes_bad_arguments(self):
+        """It should not return changes for a bad cursor or limit"""
+        response = self.client.get(f"{BASE_URL}/changes", query_string="since=nonsense")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}/changes", query_string="limit=1001")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_apply_batch_bad_data(self):
+        """It should not apply a batch that is not a list or fails validation"""
+        response = self.client.post(f"{BASE_URL}/batch", json=[{"op": "delete", "id": 1}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/batch", json={"operations": [{"op": "update", "id": 1}]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Operation 0", response.get_json()["message"])
+
+    def test_recommended_by_bad_arguments(self):
+        """It should not page or suppress with bad arguments"""
+        url = "/api/products/9/recommended-by"
+        response = self.client.get(url, query_string="limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, query_string="after=nonsense")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.put(url, json={"suppressed": "yes"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_404_not_found(self):
         """It should return 404 for non-existent endpoints"""
         response = self.client.get("/hello")
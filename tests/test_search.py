@@ -0,0 +1,44 @@
+"""
+Test cases for the Name Search
+"""
+
+from unittest import TestCase
+from service.common.search import NameIndex, like_pattern
+
+
+######################################################################
+#  N A M E   I N D E X   T E S T   C A S E S
+######################################################################
+class TestNameIndex(TestCase):
+    """Name Index Tests"""
+
+    def setUp(self):
+        self.index = NameIndex()
+        self.index.build(
+            [(1, "Running Shoes"), (2, "Running Socks"), (3, "Rain Jacket"), (4, None), (5, "Shoe Horn")]
+        )
+
+    def test_prefix(self):
+        """It should find names by prefix ignoring case"""
+        self.assertEqual(sorted(self.index.prefix("run")), [1, 2])
+        self.assertEqual(self.index.prefix("RAIN"), [3])
+        self.assertEqual(self.index.prefix("zzz"), [])
+        self.assertEqual(len(self.index), 4)
+
+    def test_contains(self):
+        """It should find names containing a substring ignoring case"""
+        self.assertEqual(sorted(self.index.contains("shoe")), [1, 5])
+        self.assertEqual(sorted(self.index.contains("s")), [1, 2, 5])
+        self.assertEqual(self.index.contains("jackets"), [])
+
+    def test_invalidate(self):
+        """It should be stale until it is built"""
+        self.assertFalse(self.index.stale)
+        self.index.invalidate()
+        self.assertTrue(self.index.stale)
+        self.assertTrue(NameIndex().stale)
+
+    def test_like_pattern(self):
+        """It should escape LIKE wildcards"""
+        self.assertEqual(like_pattern("50%_off", "prefix"), "50\\%\\_off%")
+        self.assertEqual(like_pattern("a\\b", "contains"), "%a\\\\b%")
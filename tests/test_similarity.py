@@ -0,0 +1,75 @@
+"""
+Test cases for the Similarity Engine
+"""
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from service.common.similarity import normalize, read_csv, read_npy, top_similar
+
+
+######################################################################
+#  S I M I L A R I T Y   T E S T   C A S E S
+######################################################################
+class TestSimilarity(TestCase):
+    """Similarity Engine Tests"""
+
+    def test_read_csv(self):
+        """It should read product ids and features from CSV"""
+        stream = io.StringIO("product_id,a,b\n1,0.5,1\n\n2,3,4\n")
+        self.assertEqual(read_csv(stream), ([1, 2], [[0.5, 1.0], [3.0, 4.0]]))
+        self.assertRaises(ValueError, read_csv, io.StringIO("1,x\n"))
+
+    def test_read_npy(self):
+        """It should read product ids and features from a .npy array"""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "vectors.npy")
+            np.save(path, np.array([[1, 0.5, 1], [2, 3, 4]]))
+            ids, vectors = read_npy(path)
+            self.assertEqual((ids.tolist(), vectors.tolist()), ([1, 2], [[0.5, 1.0], [3.0, 4.0]]))
+            np.save(path, np.array([[7, 0.5]], dtype=np.float32))
+            ids, vectors = read_npy(path)
+            self.assertEqual((ids.tolist(), vectors.tolist()), ([7], [[0.5]]))
+            np.save(path, np.array([[1, 2]]))
+            self.assertRaises(ValueError, read_npy, path)
+            with open(path, "wb") as file:
+                file.write(b"not numpy")
+            self.assertRaises(ValueError, read_npy, path)
+
+    def test_normalize(self):
+        """It should scale vectors to unit length"""
+        self.assertEqual(normalize([[3, 4], [0, 0]]).tolist(), [[0.6, 0.8], [0.0, 0.0]])
+        self.assertRaises(ValueError, normalize, [[1], [1, 2]])
+
+    def test_top_similar(self):
+        """It should keep the most similar products of each product"""
+        ids = [1, 2, 3, 4]
+        vectors = [[1, 0], [0.9, 0.1], [0, 1], [0, 0]]
+        neighbours = dict(top_similar(ids, vectors, top_k=1, block_size=3))
+        self.assertEqual(neighbours[1], [(2, 0.993884)])
+        self.assertEqual(neighbours[3], [(2, 0.110432)])
+        self.assertEqual(neighbours[4], [])
+        neighbours = dict(top_similar(ids, vectors, top_k=5, min_score=0.5))
+        self.assertEqual([other for other, _ in neighbours[1]], [2])
+        self.assertRaises(ValueError, list, top_similar([1, 2], [[1], [1, 2]]))
+
+    def test_top_similar_shard(self):
+        """It should only find the neighbours of the products in a shard"""
+        ids = [1, 2, 3, 4]
+        vectors = [[1, 0], [0.9, 0.1], [0, 1], [1, 1]]
+        neighbours = dict(top_similar(ids, vectors, top_k=1, shard=(1, 2)))
+        self.assertEqual(sorted(neighbours), [1, 3])
+        self.assertEqual(neighbours[3][0][0], 4)
+
+    def test_top_similar_blocks(self):
+        """It should find the same neighbours whatever the block size"""
+        generator = np.random.default_rng(7)
+        ids = list(range(100, 400))
+        vectors = generator.normal(size=(len(ids), 16))
+        expected = dict(top_similar(ids, vectors, top_k=5, block_size=len(ids)))
+        self.assertEqual(dict(top_similar(ids, vectors, top_k=5, block_size=7)), expected)
+        scores = normalize(vectors) @ normalize(vectors).T
+        np.fill_diagonal(scores, -np.inf)
+        self.assertEqual([other for other, _ in expected[100]], [ids[i] for i in np.argsort(-scores[0])[:5]])